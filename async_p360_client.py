@@ -0,0 +1,24 @@
+# Stdlibs
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncP360Client:
+
+    # Runs blocking P360 calls (P360Client methods and the Server helpers built on them) from asyncio. The calls run
+    # on a thread pool that is as large as the HTTP connection pool, so concurrent calls share the keep-alive
+    # connections of the wrapped client instead of opening new ones.
+    def __init__(self, p360_client, max_workers=None):
+        self.p360_client = p360_client
+        if max_workers is None:
+            max_workers = p360_client.transport.pool_maxsize
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="p360")
+
+    async def run(self, function, *args, **kwargs):
+        # The call runs in a copy of the caller's context, so context variables (like the timings of the message
+        # being processed) are visible on the worker thread
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, function, *args, **kwargs))
@@ -0,0 +1,61 @@
+# Compares P360 lookup latency with and without hedged requests, against the fake P360 server with a long tail:
+# most lookups answer in --fast seconds, a share --slow-share of them take --slow seconds.
+#
+#   python benchmarks/bench_hedging.py --lookups 1000 --slow-share 0.03 --budget 0.05
+
+# Stdlibs
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from p360_client import P360Client
+from hedging import Hedger
+from fake_p360 import FakeP360Server
+from bench_server import get_percentile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=500)
+    parser.add_argument("--fast", type=float, default=0.01)
+    parser.add_argument("--slow", type=float, default=1.0)
+    parser.add_argument("--slow-share", type=float, default=0.03)
+    parser.add_argument("--percentile", type=float, default=95)
+    parser.add_argument("--budget", type=float, default=0.05)
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.WARNING)
+
+    fake_p360 = FakeP360Server().start()
+    fake_p360.state.add_contact("hr@example.com")
+    fake_p360.state.get_response_delay = lambda: args.slow if random.random() < args.slow_share else args.fast
+
+    for name, hedger in (("without hedging", None),
+                         ("with hedging", Hedger(log=log, percentile=args.percentile, budget_ratio=args.budget))):
+        client = P360Client(log=log, api_base_uri=fake_p360.get_base_uri(), api_key="benchmark",
+                            single_flight=False, hedger=hedger)
+        fake_p360.state.reset_counters()
+        latencies = []
+        for i in range(args.lookups):
+            start = time.perf_counter()
+            client.get_contact_person_by_email("hr@example.com")
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print("%-16s p50 %6.1f ms, p95 %6.1f ms, p99 %6.1f ms, max %6.1f ms, %5.1f %% extra requests" % (
+            name, 1000 * get_percentile(latencies, 50), 1000 * get_percentile(latencies, 95),
+            1000 * get_percentile(latencies, 99), 1000 * latencies[-1],
+            100.0 * (fake_p360.state.get_total_calls() - args.lookups) / args.lookups))
+        client.close()
+
+    fake_p360.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Shows how the adaptive concurrency limiter and the circuit breaker react when P360 slows down or fails. Runs
+# lookups from many threads against the fake P360 server through phases of normal latency, a slowdown, an outage
+# and a recovery, and prints the limiter and breaker state twice a second.
+#
+#   python benchmarks/bench_limiter.py --threads 16 --phase-seconds 5
+
+# Stdlibs
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from p360_client import P360Client
+from p360_limiter import AdaptiveLimiter, CircuitBreaker
+from errors import RetryableError
+from fake_p360 import FakeP360Server
+
+
+class Load:
+
+    def __init__(self, client, thread_count):
+        self.client = client
+        self.thread_count = thread_count
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.counts = {"ok": 0, "failed": 0, "failed fast": 0}
+        self.threads = []
+
+    def start(self):
+        for i in range(self.thread_count):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.client.get_contact_person_by_email("hr@example.com")
+                outcome = "ok"
+            except RetryableError:
+                outcome = "failed fast"
+                # A consumer would requeue the message and wait before taking the next one
+                time.sleep(0.1)
+            except Exception:
+                outcome = "failed"
+            with self.lock:
+                self.counts[outcome] += 1
+
+    def take_counts(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = {"ok": 0, "failed": 0, "failed fast": 0}
+        return counts
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--pool-size", type=int, default=16)
+    parser.add_argument("--phase-seconds", type=float, default=5.0)
+    parser.add_argument("--normal-latency", type=float, default=0.02)
+    parser.add_argument("--slow-latency", type=float, default=0.5)
+    parser.add_argument("--latency-target", type=float, default=0.2)
+    parser.add_argument("--open-duration", type=float, default=2.0)
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.ERROR)
+
+    fake_p360 = FakeP360Server(latency=args.normal_latency).start()
+    fake_p360.state.add_contact("hr@example.com")
+
+    limiter = AdaptiveLimiter(log=log, initial_limit=args.pool_size, max_limit=args.pool_size,
+                              latency_target=args.latency_target, acquire_timeout=10)
+    circuit_breaker = CircuitBreaker(log=log, open_duration=args.open_duration)
+    client = P360Client(log=log, api_base_uri=fake_p360.get_base_uri(), api_key="benchmark", http_timeout=5,
+                        pool_maxsize=args.pool_size, max_retries=0, single_flight=False, limiter=limiter,
+                        circuit_breaker=circuit_breaker)
+
+    phases = [("normal", args.normal_latency, 0.0),
+              ("slowdown", args.slow_latency, 0.0),
+              ("outage", args.normal_latency, 1.0),
+              ("recovery", args.normal_latency, 0.0)]
+
+    load = Load(client, args.threads)
+    load.start()
+    print("%-9s %6s %8s %8s %11s %6s %9s %8s" % ("phase", "time", "ok/s", "failed/s", "fast fail/s", "limit",
+                                                 "in flight", "circuit"))
+    start = time.monotonic()
+    for name, latency, error_rate in phases:
+        fake_p360.state.latency = latency
+        fake_p360.state.error_rate = error_rate
+        phase_end = time.monotonic() + args.phase_seconds
+        while time.monotonic() < phase_end:
+            time.sleep(0.5)
+            counts = load.take_counts()
+            print("%-9s %6.1f %8.0f %8.0f %11.0f %6d %9d %8s" % (
+                name, time.monotonic() - start, counts["ok"] * 2, counts["failed"] * 2, counts["failed fast"] * 2,
+                int(limiter.limit), limiter.in_flight, ("closed", "half open", "open")[circuit_breaker.state]))
+
+    load.stop()
+    fake_p360.stop()
+
+
+if __name__ == "__main__":
+    main()
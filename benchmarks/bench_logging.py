@@ -0,0 +1,77 @@
+# Compares what the P360 client's log lines cost when they're built eagerly with string concatenation, and when
+# they're deferred with LogValue/LogFields. Logs a large GetCases response at DEBUG with the log level at INFO (the
+# line is dropped), and a request line at INFO (the line is written, redacted and capped).
+#
+#   python benchmarks/bench_logging.py --cases 200 --iterations 2000
+
+# Stdlibs
+import io
+import os
+import sys
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from structured_log import LogValue, LogFields
+
+
+def create_cases_response(case_count):
+    return {"Successful": True, "Cases": [{
+        "Recno": 200000 + i,
+        "CaseNumber": "21/" + str(200000 + i),
+        "Title": "Personalmappe offentlig - Ola Nordmann " + str(i) + " - Enhet",
+        "AccessGroup": "Enhet Personalmapper",
+        "ArchiveCodes": [{"ArchiveCode": "221", "ArchiveType": "Felles klasse"},
+                         {"ArchiveCode": "0101901234" + str(i % 10), "ArchiveType": "Fødselsnummer"}],
+        "ResponsiblePerson": {"Recno": 100 + i, "Email": "hr" + str(i) + "@example.com"},
+    } for i in range(case_count)]}
+
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    output = io.StringIO()
+    log = logging.getLogger("bench")
+    log.propagate = False
+    log.addHandler(logging.StreamHandler(output))
+    log.setLevel(logging.INFO)
+
+    response_object = create_cases_response(args.cases)
+    url = "https://p360.example.com/CaseService/GetCases?authkey=0123456789abcdef"
+    post_data = {"parameter": {"ArchiveCode": "01019012345", "IncludeCustomFields": False}}
+
+    results = [
+        ("DEBUG response, eager", measure(lambda: log.debug("API response: " + str(response_object)),
+                                          args.iterations)),
+        ("DEBUG response, lazy", measure(lambda: log.debug("API response: %s", LogValue(response_object)),
+                                         args.iterations)),
+        ("INFO request, eager", measure(lambda: log.info("Running HTTP POST to " + url +
+                                                         ", with this body content: " + str(post_data)),
+                                        args.iterations)),
+        ("INFO request, lazy", measure(lambda: log.info("Running HTTP POST %s", LogFields(url=url, body=post_data)),
+                                       args.iterations)),
+    ]
+    for name, seconds in results:
+        print("%-22s %10.2f us per log call" % (name, 1000000 * seconds))
+
+    output.seek(0)
+    output.truncate()
+    log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+    print("Logged: " + output.getvalue().strip())
+
+
+if __name__ == "__main__":
+    main()
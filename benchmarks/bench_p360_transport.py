@@ -0,0 +1,77 @@
+# Compares the pooled keep-alive P360 transport against one fresh connection per request (the old requests.post
+# behaviour), using the local fake P360 server.
+#
+#   python benchmarks/bench_p360_transport.py --requests 2000 --threads 8
+#   python benchmarks/bench_p360_transport.py --certfile cert.pem --keyfile key.pem   # include TLS handshakes
+
+# Stdlibs
+import os
+import sys
+import ssl
+import time
+import logging
+import argparse
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from p360_client import P360Client
+from p360_transport import P360Transport
+from fake_p360 import FakeP360Server
+
+
+class OneShotTransport(P360Transport):
+
+    # Opens a new connection for every request, like the module-level requests.post did
+    def post(self, url, post_data, idempotent=False):
+        return requests.post(url, json=post_data, timeout=self.http_timeout, verify=self.session.verify)
+
+
+def run(client, request_count, thread_count):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        list(executor.map(lambda i: client.get_contact_person_by_email("hr@example.com"), range(request_count)))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.WARNING)
+
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+
+    server = FakeP360Server(ssl_context=ssl_context).start()
+    server.state.add_contact("hr@example.com")
+
+    transports = [("one connection per request", OneShotTransport(log=log)),
+                  ("pooled keep-alive", P360Transport(log=log, pool_maxsize=args.pool_size))]
+
+    try:
+        for name, transport in transports:
+            transport.session.verify = False
+            client = P360Client(log=log, api_base_uri=server.get_base_uri(), api_key="bench", transport=transport)
+            server.state.reset_counters()
+            elapsed = run(client, args.requests, args.threads)
+            print("%-28s %8.1f req/s  %7.2f ms/req  %6d TCP connections" % (
+                name, args.requests / elapsed, 1000 * elapsed * args.threads / args.requests,
+                server.state.connection_count))
+            transport.close()
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
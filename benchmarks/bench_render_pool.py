@@ -0,0 +1,72 @@
+# Measures docx rendering throughput for different render pool sizes. Renders the three onboarding documents for a
+# number of messages, the way handle_new_onboarding submits them.
+#
+#   python benchmarks/bench_render_pool.py --messages 50 --pool-sizes 0,1,2,4
+
+# Stdlibs
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from document_renderer import DocumentRenderer
+from template_registry import TemplateRegistry
+
+SAMPLE_MESSAGE = {
+    "Navn": "Ola Nordmann",
+    "FødselsOgPersonnummer": "01019012345",
+    "DinEpostadresse": "hr@example.com",
+    "Enhet": "IT",
+    "ArbeidsavtaleLanguage": "Norsk",
+    "p360_case_number": "21/00001",
+    "date": "01.08.2021",
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--pool-sizes", default="0,1,2,3,4")
+    parser.add_argument("--resources-dir", default="/resources")
+    parser.add_argument("--message-file", help="JSON file with an onboarding message to render")
+    parser.add_argument("--compiled-templates", action="store_true", help="Render from compiled templates")
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.WARNING)
+
+    mq_message = SAMPLE_MESSAGE
+    if args.message_file:
+        with open(args.message_file, encoding="utf-8") as message_file:
+            mq_message = json.load(message_file)
+
+    templates = [os.path.join(args.resources_dir, name)
+                 for name in ("Arbeidsavtale_norsk.docx", "Hovedtariffavtale.docx", "Velkomstbrev.docx")]
+
+    template_registry = None
+    if args.compiled_templates:
+        template_registry = TemplateRegistry(log=log)
+        template_registry.preload(templates)
+
+    for pool_size in [int(size) for size in args.pool_sizes.split(",")]:
+        renderer = DocumentRenderer(log=log, pool_size=pool_size, template_registry=template_registry)
+        start = time.perf_counter()
+        renders = []
+        for i in range(args.messages):
+            for template in templates:
+                renders.append(renderer.submit(mq_message, template))
+        for render in renders:
+            render.result()
+        elapsed = time.perf_counter() - start
+        renderer.close()
+        print("pool size %d: %7.1f documents/s, %7.2f ms per onboarding" % (
+            pool_size, len(renders) / elapsed, 1000 * elapsed / args.messages))
+
+
+if __name__ == "__main__":
+    main()
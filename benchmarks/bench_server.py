@@ -0,0 +1,136 @@
+# End to end benchmark of the onboarding and lønnsmelding flows, against the local fake P360 server and a stub MQ
+# client. Reports throughput, per-message latency percentiles and P360 calls per message, so that regressions show
+# up before deploy.
+#
+#   python benchmarks/bench_server.py --messages 200 --concurrency 4
+#   python benchmarks/bench_server.py --latency 0.05 --jitter 0.05 --error-rate 0.01
+#
+# The documents are rendered from the templates in /resources, like in production. The server's environment
+# variables (P360_CACHE_ENABLED, DOCX_RENDER_POOL_SIZE, ...) apply as usual.
+
+# Stdlibs
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from server import Server
+from message_routing import ONBOARDING_EVENT, LONNSMELDING_EVENT
+from fake_p360 import FakeP360Server
+from stubs import StubMqClient, StubConfig
+
+RESPONSIBLE_EMAIL = "hr@example.com"
+
+
+def create_message(event_type, number):
+    # Every message is for a new employee, so onboarding creates a new case each time. The lønnsmelding for the
+    # same number finds the case created by the onboarding.
+    return {
+        "event": event_type,
+        "Navn": "Benchmark Person " + str(number),
+        "FødselsOgPersonnummer": "%011d" % (10000000000 + number),
+        "DinEpostadresse": RESPONSIBLE_EMAIL,
+        "Enhet": "IT",
+        "ArbeidsavtaleLanguage": "Engelsk" if number % 4 == 0 else "Norsk",
+    }
+
+
+def get_percentile(sorted_values, percentile):
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    index = max(0, int(round(percentile / 100.0 * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run_flow(server, fake_p360, mq_client, mq_messages, concurrency):
+    fake_p360.state.reset_counters()
+    mq_client.reset()
+
+    def handle(mq_message):
+        start = time.perf_counter()
+        successful = server.handle_mq_message(mq_message)
+        return time.perf_counter() - start, successful
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(handle, mq_messages))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, successful in results)
+    return {
+        "messages": len(mq_messages),
+        "failures": sum(1 for latency, successful in results if not successful),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "call_counts": dict(fake_p360.state.call_counts),
+        "injected_errors": fake_p360.state.error_count,
+    }
+
+
+def print_report(name, result):
+    message_count = result["messages"]
+    latencies = result["latencies"]
+    total_calls = sum(result["call_counts"].values())
+    print(name)
+    print("  %d messages in %.2f s: %.1f messages/s, %d failed (%d injected P360 errors)" % (
+        message_count, result["elapsed"], message_count / result["elapsed"], result["failures"],
+        result["injected_errors"]))
+    print("  latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        1000 * get_percentile(latencies, 50), 1000 * get_percentile(latencies, 95),
+        1000 * get_percentile(latencies, 99), 1000 * latencies[-1]))
+    print("  %.2f P360 calls per message" % (total_calls / message_count))
+    for endpoint, count in sorted(result["call_counts"].items()):
+        print("    %-34s %.2f" % (endpoint, count / message_count))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages processed at the same time")
+    parser.add_argument("--flows", default=ONBOARDING_EVENT + "," + LONNSMELDING_EVENT)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every P360 response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra seconds, 0 to jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of P360 calls that fail")
+    parser.add_argument("--error-status", type=int, default=503,
+                        help="HTTP status of failed calls. 200 answers \"Successful\": false.")
+    parser.add_argument("--warmup", type=int, default=5, help="Messages processed before measuring")
+    parser.add_argument("--log-level", default="CRITICAL", help="The server's log level. Errors are expected with --error-rate.")
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(args.log_level)
+
+    fake_p360 = FakeP360Server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                               error_status=args.error_status).start()
+    fake_p360.state.add_contact(RESPONSIBLE_EMAIL)
+
+    mq_client = StubMqClient()
+    server = Server(mq_client=mq_client, log=log, config=StubConfig(fake_p360.get_base_uri()))
+
+    flows = args.flows.split(",")
+    numbers = range(args.warmup, args.warmup + args.messages)
+
+    # The lønnsmelding flow needs existing cases, so the warmup always onboards
+    run_flow(server, fake_p360, mq_client, [create_message(ONBOARDING_EVENT, number) for number in range(args.warmup)],
+             args.concurrency)
+
+    if LONNSMELDING_EVENT in flows and ONBOARDING_EVENT not in flows:
+        run_flow(server, fake_p360, mq_client, [create_message(ONBOARDING_EVENT, number) for number in numbers],
+                 args.concurrency)
+
+    for flow in flows:
+        result = run_flow(server, fake_p360, mq_client, [create_message(flow, number) for number in numbers],
+                          args.concurrency)
+        print_report(flow, result)
+
+    fake_p360.stop()
+
+
+if __name__ == "__main__":
+    main()
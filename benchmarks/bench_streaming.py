@@ -0,0 +1,79 @@
+# Compares the peak memory of the pnr case lookup with buffered and with streaming response parsing, for an employee
+# with many cases. The lookup reads every case either way, so the times are about the same. The fake P360 server runs
+# in its own process, so the peak memory measured here is the client's alone.
+#
+#   python benchmarks/bench_streaming.py --cases 5000 --case-size 2000
+
+# Stdlibs
+import os
+import sys
+import time
+import logging
+import argparse
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from p360_client import P360Client
+from fake_p360 import FakeP360Server
+
+PNR = "01019012345"
+
+
+def run_fake_p360(case_count, case_size, base_uri_queue, stop_event):
+    fake_p360 = FakeP360Server().start()
+    fake_p360.state.add_contact("hr@example.com")
+    for i in range(case_count):
+        fake_p360.state.add_case("Personalmappe " + str(i), "Enhet " + str(i) + " Personalmapper", PNR,
+                                 "hr@example.com")
+        fake_p360.state.cases[-1]["Notes"] = "x" * case_size
+    base_uri_queue.put(fake_p360.get_base_uri())
+    stop_event.wait()
+    fake_p360.stop()
+
+
+def measure(client, access_group, iterations):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(iterations):
+        client.fetch_case_by_pnr_and_access_group(PNR, access_group)
+    seconds = (time.perf_counter() - start) / iterations
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=5000)
+    parser.add_argument("--case-size", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.WARNING)
+
+    base_uri_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    fake_p360_process = multiprocessing.Process(target=run_fake_p360,
+                                                args=(args.cases, args.case_size, base_uri_queue, stop_event))
+    fake_p360_process.start()
+    base_uri = base_uri_queue.get()
+
+    print("%d cases of about %d bytes each" % (args.cases, args.case_size))
+    for streaming in (False, True):
+        client = P360Client(log=log, api_base_uri=base_uri, api_key="benchmark", single_flight=False,
+                            streaming_responses=streaming)
+        seconds, peak = measure(client, "Enhet 0 Personalmapper", args.iterations)
+        print("%-9s %8.1f ms per lookup, peak memory %8.1f MiB" % (
+            "streaming" if streaming else "buffered", 1000 * seconds, peak / 1024.0 / 1024.0))
+        client.close()
+
+    stop_event.set()
+    fake_p360_process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Compares peak client-side memory of an UpdateDocument upload with the document base64-encoded into the JSON
+# request up front, against the streaming upload body. The fake P360 server runs in a separate process, so only
+# the client's allocations are measured.
+#
+#   python benchmarks/bench_upload_memory.py --sizes-mb 1,10,50
+
+# Stdlibs
+import os
+import sys
+import base64
+import logging
+import argparse
+import tracemalloc
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from p360_client import P360Client
+from fake_p360 import FakeP360Server
+
+
+def serve(address_queue, stop_event):
+    server = FakeP360Server().start()
+    document_number = server.state.add_document("21/00001", "Arbeidsavtale")
+    address_queue.put((server.get_base_uri(), document_number))
+    stop_event.wait()
+    server.stop()
+
+
+def measure_upload(client, document_number, document_contents, streaming):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    if streaming:
+        data = document_contents
+    else:
+        data = base64.b64encode(document_contents).decode("ascii")
+    client.upload_file(document_number, {"title": "Arbeidsavtale", "format": "docx", "data": data})
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes-mb", default="1,5,25")
+    args = parser.parse_args()
+
+    log = logging.getLogger("bench")
+    log.setLevel(logging.WARNING)
+
+    address_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    server_process = multiprocessing.Process(target=serve, args=(address_queue, stop_event), daemon=True)
+    server_process.start()
+    base_uri, document_number = address_queue.get()
+
+    client = P360Client(log=log, api_base_uri=base_uri, api_key="bench")
+    try:
+        for size_mb in [int(size) for size in args.sizes_mb.split(",")]:
+            document_contents = os.urandom(size_mb * 1024 * 1024)
+            encoded_peak = measure_upload(client, document_number, document_contents, streaming=False)
+            streaming_peak = measure_upload(client, document_number, document_contents, streaming=True)
+            print("%4d MB document: encoded up front %8.1f MB peak, streaming %6.2f MB peak" % (
+                size_mb, encoded_peak / 1024 / 1024, streaming_peak / 1024 / 1024))
+    finally:
+        client.close()
+        stop_event.set()
+        server_process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# Stdlibs
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# A local stand-in for the parts of the Public 360 SIF API that P360Client uses. Response shapes follow
+# DocumentService.json (and the equivalent Contact/Case services).
+#
+# latency (plus a random 0..jitter) seconds is added to every response. A share error_rate of the calls fail: with
+# error_status as the HTTP status code, or with status 200 and "Successful": false if error_status is 200.
+class FakeP360State:
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.lock = threading.Lock()
+        self.next_recno = 200000
+        self.contacts = {}
+        self.cases = []
+        self.documents = []
+        self.call_counts = {}
+        self.error_count = 0
+        self.connection_count = 0
+
+    def new_recno(self):
+        self.next_recno += 1
+        return self.next_recno
+
+    def add_contact(self, email):
+        with self.lock:
+            recno = self.new_recno()
+            self.contacts[email] = {"Recno": recno, "Email": email}
+            return recno
+
+    def add_case(self, title, access_group, pnr, responsible_email):
+        with self.lock:
+            recno = self.new_recno()
+            case_number = "21/" + str(recno)
+            contact = self.contacts.get(responsible_email, {})
+            self.cases.append({
+                "Recno": recno,
+                "CaseNumber": case_number,
+                "Title": title,
+                "AccessGroup": access_group,
+                "ArchiveCodes": ["221", pnr],
+                "ResponsiblePerson": {"Recno": contact.get("Recno"), "Email": responsible_email}
+            })
+            return case_number
+
+    def add_document(self, case_number, title):
+        with self.lock:
+            recno = self.new_recno()
+            document_number = case_number + "-" + str(len(self.documents) + 1)
+            self.documents.append({"Recno": recno, "DocumentNumber": document_number, "CaseNumber": case_number,
+                                   "Title": title})
+            return document_number
+
+    def count_call(self, endpoint):
+        with self.lock:
+            self.call_counts[endpoint] = self.call_counts.get(endpoint, 0) + 1
+
+    def reset_counters(self):
+        with self.lock:
+            self.call_counts = {}
+            self.error_count = 0
+            self.connection_count = 0
+
+    def get_total_calls(self):
+        with self.lock:
+            return sum(self.call_counts.values())
+
+    def get_response_delay(self):
+        if self.jitter > 0:
+            return self.latency + random.uniform(0, self.jitter)
+        return self.latency
+
+    def should_fail(self):
+        if self.error_rate <= 0 or random.random() >= self.error_rate:
+            return False
+        with self.lock:
+            self.error_count += 1
+        return True
+
+    def get_contact_persons(self, parameter):
+        contact = self.contacts.get(parameter.get("Email"))
+        return {"ContactPersons": [contact] if contact else []}
+
+    def get_cases(self, parameter):
+        with self.lock:
+            if "Title" in parameter:
+                cases = [case for case in self.cases if case["Title"] == parameter["Title"]]
+            else:
+                cases = [case for case in self.cases if parameter.get("ArchiveCode") in case["ArchiveCodes"]]
+        return {"Cases": cases}
+
+    def create_case(self, parameter):
+        with self.lock:
+            recno = self.new_recno()
+            case_number = "21/" + str(recno)
+            responsible_email = None
+            for email, contact in self.contacts.items():
+                if contact["Recno"] == parameter.get("ResponsiblePersonRecno"):
+                    responsible_email = email
+            self.cases.append({
+                "Recno": recno,
+                "CaseNumber": case_number,
+                "Title": parameter.get("Title"),
+                "AccessGroup": parameter.get("AccessGroup"),
+                "ArchiveCodes": [code.get("ArchiveCode") for code in parameter.get("ArchiveCodes", [])],
+                "ResponsiblePerson": {"Recno": parameter.get("ResponsiblePersonRecno"), "Email": responsible_email}
+            })
+        return {"Recno": recno, "CaseNumber": case_number}
+
+    def get_documents(self, parameter):
+        with self.lock:
+            documents = [document for document in self.documents
+                         if document["CaseNumber"] == parameter.get("CaseNumber") and
+                         ("Title" not in parameter or document["Title"] == parameter["Title"])]
+        if parameter.get("MaxReturnedDocuments"):
+            page_size = parameter["MaxReturnedDocuments"]
+            page = parameter.get("Page", 0)
+            documents = documents[page * page_size:(page + 1) * page_size]
+        return {"Documents": documents}
+
+    def create_document(self, parameter):
+        with self.lock:
+            recno = self.new_recno()
+            document_number = parameter.get("CaseNumber") + "-" + str(len(self.documents) + 1)
+            self.documents.append({"Recno": recno, "DocumentNumber": document_number,
+                                   "CaseNumber": parameter.get("CaseNumber"), "Title": parameter.get("Title")})
+        return {"Recno": recno, "DocumentNumber": document_number}
+
+    def update_document(self, parameter):
+        with self.lock:
+            for document in self.documents:
+                if document["DocumentNumber"] == parameter.get("DocumentNumber"):
+                    return {"Recno": document["Recno"], "DocumentNumber": document["DocumentNumber"]}
+        return None
+
+    def ping(self, parameter):
+        return {}
+
+
+ENDPOINTS = {
+    "ContactService/GetContactPersons": FakeP360State.get_contact_persons,
+    "CaseService/GetCases": FakeP360State.get_cases,
+    "CaseService/CreateCase": FakeP360State.create_case,
+    "DocumentService/GetDocuments": FakeP360State.get_documents,
+    "DocumentService/CreateDocument": FakeP360State.create_document,
+    "DocumentService/UpdateDocument": FakeP360State.update_document,
+    "DocumentService/Ping": FakeP360State.ping,
+}
+
+
+class FakeP360RequestHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1, so that clients can keep the connection alive between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.state.lock:
+            self.server.state.connection_count += 1
+
+    def do_POST(self):
+        endpoint = "/".join(self.path.split("?")[0].strip("/").split("/")[-2:])
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        handler = ENDPOINTS.get(endpoint)
+        if handler is None:
+            self.send_json(404, {"Successful": False, "ErrorMessage": "Unknown endpoint " + endpoint})
+            return
+
+        state = self.server.state
+        state.count_call(endpoint)
+        delay = state.get_response_delay()
+        if delay > 0:
+            time.sleep(delay)
+        if state.should_fail():
+            self.send_json(state.error_status, {"Successful": False, "ErrorMessage": "Injected error"})
+            return
+
+        parameter = json.loads(body).get("parameter", {})
+        result = handler(state, parameter)
+        if result is None:
+            self.send_json(200, {"Successful": False, "ErrorMessage": "Not found"})
+        else:
+            result["Successful"] = True
+            self.send_json(200, result)
+
+    def send_json(self, status_code, response_object):
+        response_body = json.dumps(response_object).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response_body)))
+        self.end_headers()
+        try:
+            self.wfile.write(response_body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting (e.g. its deadline passed)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeP360Server:
+
+    def __init__(self, host="127.0.0.1", port=0, ssl_context=None, latency=0.0, jitter=0.0, error_rate=0.0,
+                 error_status=503):
+        self.state = FakeP360State(latency=latency, jitter=jitter, error_rate=error_rate, error_status=error_status)
+        self.httpd = ThreadingHTTPServer((host, port), FakeP360RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        if ssl_context:
+            self.httpd.socket = ssl_context.wrap_socket(self.httpd.socket, server_side=True)
+        self.scheme = "https" if ssl_context else "http"
+        self.thread = None
+
+    def get_base_uri(self):
+        host, port = self.httpd.server_address[:2]
+        return self.scheme + "://" + host + ":" + str(port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,174 @@
+# Replays captured MQ messages against a Server that talks to the local fake P360 server, with a stub in place of
+# the broker. Use it to size the consumer fleet from real payloads: how many messages/s one server keeps up with,
+# and what happens to the latency when the arrival rate goes past that.
+#
+#   python benchmarks/replay.py captured.jsonl --mode max --concurrency 4
+#   python benchmarks/replay.py captured.jsonl --mode fixed --rate 5 --messages 600
+#   python benchmarks/replay.py captured.jsonl --mode ramp --rate 1 --rate-end 20 --messages 1000 --latency 0.05
+#
+# Each line of the input is one captured message: either the message body itself, or {"routing_key": ...,
+# "body": {...}} as written by a queue dump. The message type comes from the routing key or the "event" field, as
+# in the consumer. The lines are replayed in order, starting over from the top until --messages have been sent.
+#
+# Latency is measured from when a message was due to arrive, so time spent waiting for a free worker is included.
+
+# Stdlibs
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Custom code
+from server import Server
+from message_routing import get_event_type, LONNSMELDING_EVENT
+from fake_p360 import FakeP360Server
+from stubs import StubMqClient, StubConfig
+from bench_server import get_percentile
+
+
+def read_captured_messages(path):
+    captured_messages = []
+    with open(path, encoding="utf-8") as captured_file:
+        for line in captured_file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record.get("body"), dict):
+                captured_messages.append((record["body"], record.get("routing_key")))
+            else:
+                captured_messages.append((record, None))
+    return captured_messages
+
+
+def seed_fake_p360(state, captured_messages):
+    # Every responsible person exists in P360, and every lønnsmelding has a case to go into
+    for mq_message, routing_key in captured_messages:
+        email = mq_message.get("DinEpostadresse")
+        if email and email not in state.contacts:
+            state.add_contact(email)
+
+    for mq_message, routing_key in captured_messages:
+        if get_event_type(mq_message, routing_key) == LONNSMELDING_EVENT:
+            access_group = mq_message["Enhet"] + " Personalmapper"
+            pnr = mq_message["FødselsOgPersonnummer"]
+            if not state.get_cases({"ArchiveCode": pnr})["Cases"]:
+                email = mq_message.get("DinEpostadresse", "hr@example.com")
+                if email not in state.contacts:
+                    state.add_contact(email)
+                state.add_case("Personalmappe offentlig - " + mq_message["Navn"] + " - " + mq_message["Enhet"],
+                               access_group, pnr, email)
+
+
+def get_send_offset(mode, index, rate, rate_end, message_count):
+    # Seconds from the start until message number index is due
+    if mode == "max":
+        return 0.0
+    if mode == "fixed" or rate_end == rate:
+        return index / rate
+
+    # The rate rises linearly from rate to rate_end over the run. With duration D = 2 * message_count / (rate +
+    # rate_end), the number of messages sent by time t is rate * t + (rate_end - rate) * t^2 / (2 * D). Solve for t.
+    duration = 2.0 * message_count / (rate + rate_end)
+    acceleration = (rate_end - rate) / duration
+    return (-rate + math.sqrt(rate * rate + 2 * acceleration * index)) / acceleration
+
+
+class Replay:
+
+    def __init__(self, server, captured_messages, mode, rate, rate_end, message_count, concurrency):
+        self.server = server
+        self.captured_messages = captured_messages
+        self.mode = mode
+        self.rate = rate
+        self.rate_end = rate_end
+        self.message_count = message_count
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.results = []
+
+    def run(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for index in range(self.message_count):
+                due = start + get_send_offset(self.mode, index, self.rate, self.rate_end, self.message_count)
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                mq_message, routing_key = self.captured_messages[index % len(self.captured_messages)]
+                executor.submit(self.handle, mq_message, routing_key, due)
+        return time.perf_counter() - start
+
+    def handle(self, mq_message, routing_key, due):
+        event_type = get_event_type(mq_message, routing_key) or "unknown"
+        try:
+            successful = self.server.handle_mq_message(mq_message, routing_key)
+        except Exception:
+            successful = False
+        with self.lock:
+            self.results.append((event_type, time.perf_counter() - due, successful))
+
+
+def print_report(results, elapsed):
+    event_types = sorted(set(event_type for event_type, latency, successful in results))
+    print("%d messages in %.2f s: %.1f messages/s" % (len(results), elapsed, len(results) / elapsed))
+    for event_type in [None] + event_types:
+        selected = [(latency, successful) for this_event_type, latency, successful in results
+                    if event_type is None or this_event_type == event_type]
+        latencies = sorted(latency for latency, successful in selected)
+        failures = sum(1 for latency, successful in selected if not successful)
+        print("  %-13s %6d messages, error rate %5.1f %%, latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (
+            event_type if event_type else "all", len(selected), 100.0 * failures / len(selected),
+            1000 * get_percentile(latencies, 50), 1000 * get_percentile(latencies, 95),
+            1000 * get_percentile(latencies, 99)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("captured_messages", help="JSONL file with one captured message per line")
+    parser.add_argument("--mode", choices=("fixed", "ramp", "max"), default="max")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages/s (the start rate when ramping)")
+    parser.add_argument("--rate-end", type=float, help="Messages/s at the end of a ramp")
+    parser.add_argument("--messages", type=int, help="Messages to send. Defaults to one pass over the file.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages processed at the same time")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every P360 response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra seconds, 0 to jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of P360 calls that fail")
+    parser.add_argument("--log-level", default="CRITICAL")
+    args = parser.parse_args()
+
+    if args.mode == "ramp" and args.rate_end is None:
+        parser.error("--mode ramp needs --rate-end")
+    if args.mode != "max" and args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    log = logging.getLogger("replay")
+    log.setLevel(args.log_level)
+
+    captured_messages = read_captured_messages(args.captured_messages)
+    if not captured_messages:
+        parser.error("No messages in " + args.captured_messages)
+
+    fake_p360 = FakeP360Server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+    seed_fake_p360(fake_p360.state, captured_messages)
+
+    server = Server(mq_client=StubMqClient(), log=log, config=StubConfig(fake_p360.get_base_uri()))
+
+    replay = Replay(server, captured_messages, args.mode, args.rate,
+                    args.rate_end if args.rate_end is not None else args.rate,
+                    args.messages if args.messages else len(captured_messages), args.concurrency)
+    elapsed = replay.run()
+    print_report(replay.results, elapsed)
+
+    fake_p360.stop()
+
+
+if __name__ == "__main__":
+    main()
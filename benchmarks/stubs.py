@@ -0,0 +1,45 @@
+# Stand-ins for the MQ client and the server config, so that a Server can run against the fake P360 server without
+# RabbitMQ or the production config.
+
+# Stdlibs
+import threading
+
+
+class StubMqClient:
+
+    # Records the notifications instead of publishing them
+    def __init__(self, keep_messages=False):
+        self.keep_messages = keep_messages
+        self.lock = threading.Lock()
+        self.sent = []
+        self.event_counts = {}
+
+    def emit_notification_message(self, mq_message):
+        with self.lock:
+            event = mq_message.get("event")
+            self.event_counts[event] = self.event_counts.get(event, 0) + 1
+            if self.keep_messages:
+                self.sent.append(mq_message)
+
+    def reset(self):
+        with self.lock:
+            self.sent = []
+            self.event_counts = {}
+
+
+class StubConfig:
+
+    # Only the settings the server reads when it's given an MQ client
+    def __init__(self, p360_api_base_uri, p360_api_key="benchmark", p360_web_base_uri="http://p360.invalid/locator"):
+        self.p360_api_base_uri = p360_api_base_uri
+        self.p360_api_key = p360_api_key
+        self.p360_web_base_uri = p360_web_base_uri
+
+    def get_p360_api_base_uri(self):
+        return self.p360_api_base_uri
+
+    def get_p360_api_key(self):
+        return self.p360_api_key
+
+    def get_p360_web_base_uri(self):
+        return self.p360_web_base_uri
@@ -0,0 +1,155 @@
+# Stdlibs
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom code
+from errors import RetryableError
+from server import Server, get_onboarding_case_title
+
+REQUIRED_FIELDS = ("Navn", "FødselsOgPersonnummer", "DinEpostadresse", "Enhet", "ArbeidsavtaleLanguage")
+
+
+def read_onboarding_batch(path):
+    # A batch is a JSONL file with one onboarding message per line, or a CSV file with the message fields as
+    # columns. Returns (line number, message) pairs; a line that can't be parsed gives (line number, None).
+    items = []
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8-sig") as batch_file:
+            for row in csv.DictReader(batch_file):
+                items.append((len(items) + 2, dict(row)))
+        return items
+
+    with open(path, encoding="utf-8") as batch_file:
+        for line_number, line in enumerate(batch_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append((line_number, json.loads(line)))
+            except ValueError:
+                items.append((line_number, None))
+    return items
+
+
+class BulkImporter:
+
+    # Onboards a whole batch of new hires at once, e.g. at the start of a semester.
+    #
+    # The batch is planned before anything is written to P360:
+    # - Every responsible officer is looked up once, however many hires they have in the batch.
+    # - Hires with the same case title are processed one after the other, so the case is looked up (or created)
+    #   once, and the rest of them get it from the one before.
+    # - Otherwise the hires are processed side by side, at most concurrency at a time, each one the normal way
+    #   (Server.handle_new_onboarding), so their documents render in parallel in the render pool and each one
+    #   gets the normal success or error notification.
+    def __init__(self, server, log=None, concurrency=4):
+        self.server = server
+        self.log = log if log else logging.getLogger(__name__)
+        self.concurrency = concurrency
+
+    def run(self, items):
+        # Returns one result per item, in the order of the batch
+        results = {}
+        groups = {}
+        for line_number, mq_message in items:
+            missing_fields = [field for field in REQUIRED_FIELDS
+                              if not isinstance(mq_message, dict) or not mq_message.get(field)]
+            if missing_fields:
+                results[line_number] = {"line": line_number, "result": "invalid",
+                                        "error": "Missing " + ", ".join(missing_fields)}
+                continue
+            groups.setdefault(get_onboarding_case_title(mq_message), []).append((line_number, mq_message))
+
+        self.log.info("Importing " + str(len(items)) + " onboarding messages for " + str(len(groups)) + " cases")
+        # The addresses are looked up as given, like a single onboarding does, so both resolve the same contact
+        responsible_recnos = self.get_responsible_recnos(
+            {mq_message["DinEpostadresse"] for group in groups.values() for line_number, mq_message in group})
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="bulk-import") as executor:
+            futures = [executor.submit(self.import_group, case_title, group, responsible_recnos)
+                       for case_title, group in groups.items()]
+            for future in futures:
+                for result in future.result():
+                    results[result["line"]] = result
+
+        return [results[line_number] for line_number, mq_message in items]
+
+    def get_responsible_recnos(self, emails):
+        # The P360 recno of every responsible officer in the batch, looked up side by side. An officer who can't be
+        # found is left out, and their hires fail the normal way, with an error notification.
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="bulk-lookup") as executor:
+            futures = {email: executor.submit(self.server.get_p360_contact_person_by_email, email) for email in emails}
+
+        responsible_recnos = {}
+        for email, future in futures.items():
+            try:
+                contact = future.result()
+            except Exception as e:
+                self.log.warning("Could not look up the P360 user " + email + ": " + str(e))
+                continue
+            if contact is not None:
+                responsible_recnos[email] = contact.get_recno()
+        self.log.info("Looked up " + str(len(emails)) + " responsible officers for the batch")
+        return responsible_recnos
+
+    def import_group(self, case_title, group, responsible_recnos):
+        results = []
+        saved_case = None
+        for line_number, mq_message in group:
+            checkpoints = self.server.get_message_checkpoints(mq_message)
+            if not checkpoints.is_completed():
+                responsible_recno = responsible_recnos.get(mq_message["DinEpostadresse"])
+                if responsible_recno is not None and not checkpoints.is_done("responsible_recno"):
+                    checkpoints.record("responsible_recno", responsible_recno)
+                if saved_case is not None and not checkpoints.is_done("case"):
+                    checkpoints.record("case", saved_case)
+
+            result = {"line": line_number, "case_title": case_title}
+            try:
+                successful = self.server.handle_new_onboarding(mq_message, checkpoints=checkpoints)
+                result["result"] = "success" if successful else "failed"
+            except RetryableError as e:
+                result["result"] = "retry"
+                result["error"] = str(e)
+            except Exception as e:
+                result["result"] = "failed"
+                result["error"] = str(e)
+            results.append(result)
+
+            if checkpoints.get("case") is not None:
+                saved_case = checkpoints.get("case")
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Onboards a JSONL or CSV batch of new hires")
+    parser.add_argument("batch_path")
+    parser.add_argument("--report", help="Where to write the JSONL report. Default: standard output.")
+    parser.add_argument("--concurrency", type=int, default=int(os.environ.get("BULK_IMPORT_CONCURRENCY", "4")))
+    args = parser.parse_args()
+
+    server = Server()
+    # A hire that P360 turns away for now is reported as "retry", without an error notification
+    server.requeue_retryable_errors = True
+    server.warm_up()
+    server.start_notification_publisher()
+    try:
+        results = BulkImporter(server, log=server.log, concurrency=args.concurrency).run(
+            read_onboarding_batch(args.batch_path))
+    finally:
+        server.close()
+
+    report_file = open(args.report, "w", encoding="utf-8") if args.report else sys.stdout
+    for result in results:
+        report_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+    if args.report:
+        report_file.close()
+
+    failed_count = len([result for result in results if result["result"] != "success"])
+    server.log.info("Imported " + str(len(results) - failed_count) + " of " + str(len(results)) +
+                    " onboarding messages")
+    sys.exit(1 if failed_count else 0)
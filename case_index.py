@@ -0,0 +1,71 @@
+# Stdlibs
+import hmac
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Custom code
+from models.p360_case import P360Case
+
+
+class CaseIndex:
+
+    # A persistent local index from (pnr, access group) to the person's case in that unit, so that a lønnsmelding
+    # doesn't have to search P360 for it. The pnr is never stored: the key is an HMAC of it, with salt as the key.
+    #
+    # Entries older than max_age seconds are treated as missing, so that the case is looked up (and the responsible
+    # person refreshed) in P360 again.
+    def __init__(self, path, log=None, salt="", max_age=30 * 24 * 3600):
+        self.log = log if log else logging.getLogger(__name__)
+        self.path = path
+        self.salt = salt.encode("utf-8")
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cases ("
+                                "pnr_hash TEXT NOT NULL, "
+                                "access_group TEXT NOT NULL, "
+                                "case_recno INTEGER NOT NULL, "
+                                "case_number TEXT NOT NULL, "
+                                "responsible_person_email TEXT, "
+                                "responsible_person_recno INTEGER, "
+                                "updated_at REAL NOT NULL, "
+                                "PRIMARY KEY (pnr_hash, access_group))")
+
+        self.log.info("Opened the case index " + path)
+
+    def get_pnr_hash(self, pnr):
+        return hmac.new(self.salt, pnr.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def get(self, pnr, access_group):
+        with self.lock:
+            row = self.connection.execute("SELECT case_recno, case_number, responsible_person_email, "
+                                          "responsible_person_recno, updated_at FROM cases "
+                                          "WHERE pnr_hash = ? AND access_group = ?",
+                                          (self.get_pnr_hash(pnr), access_group)).fetchone()
+        if row is None or row[4] < time.time() - self.max_age:
+            return None
+        return P360Case(case_recno=row[0], case_number=row[1], responsible_person_email=row[2],
+                        responsible_person_recno=row[3], access_group=access_group)
+
+    def put(self, pnr, access_group, case_recno, case_number, responsible_person_email, responsible_person_recno):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO cases (pnr_hash, access_group, case_recno, case_number, "
+                                    "responsible_person_email, responsible_person_recno, updated_at) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (self.get_pnr_hash(pnr), access_group, case_recno, case_number,
+                                     responsible_person_email, responsible_person_recno, time.time()))
+
+    def invalidate(self, pnr, access_group):
+        with self.lock:
+            self.connection.execute("DELETE FROM cases WHERE pnr_hash = ? AND access_group = ?",
+                                    (self.get_pnr_hash(pnr), access_group))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,132 @@
+# Stdlibs
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# Marks a message as fully processed
+COMPLETED_STEP = "completed"
+
+
+def get_message_fingerprint(mq_message, message_id=None):
+    # The same message gives the same fingerprint when it's redelivered, whatever the order of its keys. With the
+    # broker's message id, an identical message that was published again gets a fingerprint of its own.
+    canonical_message = json.dumps(mq_message, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    if message_id is not None:
+        canonical_message = str(message_id) + "\n" + canonical_message
+    return hashlib.sha256(canonical_message.encode("utf-8")).hexdigest()
+
+
+class CheckpointJournal:
+
+    # A durable record of the steps that are done for each message, and what they returned (recnos, case and
+    # document numbers). When a message is redelivered after failing half way, the server picks up from the first
+    # step that isn't done, instead of doing every lookup, render and upload again.
+    #
+    # Results must be JSON serializable. Entries older than retention seconds are removed when the journal opens.
+    #
+    # A completed message is only recognized for completed_retention seconds, long enough for the broker to
+    # redeliver a message that was processed but not acked. Without a message id from the broker, a redelivery and a
+    # deliberate resubmission of the same form look the same, so after that window an identical message is processed
+    # again (e.g. HR sending the lønnsmelding again after deleting the document in P360). 0 never skips a message.
+    def __init__(self, path, log=None, retention=7 * 24 * 3600, completed_retention=3600):
+        self.log = log if log else logging.getLogger(__name__)
+        self.path = path
+        self.completed_retention = completed_retention
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                                "fingerprint TEXT NOT NULL, "
+                                "step TEXT NOT NULL, "
+                                "result TEXT, "
+                                "recorded_at REAL NOT NULL, "
+                                "PRIMARY KEY (fingerprint, step))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS checkpoints_recorded_at ON checkpoints (recorded_at)")
+
+        removed = self.prune(retention)
+        self.log.info("Opened the checkpoint journal " + path + ". Removed " + str(removed) + " old entries.")
+
+    def load(self, fingerprint):
+        with self.lock:
+            rows = self.connection.execute("SELECT step, result, recorded_at FROM checkpoints WHERE fingerprint = ?",
+                                           (fingerprint,)).fetchall()
+        completed_since = time.time() - self.completed_retention
+        return {step: json.loads(result) for step, result, recorded_at in rows
+                if step != COMPLETED_STEP or recorded_at > completed_since}
+
+    def record(self, fingerprint, step, result=None):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO checkpoints (fingerprint, step, result, recorded_at) "
+                                    "VALUES (?, ?, ?, ?)", (fingerprint, step, json.dumps(result), time.time()))
+
+    def forget(self, fingerprint, step):
+        with self.lock:
+            self.connection.execute("DELETE FROM checkpoints WHERE fingerprint = ? AND step = ?", (fingerprint, step))
+
+    def complete(self, fingerprint, result=None):
+        # The step results aren't needed anymore. Only the completed mark is kept, with result (what the
+        # notification needs), so a redelivery of a message that was processed (but not acked) is recognized.
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute("DELETE FROM checkpoints WHERE fingerprint = ?", (fingerprint,))
+                self.connection.execute("INSERT INTO checkpoints (fingerprint, step, result, recorded_at) "
+                                        "VALUES (?, ?, ?, ?)", (fingerprint, COMPLETED_STEP, json.dumps(result),
+                                                                 time.time()))
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def prune(self, retention):
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM checkpoints WHERE recorded_at < ?",
+                                             (time.time() - retention,))
+            return cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MessageCheckpoints:
+
+    # The checkpoints of one message. Without a journal, nothing is remembered and every step runs.
+    def __init__(self, journal, mq_message, message_id=None):
+        self.journal = journal
+        self.fingerprint = get_message_fingerprint(mq_message, message_id) if journal else None
+        self.steps = journal.load(self.fingerprint) if journal else {}
+
+    def is_completed(self):
+        return COMPLETED_STEP in self.steps
+
+    def is_done(self, step):
+        return step in self.steps
+
+    def get(self, step):
+        return self.steps.get(step)
+
+    def record(self, step, result=None):
+        self.steps[step] = result
+        if self.journal:
+            self.journal.record(self.fingerprint, step, result)
+
+    def forget(self, step):
+        self.steps.pop(step, None)
+        if self.journal:
+            self.journal.forget(self.fingerprint, step)
+
+    def get_completed(self):
+        # What was recorded when the message was completed
+        return self.steps.get(COMPLETED_STEP)
+
+    def complete(self, result=None):
+        # The steps stay readable until the checkpoints are thrown away (a bulk import reuses the case)
+        self.steps[COMPLETED_STEP] = result
+        if self.journal:
+            self.journal.complete(self.fingerprint, result)
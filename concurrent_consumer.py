@@ -0,0 +1,109 @@
+# Stdlibs
+import json
+import time
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom code
+from errors import RetryableError
+from message_routing import current_message_id
+
+
+def get_message_id(properties):
+    return getattr(properties, "message_id", None) if properties is not None else None
+
+
+class ConcurrentConsumer:
+
+    # Consumes a queue on a pika BlockingChannel and hands each message to a bounded pool of worker threads.
+    #
+    # pika channels aren't thread safe, so the workers never touch the channel. When a worker is done, the ack (or
+    # nack) is scheduled back onto the connection's thread with add_callback_threadsafe. prefetch_count bounds how
+    # many unacknowledged messages the broker hands us, which also bounds how many can wait for a free worker.
+    #
+    # message_handler(mq_message, routing_key) is called on a worker thread. If it returns, the message is acked.
+    # If it raises RetryableError (e.g. P360 is down), the message is requeued after requeue_delay seconds. The
+    # worker waits out the delay, so a struggling P360 also slows down how fast we take new messages. If it raises
+    # anything else, the message is nacked without requeueing, so a poison message doesn't loop.
+    def __init__(self, log, channel, queue_name, message_handler, prefetch_count=10, worker_count=4,
+                 drain_timeout=60, requeue_delay=5):
+        self.log = log if log else logging.getLogger(__name__)
+        self.channel = channel
+        self.connection = channel.connection
+        self.queue_name = queue_name
+        self.message_handler = message_handler
+        self.prefetch_count = prefetch_count
+        self.worker_count = worker_count
+        self.drain_timeout = drain_timeout
+        self.requeue_delay = requeue_delay
+
+        self.executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="mq-worker")
+        self.consumer_tag = None
+        self.stopping = threading.Event()
+        self.in_flight = 0
+
+    def start(self):
+        self.log.info("Consuming from queue " + self.queue_name + " with prefetch " + str(self.prefetch_count) +
+                      " and " + str(self.worker_count) + " workers")
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.consumer_tag = self.channel.basic_consume(queue=self.queue_name, on_message_callback=self.on_message)
+
+        while not self.stopping.is_set():
+            self.connection.process_data_events(time_limit=1)
+
+        self.drain()
+
+    def stop(self):
+        # Safe to call from a signal handler or any thread. start() returns once the in-flight messages are done.
+        self.stopping.set()
+
+    def on_message(self, channel, method, properties, body):
+        self.in_flight += 1
+        self.executor.submit(self.process_message, method.delivery_tag, method.routing_key, body,
+                             get_message_id(properties))
+
+    def process_message(self, delivery_tag, routing_key, body, message_id=None):
+        token = current_message_id.set(message_id)
+        try:
+            mq_message = json.loads(body)
+            self.message_handler(mq_message, routing_key)
+            settle = functools.partial(self.channel.basic_ack, delivery_tag=delivery_tag)
+        except RetryableError as e:
+            self.log.warning("Could not process the message with delivery tag " + str(delivery_tag) + " now: " +
+                             str(e) + ". It will be requeued.")
+            self.stopping.wait(self.requeue_delay)
+            settle = functools.partial(self.channel.basic_nack, delivery_tag=delivery_tag, requeue=True)
+        except Exception as e:
+            self.log.error("Could not process the message with delivery tag " + str(delivery_tag) +
+                           ". Error message: " + str(e) + ". The message is rejected.")
+            settle = functools.partial(self.channel.basic_nack, delivery_tag=delivery_tag, requeue=False)
+        finally:
+            current_message_id.reset(token)
+
+        self.connection.add_callback_threadsafe(functools.partial(self.settle, settle))
+
+    def settle(self, settle):
+        # Runs on the connection's thread
+        self.in_flight -= 1
+        settle()
+
+    def drain(self):
+        self.log.info("Stopping the consumer. Waiting for " + str(self.in_flight) + " messages in flight.")
+
+        # Cancelling the consumer makes pika nack the messages that were prefetched but not handed to a worker yet,
+        # so the broker redelivers them to another consumer
+        self.channel.basic_cancel(self.consumer_tag)
+
+        deadline = time.monotonic() + self.drain_timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.5)
+
+        if self.in_flight > 0:
+            self.log.warning(str(self.in_flight) + " messages were still in flight after " +
+                             str(self.drain_timeout) + " seconds. They'll be redelivered.")
+
+        self.executor.shutdown(wait=False)
+        self.connection.close()
+        self.log.info("The consumer has stopped")
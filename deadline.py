@@ -0,0 +1,40 @@
+# Stdlibs
+import time
+import contextvars
+
+# Custom code
+from errors import DeadlineExceededError
+
+# The deadline of the message being processed. Set by the server for each message. Like the message timings, it's
+# carried into the P360 worker threads by AsyncP360Client.
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class Deadline:
+
+    # The time budget of one message. Every P360 call, render and upload gets only what's left of it.
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def check(self, what):
+        if self.remaining() <= 0:
+            raise DeadlineExceededError("The message deadline of " + str(self.seconds) + " seconds was exceeded "
+                                        "before " + what)
+
+
+def get_remaining_time(default):
+    # What's left of the current message's deadline, but no more than default. default if there's no deadline.
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    return min(default, deadline.remaining())
+
+
+def check_deadline(what):
+    deadline = current_deadline.get()
+    if deadline is not None:
+        deadline.check(what)
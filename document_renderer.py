@@ -0,0 +1,118 @@
+# Stdlibs
+import os
+import tempfile
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Each render worker process has its own DocxGenerator, created once when the process starts. The template registry
+# is inherited from the parent process, with the templates already compiled. A replacement pool can't inherit it
+# (see DocumentRenderer.submit), so its workers compile the templates themselves. docxgenerator is imported when it's
+# first needed, so that importing this module is fast.
+worker_document_creator = None
+worker_template_registry = None
+
+
+def init_render_worker(log_name, log_level, template_registry, compile_templates=False):
+    global worker_document_creator, worker_template_registry
+    from docxgenerator import DocxGenerator
+    log = logging.getLogger(log_name)
+    log.setLevel(log_level)
+    worker_document_creator = DocxGenerator(log=log)
+    if template_registry is None and compile_templates:
+        from template_registry import TemplateRegistry
+        template_registry = TemplateRegistry(log=log)
+    worker_template_registry = template_registry
+
+
+def render_docx_file(document_creator, template_registry, mq_message, incoming_document_path, debug_sink_path=None):
+    # Returns the contents of the generated docx file
+    document_contents = None
+    if template_registry is not None:
+        document_contents = template_registry.render(incoming_document_path, mq_message)
+    if document_contents is None:
+        document_contents = render_with_docx_generator(document_creator, mq_message, incoming_document_path)
+
+    if debug_sink_path:
+        with open(debug_sink_path, "wb") as debug_file:
+            debug_file.write(document_contents)
+
+    return document_contents
+
+
+def render_with_docx_generator(document_creator, mq_message, incoming_document_path):
+    # DocxGenerator can only write to a file path, so give it a short-lived temporary file
+    file_descriptor, temporary_path = tempfile.mkstemp(suffix=".docx")
+    os.close(file_descriptor)
+    try:
+        document_creator.create_docx_file(mq_message, incoming_document_path, temporary_path)
+        with open(temporary_path, "rb") as generated_file:
+            return generated_file.read()
+    finally:
+        os.remove(temporary_path)
+
+
+def render_in_worker(mq_message, incoming_document_path, debug_sink_path=None):
+    return render_docx_file(worker_document_creator, worker_template_registry, mq_message, incoming_document_path,
+                            debug_sink_path)
+
+
+class DocumentRenderer:
+
+    # Renders docx templates outside the consumer thread. With pool_size > 0 the templates render in separate worker
+    # processes, so several documents render in parallel and don't compete with the P360 calls for the GIL. With
+    # pool_size 0 they render one at a time on a background thread, using the given DocxGenerator.
+    # Create it before starting other threads: the worker processes are forked.
+    def __init__(self, log, pool_size=3, document_creator=None, template_registry=None):
+        self.log = log
+        self.pool_size = pool_size
+        self.template_registry = template_registry
+
+        if pool_size > 0:
+            self.executor = self.create_process_pool()
+            self.log.info("Rendering documents in a pool of " + str(pool_size) + " worker processes")
+        else:
+            if document_creator is None:
+                from docxgenerator import DocxGenerator
+                document_creator = DocxGenerator(log=log)
+            self.document_creator = document_creator
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="docx")
+            self.log.info("Rendering documents on a background thread")
+
+    def create_process_pool(self, start_method="fork"):
+        # A forked worker inherits the compiled templates. Any other start method can't pass the registry (it holds
+        # a lock), so the workers compile their own.
+        if start_method == "fork":
+            initargs = (self.log.name, self.log.level, self.template_registry)
+        else:
+            initargs = (self.log.name, self.log.level, None, self.template_registry is not None)
+        executor = ProcessPoolExecutor(max_workers=self.pool_size, mp_context=multiprocessing.get_context(start_method),
+                                       initializer=init_render_worker, initargs=initargs)
+        # With fork, the first job starts all the workers. Do that now, while the process has few threads, rather
+        # than in the middle of processing a message.
+        executor.submit(int).result()
+        return executor
+
+    # The result of a render is the contents of the generated docx file. If debug_sink_path is given, a copy is also
+    # written there.
+    def submit(self, mq_message, incoming_document_path, debug_sink_path=None):
+        if self.pool_size > 0:
+            try:
+                return self.executor.submit(render_in_worker, mq_message, incoming_document_path, debug_sink_path)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OOM killer). The pool can't be used anymore, so start a new one.
+                # By now this process has threads (the consumer, metrics, the publisher), and forking it could copy a
+                # lock some other thread holds, so the new workers are started by a forkserver instead.
+                self.log.warning("The document render pool is broken. Starting a new one.")
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.create_process_pool(start_method="forkserver")
+                return self.executor.submit(render_in_worker, mq_message, incoming_document_path, debug_sink_path)
+        return self.executor.submit(self.render, mq_message, incoming_document_path, debug_sink_path)
+
+    def render(self, mq_message, incoming_document_path, debug_sink_path=None):
+        return render_docx_file(self.document_creator, self.template_registry, mq_message, incoming_document_path,
+                                debug_sink_path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
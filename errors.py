@@ -0,0 +1,14 @@
+class RetryableError(Exception):
+    # The message couldn't be processed now, but may well be later (e.g. P360 is overloaded or down). The consumer
+    # requeues it instead of rejecting it.
+    pass
+
+
+class CircuitOpenError(RetryableError):
+    # P360 has been failing, so calls fail fast for a while instead of waiting for it
+    pass
+
+
+class DeadlineExceededError(Exception):
+    # The message ran out of its time budget (MESSAGE_DEADLINE_SECONDS)
+    pass
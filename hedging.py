@@ -0,0 +1,139 @@
+# Stdlibs
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
+
+# Custom code
+from deadline import get_remaining_time
+from metrics import REGISTRY
+
+HEDGED_REQUESTS = REGISTRY.counter("p360_hedged_requests_total",
+                                   "P360 lookups that got a second, hedged request, by which one answered first",
+                                   ("endpoint", "winner"))
+HEDGES_SKIPPED = REGISTRY.counter("p360_hedges_skipped_total",
+                                  "Hedged requests that weren't sent because the hedging budget was used up",
+                                  ("endpoint",))
+
+
+class LatencyTracker:
+
+    # The latencies of the last window_size requests per endpoint
+    def __init__(self, window_size=200):
+        self.window_size = window_size
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            window = self.latencies.get(endpoint)
+            if window is None:
+                window = self.latencies[endpoint] = deque(maxlen=self.window_size)
+            window.append(latency)
+
+    def get_percentile(self, endpoint, percentile, min_samples):
+        # None until there are min_samples latencies to go by
+        with self.lock:
+            window = self.latencies.get(endpoint)
+            if window is None or len(window) < min_samples:
+                return None
+            latencies = sorted(window)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+
+class HedgeBudget:
+
+    # Every request earns ratio of a token, and every hedge spends a whole one, so hedges never add more than ratio
+    # (e.g. 5 %) to the number of requests. At most burst tokens are saved up.
+    def __init__(self, ratio=0.05, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+
+    def earn(self):
+        with self.lock:
+            self.tokens = min(float(self.burst), self.tokens + self.ratio)
+
+    def spend(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Hedger:
+
+    # Cuts the long tail of P360 lookups. If a lookup hasn't answered within the given percentile of the recent
+    # latencies of its endpoint, an identical request is sent, and the first successful answer wins. The slower
+    # request is called off if it hasn't started yet (all the hedging threads were busy), and otherwise left to
+    # finish on its own.
+    #
+    # Only for idempotent requests: a hedged write could create the same case or document twice.
+    def __init__(self, log=None, percentile=95, budget_ratio=0.05, min_delay=0.05, min_samples=20, max_workers=10):
+        self.log = log if log else logging.getLogger(__name__)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latency_tracker = LatencyTracker()
+        self.budget = HedgeBudget(ratio=budget_ratio)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="p360-hedge")
+
+    def call(self, endpoint, function, *args, **kwargs):
+        self.budget.earn()
+        hedge_delay = self.latency_tracker.get_percentile(endpoint, self.percentile, self.min_samples)
+        if hedge_delay is None:
+            # Not enough latencies yet to know what slow is
+            return self.timed_call(endpoint, function, *args, **kwargs)
+
+        hedge_delay = get_remaining_time(max(self.min_delay, hedge_delay))
+        answered = threading.Event()
+        primary = self.submit(answered, endpoint, function, *args, **kwargs)
+        done, pending = wait([primary], timeout=max(0, hedge_delay))
+        if done:
+            return primary.result()
+
+        if not self.budget.spend():
+            HEDGES_SKIPPED.inc(endpoint=endpoint)
+            return primary.result()
+
+        self.log.info("No answer from " + endpoint + " within " + str(round(hedge_delay, 3)) +
+                      " seconds. Sending a hedged request.")
+        hedge = self.submit(answered, endpoint, function, *args, **kwargs)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            successful = [future for future in done if future.exception() is None]
+            if successful or not pending:
+                # The first successful answer, or the last failure if both failed
+                winner = successful[0] if successful else done.pop()
+                for loser in pending:
+                    loser.cancel()
+                HEDGED_REQUESTS.inc(endpoint=endpoint, winner="primary" if winner is primary else "hedge")
+                return winner.result()
+
+    def submit(self, answered, endpoint, function, *args, **kwargs):
+        # The request runs in a copy of the caller's context, so it keeps the message's deadline
+        context = contextvars.copy_context()
+        return self.executor.submit(context.run, self.call_unless_answered, answered, endpoint, function,
+                                    *args, **kwargs)
+
+    def call_unless_answered(self, answered, endpoint, function, *args, **kwargs):
+        # A request that only gets a thread once the other one has answered isn't sent at all
+        if answered.is_set():
+            raise CancelledError()
+        result = self.timed_call(endpoint, function, *args, **kwargs)
+        answered.set()
+        return result
+
+    def timed_call(self, endpoint, function, *args, **kwargs):
+        start = time.monotonic()
+        result = function(*args, **kwargs)
+        self.latency_tracker.record(endpoint, time.monotonic() - start)
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
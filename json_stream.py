@@ -0,0 +1,99 @@
+# Stdlibs
+import re
+import json
+import codecs
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonArrayStream:
+
+    # Parses a JSON response object like {"Cases": [...], "Successful": true, ...} as it's read, from an iterable
+    # of byte chunks (e.g. response.iter_content()). Iterating yields the items of the array_key array one at a
+    # time, so only one item and one chunk are in memory at once, and the caller can stop reading as soon as it has
+    # what it needs.
+    #
+    # The other top-level fields are kept in fields. Iteration stops early if "Successful" is false. finished is
+    # True once the whole object has been read.
+    def __init__(self, chunks, array_key):
+        self.chunks = iter(chunks)
+        self.array_key = array_key
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.end_of_stream = False
+        self.fields = {}
+        self.finished = False
+
+    def __iter__(self):
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            self.finished = True
+            return
+
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            if key == self.array_key and self.peek() == "[":
+                self.position += 1
+                if self.peek() == "]":
+                    self.position += 1
+                else:
+                    while True:
+                        yield self.decode_value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                value = self.decode_value()
+                self.fields[key] = value
+                if key == "Successful" and value is False:
+                    return
+            if self.expect(",}") == "}":
+                break
+
+        self.finished = True
+
+    def read_more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            text = self.text_decoder.decode(b"", final=True)
+            self.end_of_stream = True
+        else:
+            text = self.text_decoder.decode(chunk)
+        # Drop what has already been parsed
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def peek(self):
+        # The next character that isn't whitespace
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.end_of_stream:
+                raise ValueError("The JSON response ended too early")
+            self.read_more()
+
+    def expect(self, characters):
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expected one of " + characters + " in the JSON response, got " + character)
+        self.position += 1
+        return character
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.end_of_stream:
+                    raise
+            else:
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.end_of_stream:
+                    self.position = end
+                    return value
+            self.read_more()
@@ -0,0 +1,179 @@
+# Stdlibs
+import time
+import logging
+import threading
+from collections import deque
+
+# Custom code
+from concurrent_consumer import ConcurrentConsumer, get_message_id
+from p360_limiter import ConcurrencyShare, current_p360_share
+from metrics import REGISTRY
+
+LANE_BACKLOG = REGISTRY.gauge("mq_lane_backlog", "Messages received and waiting for a worker, by processing lane",
+                              ("lane",))
+LANE_WAIT = REGISTRY.histogram("mq_lane_wait_seconds", "Time from receiving a message until a worker takes it",
+                               ("lane",))
+LANE_LATENCY = REGISTRY.histogram("mq_lane_latency_seconds", "Time from receiving a message until it's processed",
+                                  ("lane",))
+QUEUE_DEPTH = REGISTRY.gauge("mq_queue_depth", "Messages ready in the broker queue, as of the last check",
+                             ("queue",))
+
+
+class Lane:
+
+    # The share of the consumer that one event type gets: its own workers, its own prefetch (a consumer of its own
+    # when it has its own queue), and its own share of the P360 concurrency. priority decides which lane the shared
+    # workers take a message from first.
+    def __init__(self, name, worker_count=1, prefetch_count=2, priority=0, queue_name=None, p360_concurrency=None,
+                 p360_acquire_timeout=30):
+        self.name = name
+        self.worker_count = worker_count
+        self.prefetch_count = prefetch_count
+        self.priority = priority
+        self.queue_name = queue_name
+        self.p360_share = ConcurrencyShare(name, p360_concurrency, p360_acquire_timeout) if p360_concurrency else None
+        self.backlog = deque()
+
+
+class LaneConsumer(ConcurrentConsumer):
+
+    # A ConcurrentConsumer with a processing lane per event type, so a backlog of heavy onboardings doesn't delay
+    # the light lønnsmelding messages.
+    #
+    # lane_selector(body, routing_key) gives the name of the lane for a message. Each lane has worker_count workers
+    # of its own. shared_worker_count more workers help out whichever lane has a backlog, the lane with the highest
+    # priority first.
+    #
+    # Lanes with a queue_name of their own consume that queue with their own prefetch. Lanes without one share
+    # queue_name, with the sum of their prefetch counts. The broker queue depths are checked every
+    # queue_depth_interval seconds.
+    def __init__(self, log, channel, queue_name, message_handler, lanes, lane_selector, shared_worker_count=0,
+                 drain_timeout=60, requeue_delay=5, queue_depth_interval=10):
+        self.log = log if log else logging.getLogger(__name__)
+        self.channel = channel
+        self.connection = channel.connection
+        self.queue_name = queue_name
+        self.message_handler = message_handler
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.lane_selector = lane_selector
+        self.shared_worker_count = shared_worker_count
+        self.drain_timeout = drain_timeout
+        self.requeue_delay = requeue_delay
+        self.queue_depth_interval = queue_depth_interval
+
+        self.consumer_tags = []
+        self.stopping = threading.Event()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.workers_stopping = False
+        self.workers = []
+
+    def start(self):
+        for lane in self.lanes.values():
+            for i in range(lane.worker_count):
+                self.start_worker(lane, "mq-" + lane.name + "-" + str(i))
+        for i in range(self.shared_worker_count):
+            self.start_worker(None, "mq-shared-" + str(i))
+
+        # basic_qos applies to the consumers started after it, so every queue gets the prefetch of its own lanes
+        prefetch_counts = {}
+        for lane in self.lanes.values():
+            queue_name = lane.queue_name or self.queue_name
+            prefetch_counts[queue_name] = prefetch_counts.get(queue_name, 0) + lane.prefetch_count
+        for queue_name, prefetch_count in prefetch_counts.items():
+            self.log.info("Consuming from queue " + queue_name + " with prefetch " + str(prefetch_count))
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+            self.consumer_tags.append(self.channel.basic_consume(queue=queue_name,
+                                                                 on_message_callback=self.on_message))
+        self.log.info("Processing lanes: " + ", ".join(
+            lane.name + " (" + str(lane.worker_count) + " workers, priority " + str(lane.priority) + ")"
+            for lane in self.lanes.values()) + ", and " + str(self.shared_worker_count) + " shared workers")
+
+        next_queue_depth_check = 0
+        while not self.stopping.is_set():
+            if time.monotonic() >= next_queue_depth_check:
+                self.update_queue_depths(prefetch_counts)
+                next_queue_depth_check = time.monotonic() + self.queue_depth_interval
+            self.connection.process_data_events(time_limit=1)
+
+        self.drain()
+
+    def on_message(self, channel, method, properties, body):
+        lane = self.lanes.get(self.lane_selector(body, method.routing_key))
+        if lane is None:
+            # A message of unknown type goes to the lowest priority lane, where the message handler rejects it
+            lane = min(self.lanes.values(), key=lambda lane: lane.priority)
+        self.in_flight += 1
+        with self.condition:
+            lane.backlog.append((method.delivery_tag, method.routing_key, body, time.monotonic(),
+                                 get_message_id(properties)))
+            LANE_BACKLOG.set(len(lane.backlog), lane=lane.name)
+            self.condition.notify_all()
+
+    def start_worker(self, lane, name):
+        worker = threading.Thread(target=self.run_worker, args=(lane,), name=name, daemon=True)
+        worker.start()
+        self.workers.append(worker)
+
+    def run_worker(self, lane):
+        # A worker of lane, or a shared worker if lane is None
+        while True:
+            with self.condition:
+                message_lane = self.get_next_lane(lane)
+                while message_lane is None:
+                    if self.workers_stopping:
+                        return
+                    self.condition.wait()
+                    message_lane = self.get_next_lane(lane)
+                delivery_tag, routing_key, body, received, message_id = message_lane.backlog.popleft()
+                LANE_BACKLOG.set(len(message_lane.backlog), lane=message_lane.name)
+            self.process_lane_message(message_lane, delivery_tag, routing_key, body, received, message_id)
+
+    def get_next_lane(self, lane):
+        # Call with the condition held
+        if lane is not None:
+            return lane if lane.backlog else None
+        waiting_lanes = [lane for lane in self.lanes.values() if lane.backlog]
+        if not waiting_lanes:
+            return None
+        # The highest priority, and then the lane whose next message has waited the longest
+        return max(waiting_lanes, key=lambda lane: (lane.priority, -lane.backlog[0][3]))
+
+    def process_lane_message(self, lane, delivery_tag, routing_key, body, received, message_id=None):
+        LANE_WAIT.observe(time.monotonic() - received, lane=lane.name)
+        token = current_p360_share.set(lane.p360_share)
+        try:
+            self.process_message(delivery_tag, routing_key, body, message_id)
+        finally:
+            current_p360_share.reset(token)
+            LANE_LATENCY.observe(time.monotonic() - received, lane=lane.name)
+
+    def update_queue_depths(self, prefetch_counts):
+        # Runs on the connection's thread
+        for queue_name in prefetch_counts:
+            try:
+                method_frame = self.channel.queue_declare(queue=queue_name, passive=True)
+                QUEUE_DEPTH.set(method_frame.method.message_count, queue=queue_name)
+            except Exception as e:
+                self.log.warning("Could not check the depth of queue " + queue_name + ": " + str(e))
+
+    def drain(self):
+        self.log.info("Stopping the consumer. Waiting for " + str(self.in_flight) + " messages in flight.")
+
+        # Cancelling the consumers makes pika nack the messages that were prefetched but not handed to a lane yet
+        for consumer_tag in self.consumer_tags:
+            self.channel.basic_cancel(consumer_tag)
+
+        deadline = time.monotonic() + self.drain_timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.5)
+
+        if self.in_flight > 0:
+            self.log.warning(str(self.in_flight) + " messages were still in flight after " +
+                             str(self.drain_timeout) + " seconds. They'll be redelivered.")
+
+        with self.condition:
+            self.workers_stopping = True
+            self.condition.notify_all()
+        self.connection.close()
+        self.log.info("The consumer has stopped")
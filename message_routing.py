@@ -0,0 +1,44 @@
+# Stdlibs
+import os
+import json
+import contextvars
+
+ONBOARDING_EVENT = "onboarding"
+LONNSMELDING_EVENT = "lonnsmelding"
+
+EVENT_TYPES = (ONBOARDING_EVENT, LONNSMELDING_EVENT)
+
+# The message_id property of the message being processed, if the publisher set one. A redelivery keeps it, while a
+# resubmission of the same form gets a new one. Set by the consumers with worker threads; MqClient doesn't pass it on.
+current_message_id = contextvars.ContextVar("current_message_id", default=None)
+
+
+def get_routing_keys():
+    # The routing keys the two message types are published with. They have no defaults: they must match how the
+    # messages are actually published, and a guess would send messages to the wrong handler.
+    routing_keys = {}
+    for event_type in EVENT_TYPES:
+        routing_key = os.environ.get("MQ_" + event_type.upper() + "_ROUTING_KEY")
+        if routing_key:
+            routing_keys[routing_key] = event_type
+    return routing_keys
+
+
+def get_event_type(mq_message, routing_key=None):
+    # Onboarding and lønnsmelding messages are told apart by their routing key (MQ_ONBOARDING_ROUTING_KEY and
+    # MQ_LONNSMELDING_ROUTING_KEY). Captured messages that are replayed outside the broker can carry the type in an
+    # "event" field instead. Returns None if the type is unknown.
+    if isinstance(mq_message, dict) and mq_message.get("event") in EVENT_TYPES:
+        return mq_message["event"]
+    if routing_key:
+        return get_routing_keys().get(routing_key)
+    return None
+
+
+def get_message_event_type(body, routing_key=None):
+    # The event type of a message that hasn't been parsed yet. A body that isn't JSON goes by the routing key.
+    try:
+        mq_message = json.loads(body)
+    except ValueError:
+        mq_message = None
+    return get_event_type(mq_message, routing_key)
@@ -0,0 +1,236 @@
+# Stdlibs
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The timings of the message being processed. Set by the server for each message, and carried into the P360 worker
+# threads by AsyncP360Client.
+current_message_timings = contextvars.ContextVar("current_message_timings", default=None)
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [name + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") + "\""
+               for name, value in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                cumulative = 0
+                for bucket, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(self.name + "_bucket" +
+                                 format_labels(self.label_names, label_values, ("le", format_value(bucket))) +
+                                 " " + str(cumulative))
+                lines.append(self.name + "_bucket" +
+                             format_labels(self.label_names, label_values, ("le", "+Inf")) + " " +
+                             str(series["count"]))
+                lines.append(self.name + "_sum" + format_labels(self.label_names, label_values) + " " +
+                             format_value(series["sum"]))
+                lines.append(self.name + "_count" + format_labels(self.label_names, label_values) + " " +
+                             str(series["count"]))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(self.name + format_labels(self.label_names, label_values) + " " + format_value(value))
+        return lines
+
+
+class Gauge:
+
+    # Either set explicitly, or read at scrape time from callback(), which returns {label values tuple: value}
+    def __init__(self, name, help_text, label_names=(), callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.callback = callback
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def set(self, value, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, amount=1, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " gauge"]
+        if self.callback is not None:
+            values = self.callback()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for label_values, value in sorted(values.items()):
+            lines.append(self.name + format_labels(self.label_names, label_values) + " " + format_value(value))
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # Registering a name again returns the metric that's already there
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=(), callback=None):
+        return self.register(Gauge(name, help_text, label_names, callback))
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+# The process wide registry that the server and the P360 client report to
+REGISTRY = MetricsRegistry()
+
+
+class MessageTimings:
+
+    # Collects how long each stage of one message took, for the per-message summary log line. Stages can run
+    # concurrently (e.g. three uploads), so a stage's time is the sum over its calls.
+    def __init__(self, event_type):
+        self.event_type = event_type
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.error = None
+        self.lock = threading.Lock()
+
+    def set_error(self, error):
+        self.error = error
+
+    def record(self, stage, seconds):
+        with self.lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def get_elapsed(self):
+        return time.perf_counter() - self.start
+
+    def get_summary(self, outcome):
+        with self.lock:
+            stages = {stage: {"seconds": round(total, 4), "calls": count}
+                      for stage, (total, count) in self.stages.items()}
+        summary = {"event_type": self.event_type, "outcome": outcome, "seconds": round(self.get_elapsed(), 4),
+                   "stages": stages}
+        if self.error is not None:
+            summary["error"] = type(self.error).__name__
+        return summary
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/ready" and self.server.readiness is not None:
+            ready = self.server.readiness()
+            body = b"ready\n" if ready else b"not ready\n"
+            self.send_response(200 if ready else 503)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0", registry=REGISTRY, log=None, readiness=None):
+    # Serves the registry in the Prometheus text format on http://host:port/metrics, from a daemon thread. With a
+    # readiness callback, http://host:port/ready answers 200 when it returns True and 503 otherwise.
+    httpd = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    httpd.readiness = readiness
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    (log if log else logging.getLogger(__name__)).info("Serving metrics on port " + str(httpd.server_address[1]))
+    return httpd
@@ -0,0 +1,222 @@
+# Stdlibs
+import json
+import time
+import pika
+import logging
+import threading
+from collections import deque
+
+# Custom code
+from metrics import REGISTRY
+
+NOTIFICATION_BUFFER = REGISTRY.gauge("notification_buffer_size", "Notifications waiting to be published")
+NOTIFICATIONS_UNCONFIRMED = REGISTRY.gauge("notifications_unconfirmed",
+                                           "Notifications published but not confirmed by the broker yet")
+NOTIFICATIONS = REGISTRY.counter("notifications_total", "Notifications by what happened to them", ("result",))
+
+
+class NotificationPublisher:
+
+    # Publishes notifications on one long-lived connection and channel, with publisher confirms.
+    #
+    # publish() only puts the notification in a bounded local buffer and wakes the IO thread, so it costs
+    # microseconds on the worker thread. The IO thread (a pika SelectConnection) publishes the buffer in batches and
+    # gets the confirms asynchronously; the broker confirms many deliveries at once with "multiple". Notifications
+    # that are nacked, or unconfirmed when the connection is lost, go back to the front of the buffer and are
+    # published again after reconnecting (so a notification may, rarely, be delivered twice).
+    #
+    # When the buffer is full, publish() falls back to fallback(message) (e.g. MqClient.emit_notification_message),
+    # which publishes synchronously.
+    #
+    # publish() returns before the broker has the notification, so the message that caused it may be acked first.
+    # Notifications still in the buffer when the process dies are lost.
+    def __init__(self, log, host, port, vhost, username, password, exchange, routing_key="", buffer_size=10000,
+                 max_unconfirmed=1000, reconnect_delay=5, fallback=None):
+        self.log = log if log else logging.getLogger(__name__)
+        self.parameters = pika.ConnectionParameters(host=host, port=port, virtual_host=vhost,
+                                                    credentials=pika.PlainCredentials(username, password),
+                                                    heartbeat=60)
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.buffer_size = buffer_size
+        self.max_unconfirmed = max_unconfirmed
+        self.reconnect_delay = reconnect_delay
+        self.fallback = fallback
+        self.properties = pika.BasicProperties(content_type="application/json", delivery_mode=2)
+
+        self.lock = threading.Lock()
+        self.buffer = deque()
+        self.unconfirmed = {}
+        self.delivery_tag = 0
+        self.connection = None
+        self.channel = None
+        self.stopping = False
+        self.idle = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="notification-publisher", daemon=True)
+        self.thread.start()
+        return self
+
+    def publish(self, message):
+        body = json.dumps(message).encode("utf-8")
+        with self.lock:
+            buffered = len(self.buffer) < self.buffer_size and not self.stopping
+            if buffered:
+                self.buffer.append(body)
+                NOTIFICATION_BUFFER.set(len(self.buffer))
+            connection = self.connection
+
+        if not buffered:
+            NOTIFICATIONS.inc(result="fallback")
+            self.log.warning("The notification buffer is full. Publishing the notification directly.")
+            if self.fallback is None:
+                raise Exception("The notification buffer is full, and there's no fallback publisher")
+            self.fallback(message)
+            return
+
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self.flush)
+            except Exception:
+                # The connection is closing. The notification is published after reconnecting.
+                pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+            try:
+                connection = pika.SelectConnection(self.parameters, on_open_callback=self.on_connection_open,
+                                                   on_open_error_callback=self.on_connection_open_error,
+                                                   on_close_callback=self.on_connection_closed)
+                with self.lock:
+                    self.connection = connection
+                connection.ioloop.start()
+            except Exception as e:
+                self.log.error("The notification publisher's connection failed: " + str(e))
+
+            with self.lock:
+                self.connection = None
+                self.channel = None
+                self.requeue_unconfirmed()
+                if self.stopping:
+                    return
+            time.sleep(self.reconnect_delay)
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, error):
+        self.log.error("Could not connect the notification publisher to the broker: " + str(error))
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
+        with self.lock:
+            stopping = self.stopping
+        if not stopping:
+            self.log.warning("The notification publisher's connection was closed: " + str(reason) +
+                             ". Will reconnect.")
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.confirm_delivery(self.on_delivery_confirmation)
+        with self.lock:
+            self.channel = channel
+            self.delivery_tag = 0
+        self.log.info("The notification publisher is connected")
+        self.flush()
+
+    def on_channel_closed(self, channel, reason):
+        self.log.warning("The notification publisher's channel was closed: " + str(reason))
+        with self.lock:
+            self.channel = None
+            self.requeue_unconfirmed()
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+    def flush(self):
+        # Runs on the IO thread
+        with self.lock:
+            channel = self.channel
+            while channel is not None and self.buffer and len(self.unconfirmed) < self.max_unconfirmed:
+                body = self.buffer.popleft()
+                channel.basic_publish(exchange=self.exchange, routing_key=self.routing_key, body=body,
+                                      properties=self.properties)
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = body
+            self.update_metrics()
+
+    def on_delivery_confirmation(self, frame):
+        # Runs on the IO thread
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self.lock:
+            if method.multiple:
+                delivery_tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+            else:
+                delivery_tags = [method.delivery_tag]
+            bodies = [self.unconfirmed.pop(tag) for tag in sorted(delivery_tags) if tag in self.unconfirmed]
+            if acked:
+                NOTIFICATIONS.inc(len(bodies), result="confirmed")
+            else:
+                NOTIFICATIONS.inc(len(bodies), result="nacked")
+                self.buffer.extendleft(reversed(bodies))
+            self.update_metrics()
+
+        if not acked:
+            self.log.warning("The broker nacked " + str(len(bodies)) + " notifications. Will publish them again.")
+        self.flush()
+
+    def requeue_unconfirmed(self):
+        # Call with the lock held
+        if self.unconfirmed:
+            self.buffer.extendleft(reversed([self.unconfirmed[tag] for tag in sorted(self.unconfirmed)]))
+            self.unconfirmed = {}
+        self.update_metrics()
+
+    def update_metrics(self):
+        # Call with the lock held
+        NOTIFICATION_BUFFER.set(len(self.buffer))
+        NOTIFICATIONS_UNCONFIRMED.set(len(self.unconfirmed))
+        if not self.buffer and not self.unconfirmed:
+            self.idle.notify_all()
+
+    def close(self, timeout=10):
+        # Waits up to timeout seconds for the buffered notifications to be published and confirmed
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while (self.buffer or self.unconfirmed) and time.monotonic() < deadline:
+                self.idle.wait(deadline - time.monotonic())
+            left = len(self.buffer) + len(self.unconfirmed)
+            self.stopping = True
+            connection = self.connection
+
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(connection.close)
+            except Exception:
+                pass
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+        if left:
+            # What's left is published directly, so it isn't lost. Unconfirmed notifications may be delivered twice.
+            self.log.warning(str(left) + " notifications were not confirmed by the broker before closing")
+            with self.lock:
+                self.requeue_unconfirmed()
+                bodies = list(self.buffer)
+                self.buffer.clear()
+                self.update_metrics()
+            for body in bodies:
+                if self.fallback is None:
+                    self.log.error("Dropping a notification, there's no fallback publisher: " + body.decode("utf-8"))
+                    continue
+                try:
+                    self.fallback(json.loads(body))
+                    NOTIFICATIONS.inc(result="fallback")
+                except Exception as e:
+                    self.log.error("Could not publish a notification while closing: " + str(e))
@@ -0,0 +1,62 @@
+# Stdlibs
+import time
+import threading
+from collections import OrderedDict
+
+# Returned by get() when there's no live entry. None is a valid cached value (a negative entry).
+MISSING = object()
+
+
+class TtlLruCache:
+
+    # A thread safe cache with a time to live per entry and a bound on the number of entries. When it's full, the
+    # least recently used entry is evicted. None values are negative entries ("P360 has no such contact/case") and
+    # live for negative_ttl seconds, which is normally shorter than the ttl of positive entries.
+    #
+    # Keys are tuples whose first element is a namespace, e.g. ("contact", email). Hits and misses are counted per
+    # namespace.
+    def __init__(self, max_entries=1024, ttl=300, negative_ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.count(key, "hits" if entry[1] is not None else "negative_hits")
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.count(key, "misses")
+            return MISSING
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                evicted_key, evicted_entry = self.entries.popitem(last=False)
+                self.count(evicted_key, "evictions")
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def count(self, key, counter):
+        namespace_stats = self.stats.setdefault(key[0], {"hits": 0, "negative_hits": 0, "misses": 0, "evictions": 0})
+        namespace_stats[counter] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = {namespace: dict(counters) for namespace, counters in self.stats.items()}
+            stats["entries"] = len(self.entries)
+            return stats
@@ -1,18 +1,44 @@
 # Stdlibs
 import os
-import pika
 import json
+import time
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 # Custom code
 from models.p360_case import P360Case
 from models.p360_contact import P360Contact
+from p360_transport import P360Transport
+from streaming_upload import StreamingUploadBody
+from p360_cache import TtlLruCache, MISSING
+from errors import RetryableError, DeadlineExceededError
+from single_flight import SingleFlight, KeyedLock
+from metrics import REGISTRY
+from structured_log import LogValue, LogFields, redact_text
+from json_stream import JsonArrayStream
+
+P360_REQUEST_DURATION = REGISTRY.histogram("p360_request_duration_seconds",
+                                           "Duration of Public 360 API calls, retries included",
+                                           ("endpoint", "outcome"))
+# The lookups that may be hedged. Writes (CreateCase, CreateDocument, UpdateDocument) never are.
+HEDGED_ENDPOINTS = ("ContactService/GetContactPersons", "CaseService/GetCases", "DocumentService/GetDocuments")
+
+# How much of a streamed response is read at a time
+STREAMING_CHUNK_SIZE = 64 * 1024
+
+# How many documents the case-wide GetDocuments lookup asks for per page
+GET_DOCUMENTS_PAGE_SIZE = 100
+
+P360_COALESCED_REQUESTS = REGISTRY.counter("p360_coalesced_requests_total",
+                                           "P360 lookups that shared the result of an identical lookup in flight",
+                                           ("endpoint",))
 
 
 class P360Client:
 
-    def __init__(self, log=None, api_base_uri=None, api_key=None, http_timeout=30):
+    def __init__(self, log=None, api_base_uri=None, api_key=None, http_timeout=30, pool_maxsize=10, max_retries=3,
+                 backoff_base=0.2, backoff_max=5.0, transport=None, cache=None, case_index=None,
+                 single_flight=True, limiter=None, circuit_breaker=None, hedger=None, streaming_responses=False):
         
         if log:
             self.log = log
@@ -26,13 +52,63 @@ class P360Client:
             
         self.log.info("Initializing the P360 client with base URI " + api_base_uri + " and timeout " + str(http_timeout))
         self.log.debug("Base URI: " + api_base_uri)
-        self.log.debug("API key: " + api_key)
         self.api_base_uri = api_base_uri
         self.api_key = api_key
 
         self.http_timeout = http_timeout
 
+        if transport:
+            self.transport = transport
+        else:
+            self.transport = P360Transport(log=self.log, http_timeout=http_timeout, pool_maxsize=pool_maxsize,
+                                           max_retries=max_retries, backoff_base=backoff_base,
+                                           backoff_max=backoff_max, limiter=limiter,
+                                           circuit_breaker=circuit_breaker)
+
+        # Optional read-through cache (a TtlLruCache) for contact, case and document folder lookups
+        self.cache = cache
+
+        # Optional persistent (pnr, access group) -> case index (a CaseIndex), consulted before searching P360
+        self.case_index = case_index
+
+        # Identical lookups in flight at the same time are sent once, and their result is shared
+        self.single_flight = SingleFlight() if single_flight else None
+        self.case_title_locks = KeyedLock()
+        # The cases this client has created lately, by title. The title lookup before a create may have been answered
+        # before another thread's create of the same case, or from the cache.
+        self.created_cases = TtlLruCache(max_entries=1024, ttl=3600)
+
+        # Optional Hedger, which sends a second request for lookups that are slower than usual
+        self.hedger = hedger
+
+        # Case and document lookups parse the response as it's read, and stop reading once they have their answer
+        self.streaming_responses = streaming_responses
+
+    def get_cached(self, key):
+        if self.cache is None:
+            return MISSING
+        return self.cache.get(key)
+
+    def put_cached(self, key, value):
+        if self.cache is not None:
+            self.cache.put(key, value)
+
+    def get_cache_stats(self):
+        if self.cache is None:
+            return {}
+        return self.cache.get_stats()
+
     def get_contact_person_by_email(self, user_email):
+        cache_key = ("contact", user_email.lower())
+        contact = self.get_cached(cache_key)
+        if contact is MISSING:
+            contact = self.fetch_contact_person_by_email(user_email)
+            self.put_cached(cache_key, contact)
+        else:
+            self.log.info("Found the P360 user with email \"" + user_email + "\" in the cache")
+        return contact
+
+    def fetch_contact_person_by_email(self, user_email):
         self.log.info("Searching for a P360 user with email \"" + user_email + "\"...")
 
         url = self.api_base_uri + "/ContactService/GetContactPersons?authkey=" + self.api_key
@@ -41,14 +117,8 @@ class P360Client:
             "Email": user_email 
         }}
 
-        self.log.info("Running HTTP POST to " + url + ", with this body content: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            self.log.error("ERROR: " + str(e))
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        response_object = self.post(url, post_data, idempotent=True)
 
         contacts = response_object["ContactPersons"]
         if len(contacts) > 1:
@@ -62,20 +132,171 @@ class P360Client:
         else:
             return None
 
+    def post(self, url, post_data=None, idempotent=False, body=None):
+        # Only lookups are coalesced and hedged. The callers get the same response object, and must not change it.
+        if not idempotent or body is not None:
+            return self.send(url, post_data, idempotent=idempotent, body=body)
+        if self.single_flight is None:
+            return self.send_lookup(url, post_data)
+
+        key = (url, json.dumps(post_data, sort_keys=True))
+        response_object, shared = self.single_flight.do(key, self.send_lookup, url, post_data)
+        if shared:
+            P360_COALESCED_REQUESTS.inc(endpoint=self.get_endpoint(url))
+        return response_object
+
+    def send_lookup(self, url, post_data):
+        endpoint = self.get_endpoint(url)
+        if self.hedger is not None and endpoint in HEDGED_ENDPOINTS:
+            return self.hedger.call(endpoint, self.send, url, post_data, idempotent=True)
+        return self.send(url, post_data, idempotent=True)
+
+    def lookup(self, url, post_data, array_key, select, *select_args):
+        # A lookup that only needs the items of the array_key array of the response (e.g. "Cases"). select(items,
+        # *select_args) gets an iterator over the items and returns the result, and may stop as soon as it has it.
+        # With streaming responses, the rest of the response is then never read or parsed.
+        if not self.streaming_responses:
+            response_object = self.post(url, post_data, idempotent=True)
+            return select(iter(response_object.get(array_key) or ()), *select_args)
+        if self.single_flight is None:
+            return self.send_streaming_lookup(url, post_data, array_key, select, *select_args)
+
+        key = (url, json.dumps(post_data, sort_keys=True), array_key, select.__name__, select_args)
+        result, shared = self.single_flight.do(key, self.send_streaming_lookup, url, post_data, array_key, select,
+                                               *select_args)
+        if shared:
+            P360_COALESCED_REQUESTS.inc(endpoint=self.get_endpoint(url))
+        return result
+
+    def send_streaming_lookup(self, url, post_data, array_key, select, *select_args):
+        endpoint = self.get_endpoint(url)
+        if self.hedger is not None and endpoint in HEDGED_ENDPOINTS:
+            return self.hedger.call(endpoint, self.send_streaming, url, post_data, array_key, select, *select_args)
+        return self.send_streaming(url, post_data, array_key, select, *select_args)
+
+    def send_streaming(self, url, post_data, array_key, select, *select_args):
+        endpoint = self.get_endpoint(url)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            try:
+                response = self.transport.post(url, post_data, idempotent=True, stream=True)
+            except (RetryableError, DeadlineExceededError):
+                raise
+            except Exception as e:
+                self.log.error("ERROR: %s", LogValue(e))
+                raise Exception("Failed to POST data to " + redact_text(url) + ". Error message: " +
+                                redact_text(str(e)))
+
+            try:
+                result = self.select_streamed_response(response, url, array_key, select, *select_args)
+            finally:
+                response.close()
+            outcome = "success"
+            return result
+        finally:
+            P360_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=endpoint, outcome=outcome)
+
+    def select_streamed_response(self, response, url, array_key, select, *select_args):
+        status_code = response.status_code
+        self.log.debug("API response status code: " + str(status_code))
+        if not status_code == 200:
+            raise Exception("The request to " + redact_text(url) + " returned status code " + str(status_code))
+
+        items = JsonArrayStream(response.iter_content(chunk_size=STREAMING_CHUNK_SIZE), array_key)
+        try:
+            result = select(iter(items), *select_args)
+        except Exception:
+            # If P360 said the request failed, that's the error to report, not what select made of the missing items
+            self.check_streamed_response(items, url, status_code)
+            raise
+        self.check_streamed_response(items, url, status_code)
+        if not items.finished:
+            self.log.debug("Stopped reading the response from " + self.get_endpoint(url) + " early")
+        return result
+
+    def check_streamed_response(self, items, url, status_code):
+        # "Successful" may come after the array. A response that was only read up to the answer had that answer in
+        # its array, which a failed request doesn't have.
+        if items.fields.get("Successful") is False or (items.finished and not items.fields.get("Successful")):
+            raise Exception("The request to " + redact_text(url) + " returned status code " + str(
+                status_code) + ". Response from the API was this: " + str(LogValue(items.fields)))
+
+    def send(self, url, post_data=None, idempotent=False, body=None):
+        endpoint = self.get_endpoint(url)
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            try:
+                response = self.transport.post(url, post_data, idempotent=idempotent, body=body)
+            except (RetryableError, DeadlineExceededError):
+                raise
+            except Exception as e:
+                self.log.error("ERROR: %s", LogValue(e))
+                raise Exception("Failed to POST data to " + redact_text(url) + ". Error message: " +
+                                redact_text(str(e)))
+
+            response_object = self.validate_response(response, url)
+            outcome = "success"
+            return response_object
+        finally:
+            P360_REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=endpoint, outcome=outcome)
+
+    def warm_up(self, connection_count):
+        # Opens connection_count pooled connections to P360 with side by side Ping calls, so the first messages
+        # don't wait for TCP and TLS handshakes
+        url = self.api_base_uri + "/DocumentService/Ping?authkey=" + self.api_key
+        with ThreadPoolExecutor(max_workers=connection_count, thread_name_prefix="p360-warm-up") as executor:
+            responses = list(executor.map(lambda i: self.transport.post(url, {}, idempotent=True),
+                                          range(connection_count)))
+        self.log.info("Opened " + str(len(responses)) + " connections to P360")
+
+    def get_endpoint(self, url):
+        # E.g. "CaseService/GetCases", without the base URI and the authkey
+        return url[len(self.api_base_uri):].split("?")[0].strip("/")
+
     def validate_response(self, response, url):
         status_code = response.status_code
         self.log.debug("API response status code: " + str(status_code))
         if not status_code == 200:
-            raise Exception("The request to " + url + " returned status code " + str(status_code))
+            raise Exception("The request to " + redact_text(url) + " returned status code " + str(status_code))
         response_object = response.json()
         if not response_object["Successful"]:
-            raise Exception("The request to " + url + " returned status code " + str(
-                status_code) + ". Response from the API was this: " + str(response_object))
-        self.log.debug("API response: " + str(response_object))
+            raise Exception("The request to " + redact_text(url) + " returned status code " + str(
+                status_code) + ". Response from the API was this: " + str(LogValue(response_object)))
+        self.log.debug("API response: %s", LogValue(response_object))
         return response_object
 
     def get_case_by_pnr_and_access_group(self, pnr, access_group_filter):
-        self.log.info("Searching for a P360 case based on pnr \"" + pnr + "\" and access group \"" + access_group_filter + "\"...")
+        cache_key = ("case_by_pnr", pnr, access_group_filter)
+        p360_case = self.get_cached(cache_key)
+        if p360_case is not MISSING:
+            self.log.info("Found the P360 case for access group \"" + access_group_filter + "\" in the cache")
+            return p360_case
+
+        if self.case_index is not None:
+            p360_case = self.case_index.get(pnr, access_group_filter)
+            if p360_case is not None:
+                self.log.info("Found the P360 case for access group \"" + access_group_filter + "\" in the case index")
+                self.put_cached(cache_key, p360_case)
+                return p360_case
+
+        p360_case = self.fetch_case_by_pnr_and_access_group(pnr, access_group_filter)
+        self.put_cached(cache_key, p360_case)
+        return p360_case
+
+    def invalidate_case_by_pnr_and_access_group(self, pnr, access_group_filter):
+        # The case found for (pnr, access group) turned out to be wrong (e.g. moved or closed, or the responsible
+        # person changed). The next lookup goes to P360.
+        self.log.info("Forgetting the P360 case for access group \"" + access_group_filter + "\"")
+        if self.cache is not None:
+            self.cache.invalidate(("case_by_pnr", pnr, access_group_filter))
+        if self.case_index is not None:
+            self.case_index.invalidate(pnr, access_group_filter)
+
+    def fetch_case_by_pnr_and_access_group(self, pnr, access_group_filter):
+        self.log.info("Searching for a P360 case based on pnr \"%s\" and access group \"%s\"...", LogValue(pnr),
+                      access_group_filter)
 
         url = self.api_base_uri + "/CaseService/GetCases?authkey=" + self.api_key
         post_data = {
@@ -84,27 +305,13 @@ class P360Client:
             }
         }
 
-        self.log.info("Running HTTP POST to " + url + ", with this body content: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
-
-        cases = response_object["Cases"]
-
-        existing_case = None
-
-        # The person may have a case registered with multiple units. Loop through the cases and fetch the one with
-        # the correct access group.
-        for case in cases:
-            this_access_group = case["AccessGroup"]
-            if this_access_group == access_group_filter:
-                existing_case = case
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        existing_case = self.lookup(url, post_data, "Cases", self.select_case_with_access_group, pnr,
+                                    access_group_filter)
 
         if existing_case is None:
-            raise Exception("Could not find any cases matching prn " + pnr + " and access group " + access_group_filter)
+            raise Exception("Could not find any cases matching prn " + redact_text(pnr) + " and access group " +
+                            access_group_filter)
 
         recno = existing_case["Recno"]
         case_number = existing_case["CaseNumber"]
@@ -122,7 +329,54 @@ class P360Client:
                         case_number=case_number,
                         case_recno=recno)
 
+    def select_case_with_access_group(self, cases, pnr, access_group_filter):
+        # The person may have a case registered with multiple units. Loop through the cases to find the one with the
+        # correct access group; if there's more than one, the last one, as before. The cases in the other units go
+        # into the case index as well. Every case is read, so streaming the response only saves memory here (one
+        # case is parsed at a time), not time.
+        found = None
+        for case in cases:
+            if case["AccessGroup"] == access_group_filter:
+                if found is not None:
+                    self.log.warning("P360 has more than one case with access group \"" + access_group_filter +
+                                     "\" for the same person: " + str(found["CaseNumber"]) + " and " +
+                                     str(case["CaseNumber"]) + ". Using the last one.")
+                found = case
+            else:
+                self.put_case_index(pnr, case)
+        if found is not None:
+            self.put_case_index(pnr, found)
+        return found
+
+    def select_single(self, items, error_message):
+        # The only item, or None. A second item is an error, raised without reading any further.
+        found = None
+        for item in items:
+            if found is not None:
+                raise Exception(error_message)
+            found = item
+        return found
+
+    def put_case_index(self, pnr, case):
+        if self.case_index is None:
+            return
+        responsible_person = case.get("ResponsiblePerson") or {}
+        if responsible_person.get("Email") is None or responsible_person.get("Recno") is None:
+            return
+        self.case_index.put(pnr, case["AccessGroup"], case["Recno"], case["CaseNumber"],
+                            responsible_person["Email"], responsible_person["Recno"])
+
     def get_case_by_title(self, case_title):
+        cache_key = ("case_by_title", case_title)
+        p360_case = self.get_cached(cache_key)
+        if p360_case is MISSING:
+            p360_case = self.fetch_case_by_title(case_title)
+            self.put_cached(cache_key, p360_case)
+        else:
+            self.log.info("Found the P360 case with title \"" + case_title + "\" in the cache")
+        return p360_case
+
+    def fetch_case_by_title(self, case_title):
         self.log.info("Searching for a P360 case with title \"" + case_title + "\"...")
 
         url = self.api_base_uri + "/CaseService/GetCases?authkey=" + self.api_key
@@ -130,27 +384,37 @@ class P360Client:
             "Title": case_title
         }}
 
-        self.log.info("Running HTTP POST to " + url + ", with this body content: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        existing_case = self.lookup(url, post_data, "Cases", self.select_single,
+                                    "The P360 returned more than one case. Expected 0 or 1 case.")
 
-        cases = response_object["Cases"]
-        if len(cases) > 1:
-            raise Exception("The P360 returned more than one case. Expected 0 or 1 case.")
-
-        elif len(cases) == 1:
-            existing_case = cases[0]
+        if existing_case is not None:
             recno = existing_case["Recno"]
             case_number = existing_case["CaseNumber"]
             return P360Case(case_number=case_number, case_recno=recno)
         else:
             return None
 
-    def create_case(self, case_title, responsible_person_recno, access_group, pnr):
+    def create_case(self, case_title, responsible_person_recno, access_group, pnr, responsible_person_email=None):
+        # Cases are created one at a time per title. Someone else may have created the case while we waited, or
+        # just before, and then we use theirs instead of creating a duplicate.
+        with self.case_title_locks.hold(case_title) as waited:
+            created_case = self.created_cases.get(("created_case", case_title))
+            if created_case is not MISSING:
+                self.log.info("The P360 case \"" + case_title + "\" was created just before. Will use it.")
+                return created_case
+            if waited:
+                existing_case = self.fetch_case_by_title(case_title)
+                if existing_case is not None:
+                    self.log.info("The P360 case \"" + case_title + "\" was created while we waited. Will use it.")
+                    self.put_cached(("case_by_title", case_title), existing_case)
+                    return existing_case
+            p360_case = self.send_create_case(case_title, responsible_person_recno, access_group, pnr,
+                                              responsible_person_email)
+            self.created_cases.put(("created_case", case_title), p360_case)
+            return p360_case
+
+    def send_create_case(self, case_title, responsible_person_recno, access_group, pnr, responsible_person_email=None):
         self.log.info("Creating new P360 case \"" + case_title + "\"...")
 
         url = self.api_base_uri + "/CaseService/CreateCase?authkey=" + self.api_key
@@ -175,21 +439,30 @@ class P360Client:
             ],
         }}
 
-        self.log.info("Running HTTP POST to " + url + ", with this body content: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        response_object = self.post(url, post_data, idempotent=False)
 
         recno = response_object["Recno"]
         case_number = response_object["CaseNumber"]
-        self.log.debug("Got this data from P360 CreateCase: " + str(response_object))
+        self.log.debug("Got this data from P360 CreateCase: %s", LogValue(response_object))
 
-        return P360Case(case_number=case_number, case_recno=recno)
+        p360_case = P360Case(case_number=case_number, case_recno=recno)
+        self.put_cached(("case_by_title", case_title), p360_case)
+        if responsible_person_email is not None:
+            self.put_case_index(pnr, {"AccessGroup": access_group, "Recno": recno, "CaseNumber": case_number,
+                                      "ResponsiblePerson": {"Email": responsible_person_email,
+                                                            "Recno": responsible_person_recno}})
+        return p360_case
 
     def get_document_folder(self, folder_name, document_number):
+        cache_key = ("document_folder", document_number, folder_name)
+        folder_document_number = self.get_cached(cache_key)
+        if folder_document_number is MISSING:
+            folder_document_number = self.fetch_document_folder(folder_name, document_number)
+            self.put_cached(cache_key, folder_document_number)
+        return folder_document_number
+
+    def fetch_document_folder(self, folder_name, document_number):
         self.log.info("Looking for document folder " + folder_name + " in P360...")
 
         url = self.api_base_uri + "/DocumentService/GetDocuments?authkey=" + self.api_key
@@ -199,26 +472,76 @@ class P360Client:
             "Title": folder_name
         }}
 
-        self.log.info("Running HTTP POST to " + url + " with this body: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        existing_document = self.lookup(url, post_data, "Documents", self.select_single,
+                                        "The P360 returned more than one documents. Expected 0 or 1.")
 
-        documents = response_object["Documents"]
-        if len(documents) > 1:
-            raise Exception("The P360 returned more than one documents. Expected 0 or 1.")
+        if existing_document is not None:
+            return existing_document["DocumentNumber"]
+        else:
+            return None
 
-        elif len(documents) == 1:
-            existing_document = documents[0]
-            recno = existing_document["Recno"]
-            document_number = existing_document["DocumentNumber"]
-            return document_number
+    def get_document_folders(self, case_number, folder_names):
+        document_folders = {}
+        for folder_name in folder_names:
+            document_folders[folder_name] = self.get_cached(("document_folder", case_number, folder_name))
 
+        if any(document_number is MISSING for document_number in document_folders.values()):
+            document_folders = self.fetch_document_folders(case_number, folder_names)
+            for folder_name, document_number in document_folders.items():
+                self.put_cached(("document_folder", case_number, folder_name), document_number)
         else:
-            return None
+            self.log.info("Found the document folders of case " + case_number + " in the cache")
+
+        return document_folders
+
+    def fetch_document_folders(self, case_number, folder_names):
+        self.log.info("Looking for document folders " + ", ".join(folder_names) + " in case " + case_number + " in P360...")
+
+        url = self.api_base_uri + "/DocumentService/GetDocuments?authkey=" + self.api_key
+
+        # One lookup for all the documents in the case, a page at a time. The requested titles are resolved locally.
+        # All the pages have to be read to know that a title isn't there.
+        document_folders = {folder_name: None for folder_name in folder_names}
+        seen_document_numbers = set()
+        page = 0
+        while True:
+            post_data = {"parameter": {
+                "CaseNumber": case_number,
+                "IncludeFileData": False,
+                "MaxReturnedDocuments": GET_DOCUMENTS_PAGE_SIZE,
+                "Page": page
+            }}
+
+            self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+            matches, document_numbers = self.lookup(url, post_data, "Documents", self.select_documents_by_title,
+                                                    tuple(folder_names))
+
+            # A P360 that ignores Page would return the first page forever
+            if seen_document_numbers.intersection(document_numbers):
+                raise Exception("The P360 returned the same documents on more than one page of case " + case_number)
+            seen_document_numbers.update(document_numbers)
+
+            for title, document_number in matches:
+                if document_folders[title] is not None:
+                    raise Exception("The P360 returned more than one documents named \"" + title +
+                                    "\". Expected 0 or 1.")
+                document_folders[title] = document_number
+
+            if len(document_numbers) < GET_DOCUMENTS_PAGE_SIZE:
+                return document_folders
+            page += 1
+
+    def select_documents_by_title(self, documents, folder_names):
+        # The (title, document number) of the documents on the page that are titled one of folder_names, and the
+        # document numbers of all the documents on the page
+        matches = []
+        document_numbers = []
+        for document in documents:
+            document_numbers.append(document["DocumentNumber"])
+            if document["Title"] in folder_names:
+                matches.append((document["Title"], document["DocumentNumber"]))
+        return matches, document_numbers
 
     # POP Har lagt til access_code og paragraph
     def create_document_folder(self, folder_name, category, status, case_number, responsible_recno, access_code,
@@ -256,18 +579,14 @@ class P360Client:
                 "AccessGroup": access_group
             }}
 
-        self.log.info("Running HTTP POST to " + url + ", with this body content: " + str(post_data))
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
-
-        response_object = self.validate_response(response, url)
+        self.log.info("Running HTTP POST %s", LogFields(url=url, body=post_data))
+        response_object = self.post(url, post_data, idempotent=False)
 
         recno = response_object["Recno"]
         document_number = response_object["DocumentNumber"]
-        self.log.debug("Got this data from P360 CreateDocument: " + str(response_object))
+        self.log.debug("Got this data from P360 CreateDocument: %s", LogValue(response_object))
 
+        self.put_cached(("document_folder", case_number, folder_name), document_number)
         return recno, document_number
 
     def upload_file(self, document_number, file_object):
@@ -275,24 +594,31 @@ class P360Client:
 
         url = self.api_base_uri + "/DocumentService/UpdateDocument?authkey=" + self.api_key
 
-        post_data = {"parameter": {
-            "DocumentNumber": document_number,
-            "Files": [
-                file_object
-            ]
-        }}
-
-        self.log.info("Running HTTP POST to " + url + " using this document number: " + document_number)
-        try:
-            response = requests.post(url, json=post_data, timeout=self.http_timeout)
-        except Exception as e:
-            raise Exception("Failed to POST data to " + url + ". Error message: " + str(e))
+        self.log.info("Running HTTP POST %s", LogFields(url=url, document_number=document_number))
 
-        response_object = self.validate_response(response, url)
+        # The file data is either the already encoded ASCII text, or the raw document (bytes or a binary file object).
+        # A raw document is encoded while the request body streams out, so it's never held in memory as one big
+        # JSON string.
+        if isinstance(file_object["data"], str):
+            post_data = {"parameter": {
+                "DocumentNumber": document_number,
+                "Files": [
+                    file_object
+                ]
+            }}
+            response_object = self.post(url, post_data, idempotent=False)
+        else:
+            response_object = self.post(url, body=StreamingUploadBody(document_number, file_object), idempotent=False)
 
         recno = response_object["Recno"]
         document_number = response_object["DocumentNumber"]
-        self.log.debug("Got this data from P360 UpdateDocument: " + str(response_object))
+        self.log.debug("Got this data from P360 UpdateDocument: %s", LogValue(response_object))
 
         return recno, document_number
 
+    def close(self):
+        self.transport.close()
+        if self.hedger is not None:
+            self.hedger.close()
+        if self.case_index is not None:
+            self.case_index.close()
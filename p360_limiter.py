@@ -0,0 +1,176 @@
+# Stdlibs
+import time
+import logging
+import threading
+import contextvars
+
+# Custom code
+from errors import RetryableError, CircuitOpenError
+from metrics import REGISTRY
+
+CONCURRENCY_LIMIT = REGISTRY.gauge("p360_concurrency_limit", "Current adaptive limit on concurrent P360 requests")
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("p360_requests_in_flight", "P360 requests in flight")
+CIRCUIT_STATE = REGISTRY.gauge("p360_circuit_state", "State of the P360 circuit breaker: 0 closed, 1 half open, 2 open")
+CIRCUIT_REJECTIONS = REGISTRY.counter("p360_circuit_rejections_total",
+                                      "P360 requests that failed fast because the circuit was open")
+
+LANE_REQUESTS_IN_FLIGHT = REGISTRY.gauge("p360_lane_requests_in_flight", "P360 requests in flight, by processing lane",
+                                         ("lane",))
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+# The P360 concurrency share of the processing lane the current message is in (see lane_consumer.py), or None
+current_p360_share = contextvars.ContextVar("current_p360_share", default=None)
+
+
+class AdaptiveLimiter:
+
+    # Limits how many requests may be in flight to P360, and adapts the limit the AIMD way: it grows by one for
+    # every limit fast, successful requests (additive increase), and is cut by backoff_ratio when a request fails
+    # or is slower than latency_target (multiplicative decrease). The limit is cut at most once per latency_target,
+    # so one burst of slow responses doesn't drive it to the minimum.
+    #
+    # acquire() waits at most acquire_timeout seconds for a free slot, and then raises RetryableError.
+    def __init__(self, log=None, initial_limit=10, min_limit=1, max_limit=10, latency_target=2.0, backoff_ratio=0.7,
+                 acquire_timeout=30):
+        self.log = log if log else logging.getLogger(__name__)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.acquire_timeout = acquire_timeout
+
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+        self.update_metrics()
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.acquire_timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RetryableError("Waited " + str(round(timeout, 1)) + " seconds for one of the " +
+                                         str(int(self.limit)) + " P360 request slots")
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            self.update_metrics()
+
+    def cancel(self):
+        # Gives the slot back without a request having been sent
+        with self.condition:
+            self.in_flight -= 1
+            self.update_metrics()
+            self.condition.notify_all()
+
+    def release(self, latency, failed):
+        with self.condition:
+            self.in_flight -= 1
+            if failed or latency > self.latency_target:
+                now = time.monotonic()
+                if now - self.last_decrease >= self.latency_target:
+                    self.last_decrease = now
+                    old_limit = int(self.limit)
+                    self.limit = max(float(self.min_limit), self.limit * self.backoff_ratio)
+                    if int(self.limit) != old_limit:
+                        self.log.warning("P360 is " + ("failing" if failed else "slow") +
+                                         ". Lowering the concurrency limit to " + str(int(self.limit)))
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self.update_metrics()
+            self.condition.notify_all()
+
+    def update_metrics(self):
+        CONCURRENCY_LIMIT.set(int(self.limit))
+        REQUESTS_IN_FLIGHT.set(self.in_flight)
+
+
+class CircuitBreaker:
+
+    # Opens after failure_threshold failures in a row. While it's open, calls fail fast with CircuitOpenError. After
+    # open_duration seconds one call is let through (half open); if it succeeds the circuit closes, if not it opens
+    # again.
+    def __init__(self, log=None, failure_threshold=5, open_duration=30):
+        self.log = log if log else logging.getLogger(__name__)
+        self.failure_threshold = failure_threshold
+        self.open_duration = open_duration
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+        CIRCUIT_STATE.set(self.state)
+
+    def before_call(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_duration:
+                self.set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+        CIRCUIT_REJECTIONS.inc()
+        raise CircuitOpenError("P360 is unavailable, the circuit breaker is open")
+
+    def on_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+            if self.state != CLOSED:
+                self.log.info("P360 is responding again. Closing the circuit breaker.")
+                self.set_state(CLOSED)
+
+    def on_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and
+                                           self.consecutive_failures >= self.failure_threshold):
+                self.log.warning("P360 failed " + str(self.consecutive_failures) + " times in a row. Opening the "
+                                 "circuit breaker for " + str(self.open_duration) + " seconds.")
+                self.opened_at = time.monotonic()
+                self.set_state(OPEN)
+
+    def set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(state)
+
+
+class ConcurrencyShare:
+
+    # The most P360 requests one processing lane may have in flight, so a backlog in one lane can't take all of the
+    # connections. acquire() waits at most acquire_timeout seconds, and then raises RetryableError.
+    def __init__(self, name, limit, acquire_timeout=30):
+        self.name = name
+        self.limit = limit
+        self.acquire_timeout = acquire_timeout
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.acquire_timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RetryableError("Waited " + str(round(timeout, 1)) + " seconds for one of the " +
+                                         str(self.limit) + " P360 request slots of the " + self.name + " lane")
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            LANE_REQUESTS_IN_FLIGHT.set(self.in_flight, lane=self.name)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            LANE_REQUESTS_IN_FLIGHT.set(self.in_flight, lane=self.name)
+            self.condition.notify()
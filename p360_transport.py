@@ -0,0 +1,139 @@
+# Stdlibs
+import time
+import random
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+# Custom code
+from errors import RetryableError, DeadlineExceededError
+from deadline import get_remaining_time, check_deadline
+from structured_log import LogValue
+from p360_limiter import current_p360_share
+
+# Status codes where P360 (or the proxy in front of it) is telling us to come back later
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class P360Transport:
+
+    # One shared, keep-alive HTTP session for all calls to Public 360. The connection pool is bounded, so at most
+    # pool_maxsize connections are kept open per host. With pool_block=True, callers wait for a free connection
+    # instead of opening extra ones that would be thrown away afterwards.
+    def __init__(self, log=None, http_timeout=30, pool_connections=2, pool_maxsize=10, pool_block=True,
+                 max_retries=3, backoff_base=0.2, backoff_max=5.0, limiter=None, circuit_breaker=None):
+
+        self.log = log if log else logging.getLogger(__name__)
+
+        self.http_timeout = http_timeout
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Optional AdaptiveLimiter and CircuitBreaker, applied to every request that is sent, retries included
+        self.limiter = limiter
+        self.circuit_breaker = circuit_breaker
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block,
+                              max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.log.info("P360 transport: connection pool size " + str(pool_maxsize) + ", max " + str(max_retries) +
+                      " retries for idempotent requests")
+
+    def post(self, url, post_data=None, idempotent=False, body=None, stream=False):
+        # Sends post_data serialized as JSON, or body as is if given. body is an already serialized JSON body, either
+        # bytes or a file-like object that is read as it's sent.
+        #
+        # Only idempotent requests (lookups) are retried. Retrying a CreateCase or CreateDocument after a timeout
+        # could create the same case or document twice.
+        #
+        # Within a message, no request (or wait for a retry) goes beyond the message's deadline.
+        #
+        # With stream, the response body is left unread for the caller to stream, and the caller closes the response.
+        attempt = 0
+        while True:
+            check_deadline("a P360 request")
+            try:
+                response = self.send(url, post_data, body, stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                check_deadline("P360 answered")
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                self.log.warning("HTTP POST failed on attempt %d: %s. Will retry.", attempt + 1, LogValue(e))
+            else:
+                if not idempotent or response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                self.log.warning("HTTP POST returned status code " + str(response.status_code) + " on attempt " +
+                                 str(attempt + 1) + ". Will retry.")
+                response.close()
+
+            backoff_delay = self.get_backoff_delay(attempt)
+            if backoff_delay >= get_remaining_time(backoff_delay + 1):
+                raise DeadlineExceededError("The message deadline doesn't leave time to retry the P360 request")
+            time.sleep(backoff_delay)
+            attempt += 1
+
+    def send(self, url, post_data, body, stream=False):
+        # The message's processing lane may only use its share of the P360 concurrency
+        share = current_p360_share.get()
+        if share is None:
+            return self.send_limited(url, post_data, body, stream)
+        try:
+            share.acquire(get_remaining_time(share.acquire_timeout))
+        except RetryableError:
+            check_deadline("a P360 request slot of the lane was free")
+            raise
+        try:
+            return self.send_limited(url, post_data, body, stream)
+        finally:
+            share.release()
+
+    def send_limited(self, url, post_data, body, stream=False):
+        if self.limiter:
+            acquire_timeout = get_remaining_time(self.limiter.acquire_timeout)
+            try:
+                self.limiter.acquire(acquire_timeout)
+            except RetryableError:
+                check_deadline("a P360 request slot was free")
+                raise
+        try:
+            if self.circuit_breaker:
+                self.circuit_breaker.before_call()
+        except RetryableError:
+            if self.limiter:
+                self.limiter.cancel()
+            raise
+
+        http_timeout = get_remaining_time(self.http_timeout)
+        start = time.monotonic()
+        failed = True
+        try:
+            if body is None:
+                response = self.session.post(url, json=post_data, timeout=http_timeout, stream=stream)
+            else:
+                response = self.session.post(url, data=body, headers=JSON_HEADERS, timeout=http_timeout,
+                                             stream=stream)
+            failed = response.status_code >= 500 or response.status_code == 429
+            return response
+        finally:
+            if self.limiter:
+                self.limiter.release(time.monotonic() - start, failed)
+            if self.circuit_breaker:
+                if failed:
+                    self.circuit_breaker.on_failure()
+                else:
+                    self.circuit_breaker.on_success()
+
+    def get_backoff_delay(self, attempt):
+        # Exponential backoff with full jitter, so that several workers that failed at the same time don't retry in
+        # lockstep against an already struggling P360.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def close(self):
+        self.session.close()
@@ -1,26 +1,114 @@
 # Stdlibs
+import json
+import time
+import base64
+import signal
+import asyncio
 import logging
+import threading
+import contextlib
+import concurrent.futures
 import os
 import datetime
 
+# When this module started loading, for the startup timings
+MODULE_LOAD_STARTED = time.perf_counter()
+
 # Custom code
-from mq_client import MqClient
 from config.server import ServerConfig as Config
 from p360_client import P360Client
-from docxgenerator import DocxGenerator
+from async_p360_client import AsyncP360Client
+from p360_cache import TtlLruCache
+from concurrent_consumer import ConcurrentConsumer
+from lane_consumer import Lane, LaneConsumer
+from message_routing import get_event_type, get_message_event_type, get_routing_keys, EVENT_TYPES, ONBOARDING_EVENT, \
+    LONNSMELDING_EVENT, current_message_id
+from case_index import CaseIndex
+from errors import RetryableError, DeadlineExceededError
+from deadline import Deadline, current_deadline, check_deadline
+from p360_limiter import AdaptiveLimiter, CircuitBreaker
+from hedging import Hedger
+from checkpoint_journal import CheckpointJournal, MessageCheckpoints
+from metrics import REGISTRY, MessageTimings, current_message_timings, start_metrics_server
+from structured_log import LogValue
+from models.p360_case import P360Case
+from document_renderer import DocumentRenderer
+from template_registry import TemplateRegistry
+from startup import StartupTimings, SERVER_READY
 import utils
 
+MODULE_LOAD_SECONDS = time.perf_counter() - MODULE_LOAD_STARTED
+
+ARBEIDSAVTALE_NORSK_TEMPLATE_PATH = "/resources/Arbeidsavtale_norsk.docx"
+ARBEIDSAVTALE_ENGELSK_TEMPLATE_PATH = "/resources/Arbeidsavtale_engelsk.docx"
+HOVEDTARIFFAVTALE_TEMPLATE_PATH = "/resources/Hovedtariffavtale.docx"
+VELKOMSTBREV_TEMPLATE_PATH = "/resources/Velkomstbrev.docx"
+LONNSMELDING_TEMPLATE_PATH = "/resources/Lonnsmelding.docx"
+
+TEMPLATE_PATHS = [ARBEIDSAVTALE_NORSK_TEMPLATE_PATH, ARBEIDSAVTALE_ENGELSK_TEMPLATE_PATH,
+                  HOVEDTARIFFAVTALE_TEMPLATE_PATH, VELKOMSTBREV_TEMPLATE_PATH, LONNSMELDING_TEMPLATE_PATH]
+
+
+def get_onboarding_case_title(mq_message):
+    return "Personalmappe offentlig - " + mq_message["Navn"] + " - " + mq_message["Enhet"]
+
+
+def check_consumer_config(require_worker_threads=False):
+    # Returns True if the server consumes with worker threads (MQ_WORKER_COUNT > 1 or MQ_LANES), which drain on
+    # SIGTERM. Otherwise MqClient consumes, and a SIGTERM stops it in the middle of a message.
+    worker_threads = (int(os.environ.get("MQ_WORKER_COUNT", "1")) > 1 or
+                      os.environ.get("MQ_LANES", "false").lower() == "true")
+    if require_worker_threads and not worker_threads:
+        raise Exception("Set MQ_WORKER_COUNT > 1 or MQ_LANES=true, so the server drains its messages on SIGTERM")
+    if worker_threads and len(get_routing_keys()) < len(EVENT_TYPES):
+        raise Exception("Consuming with worker threads needs MQ_ONBOARDING_ROUTING_KEY and "
+                        "MQ_LONNSMELDING_ROUTING_KEY to tell the message types apart")
+    # Lanes on one queue share its prefetch window, so a backlog of onboardings would still hold back the
+    # lønnsmelding messages queued behind them
+    if os.environ.get("MQ_LANES", "false").lower() == "true":
+        lane_queue_names = [os.environ.get("MQ_" + event_type.upper() + "_QUEUE_NAME") for event_type in EVENT_TYPES]
+        if not all(lane_queue_names) or len(set(lane_queue_names)) < len(lane_queue_names):
+            raise Exception("MQ_LANES needs a queue of its own for each lane. Set MQ_ONBOARDING_QUEUE_NAME and "
+                            "MQ_LONNSMELDING_QUEUE_NAME to two different queues.")
+    return worker_threads
+
+
+# The stages are lookup, create, render, encode, upload and notify. With P360_STREAMING_UPLOADS (the default) the
+# documents are encoded while they're uploaded, so their encoding time is part of the upload stage and there's no
+# encode stage.
+STAGE_DURATION = REGISTRY.histogram("onboarding_stage_duration_seconds",
+                                    "Duration of each stage of processing a message. With streaming uploads, "
+                                    "encoding is counted in the upload stage.",
+                                    ("event_type", "stage"))
+MESSAGE_DURATION = REGISTRY.histogram("onboarding_message_duration_seconds",
+                                      "Duration of processing a message, from start to the notification",
+                                      ("event_type", "outcome"))
+
 
 class Server:
 
     ldap_client = None
     mq_client = None
     p360_client = None
-    document_creator = None
+    async_p360_client = None
+    document_renderer = None
+    template_registry = None
+    document_debug_sink_dir = None
+    streaming_uploads = True
     config = None
-
-    def __init__(self, mq_client=None, log=None):
+    consumer = None
+    metrics_server = None
+    checkpoint_journal = None
+    notification_publisher = None
+    ready = False
+    # Set when the consumer requeues a message whose handler raises RetryableError
+    requeue_retryable_errors = False
+
+    def __init__(self, mq_client=None, log=None, config=None, p360_client=None, template_registry=None):
         logging.info("Initializing the server...")
+        self.startup_timings = StartupTimings()
+        self.startup_timings.record("imports", MODULE_LOAD_SECONDS)
+        init_started = time.perf_counter()
         
         if log:
             self.log = log
@@ -33,13 +121,59 @@ class Server:
             self.log.info("The server created a new log \"" + self.log.name + "\" with log level " +
                           logging.getLevelName(self.log.level))
 
-        self.config = Config(log=self.log)
+        self.config = config if config else Config(log=self.log)
 
-        self.p360_client = P360Client(log=self.log,
-                                      api_base_uri=self.config.get_p360_api_base_uri(),
-                                      api_key=self.config.get_p360_api_key())
-
-        self.document_creator = DocxGenerator(log=self.log)
+        if p360_client:
+            self.p360_client = p360_client
+        else:
+            p360_pool_maxsize = int(os.environ.get("P360_POOL_MAXSIZE", "10"))
+            self.p360_client = P360Client(log=self.log,
+                                          api_base_uri=self.config.get_p360_api_base_uri(),
+                                          api_key=self.config.get_p360_api_key(),
+                                          pool_maxsize=p360_pool_maxsize,
+                                          max_retries=int(os.environ.get("P360_MAX_RETRIES", "3")),
+                                          backoff_base=float(os.environ.get("P360_BACKOFF_BASE", "0.2")),
+                                          cache=self.create_p360_cache(),
+                                          case_index=self.create_case_index(),
+                                          single_flight=os.environ.get("P360_SINGLE_FLIGHT", "true").lower() == "true",
+                                          limiter=self.create_p360_limiter(p360_pool_maxsize),
+                                          circuit_breaker=self.create_p360_circuit_breaker(),
+                                          hedger=self.create_p360_hedger(p360_pool_maxsize),
+                                          streaming_responses=os.environ.get("P360_STREAMING_RESPONSES",
+                                                                             "true").lower() == "true")
+
+        self.async_p360_client = AsyncP360Client(self.p360_client)
+        self.p360_concurrency_per_message = int(os.environ.get("P360_CONCURRENCY_PER_MESSAGE", "4"))
+
+        # The time budget of one message, for all its P360 calls, renders and uploads together. 0 turns it off.
+        self.message_deadline_seconds = float(os.environ.get("MESSAGE_DEADLINE_SECONDS", "20"))
+
+        # With FAST_STARTUP, the docx libraries, the templates and the render pool are left for warm_up(), which
+        # run() does while it connects to the broker. Without it, they're all ready when the server is created.
+        self.fast_startup = os.environ.get("FAST_STARTUP", "false").lower() == "true"
+
+        # Compile the templates once, before the render workers are forked, so every worker starts with them. The
+        # supervisor compiles them before forking the servers, and passes them in.
+        self.template_registry = template_registry
+        if not self.fast_startup:
+            self.preload_templates()
+
+        self.streaming_uploads = os.environ.get("P360_STREAMING_UPLOADS", "true").lower() == "true"
+
+        # Documents are rendered and uploaded in memory. Set DOCX_DEBUG_SINK_DIR (e.g. /result) to also keep a copy on disk.
+        self.document_debug_sink_dir = os.environ.get("DOCX_DEBUG_SINK_DIR")
+
+        # With CHECKPOINT_JOURNAL_PATH set, the steps that are done for each message are journaled, so a redelivered
+        # message picks up where it failed
+        checkpoint_journal_path = os.environ.get("CHECKPOINT_JOURNAL_PATH")
+        if checkpoint_journal_path:
+            self.checkpoint_journal = CheckpointJournal(checkpoint_journal_path, log=self.log,
+                                                        retention=float(os.environ.get("CHECKPOINT_RETENTION", str(7 * 24 * 3600))),
+                                                        completed_retention=float(os.environ.get(
+                                                            "CHECKPOINT_COMPLETED_RETENTION", "3600")))
+
+        if not self.fast_startup:
+            self.document_renderer = self.create_document_renderer()
 
         if mq_client:
             self.mq_client = mq_client
@@ -48,6 +182,8 @@ class Server:
             mq_notification_username = self.config.get_mq_username()
             mq_notification_password = self.config.get_mq_password()
             mq_notification_exchange = self.config.get_notification_exchange_name()
+            # Imported here, so pika is only loaded by servers that talk to the broker
+            from mq_client import MqClient
             self.mq_client = MqClient(log=self.log, mq_host=self.config.get_mq_host(),
                                       mq_port=self.config.get_mq_port(),
                                       listen_exchange_name=self.config.get_mq_listen_exchange_name(),
@@ -65,9 +201,129 @@ class Server:
                                       notification_password=mq_notification_password,
                                       notification_exchange=mq_notification_exchange)
 
+        self.startup_timings.record("init", time.perf_counter() - init_started)
+
+    def preload_templates(self):
+        # The docx libraries are imported here rather than when the server module loads, and before the render
+        # workers are forked, so the workers share them
+        import docxgenerator
+        if self.template_registry is None and os.environ.get("DOCX_COMPILED_TEMPLATES", "true").lower() == "true":
+            self.template_registry = TemplateRegistry(log=self.log)
+            self.template_registry.preload(TEMPLATE_PATHS)
+
+    def create_document_renderer(self):
+        return DocumentRenderer(log=self.log, pool_size=int(os.environ.get("DOCX_RENDER_POOL_SIZE", "3")),
+                                template_registry=self.template_registry)
+
+    def warm_up(self, connect=None):
+        # Gets everything a message needs ready before the first one arrives. The templates are compiled and P360
+        # connections are opened on threads of their own, while connect() (e.g. the broker connection) runs on this
+        # one. The render workers are forked once those threads are done. Returns what connect() returned.
+        threads = [self.startup_timings.start_thread("templates", self.preload_templates),
+                   self.startup_timings.start_thread("p360_connections", self.warm_up_p360_connections)]
+        connected = None
+        if connect is not None:
+            with self.startup_timings.measure("broker"):
+                connected = connect()
+        for thread in threads:
+            thread.join()
+
+        if self.document_renderer is None:
+            with self.startup_timings.measure("render_pool"):
+                self.document_renderer = self.create_document_renderer()
+        return connected
+
+    def warm_up_p360_connections(self):
+        # A message makes several P360 calls side by side, so open that many pooled connections up front. P360 being
+        # down doesn't stop the server from starting; the circuit breaker handles that.
+        connection_count = int(os.environ.get("P360_WARM_CONNECTIONS", str(self.p360_concurrency_per_message)))
+        if connection_count <= 0:
+            return
+        try:
+            self.p360_client.warm_up(connection_count)
+        except Exception as e:
+            self.log.warning("Could not open connections to P360 at startup: %s", LogValue(e))
+
+    def set_ready(self, ready=True):
+        # The readiness signal: /ready on the metrics port, the server_ready gauge, and the file READY_FILE
+        self.ready = ready
+        SERVER_READY.set(1 if ready else 0)
+        ready_file = os.environ.get("READY_FILE")
+        if ready_file:
+            if ready:
+                with open(ready_file, "w") as file:
+                    file.write(str(os.getpid()))
+            elif os.path.exists(ready_file):
+                os.remove(ready_file)
+
+    def create_p360_cache(self):
+        if os.environ.get("P360_CACHE_ENABLED", "false").lower() != "true":
+            return None
+        return TtlLruCache(max_entries=int(os.environ.get("P360_CACHE_MAX_ENTRIES", "1024")),
+                           ttl=float(os.environ.get("P360_CACHE_TTL", "300")),
+                           negative_ttl=float(os.environ.get("P360_CACHE_NEGATIVE_TTL", "30")))
+
+    def create_p360_limiter(self, pool_maxsize):
+        # Adapts how many requests may be in flight to P360 to how fast it answers. It never goes above the size of
+        # the connection pool. Off by default. A request it turns away raises RetryableError, which only a consumer
+        # with worker threads (MQ_WORKER_COUNT > 1 or MQ_LANES) requeues. With MqClient the message fails.
+        if os.environ.get("P360_ADAPTIVE_LIMIT", "false").lower() != "true":
+            return None
+        return AdaptiveLimiter(log=self.log,
+                               initial_limit=pool_maxsize,
+                               min_limit=int(os.environ.get("P360_MIN_CONCURRENCY", "1")),
+                               max_limit=pool_maxsize,
+                               latency_target=float(os.environ.get("P360_LATENCY_TARGET", "2.0")),
+                               acquire_timeout=float(os.environ.get("P360_ACQUIRE_TIMEOUT", "30")))
+
+    def create_p360_circuit_breaker(self):
+        # Off by default, like the limiter
+        if os.environ.get("P360_CIRCUIT_BREAKER", "false").lower() != "true":
+            return None
+        return CircuitBreaker(log=self.log,
+                              failure_threshold=int(os.environ.get("P360_CIRCUIT_FAILURE_THRESHOLD", "5")),
+                              open_duration=float(os.environ.get("P360_CIRCUIT_OPEN_DURATION", "30")))
+
+    def create_p360_hedger(self, pool_maxsize):
+        # Off by default. P360_HEDGE_BUDGET is the most extra load hedging may add, as a share of the lookups.
+        if os.environ.get("P360_HEDGING", "false").lower() != "true":
+            return None
+        return Hedger(log=self.log,
+                      percentile=float(os.environ.get("P360_HEDGE_PERCENTILE", "95")),
+                      budget_ratio=float(os.environ.get("P360_HEDGE_BUDGET", "0.05")),
+                      min_delay=float(os.environ.get("P360_HEDGE_MIN_DELAY", "0.05")),
+                      max_workers=2 * pool_maxsize)
+
+    def create_case_index(self):
+        # With CASE_INDEX_PATH set, the cases we create or find are indexed locally by (pnr, access group), so the
+        # lønnsmelding flow usually doesn't have to search P360 for the case
+        case_index_path = os.environ.get("CASE_INDEX_PATH")
+        if not case_index_path:
+            return None
+        return CaseIndex(case_index_path, log=self.log, salt=os.environ.get("CASE_INDEX_SALT", ""),
+                         max_age=float(os.environ.get("CASE_INDEX_MAX_AGE", str(30 * 24 * 3600))))
+
+    def start_metrics_server(self):
+        # Prometheus metrics are served on http://<host>:METRICS_PORT/metrics when METRICS_PORT is set
+        metrics_port = os.environ.get("METRICS_PORT")
+        if not metrics_port or self.metrics_server is not None:
+            return
+        REGISTRY.gauge("p360_cache_lookups", "Lookups in the P360 cache, by namespace and result",
+                       ("namespace", "result"), callback=self.get_p360_cache_lookup_counts)
+        self.metrics_server = start_metrics_server(int(metrics_port), log=self.log, readiness=lambda: self.ready)
+
+    def get_p360_cache_lookup_counts(self):
+        lookup_counts = {}
+        for namespace, counters in self.p360_client.get_cache_stats().items():
+            if isinstance(counters, dict):
+                for result, count in counters.items():
+                    lookup_counts[(namespace, result)] = count
+        return lookup_counts
+
     def run(self):
         self.log.info("Preparing to consuming messages from queue.")
-        
+        worker_threads = check_consumer_config()
+
         queue_name = self.config.get_mq_listen_queue_name()
 
         mq_vhost = self.config.get_mq_vhost()
@@ -75,10 +331,132 @@ class Server:
         mq_password = self.config.get_mq_password()
         mq_exchange = self.config.get_mq_listen_exchange_name()
 
+        # A supervised server process ends with os._exit, which skips atexit, so everything that outlives the
+        # process unless it's shut down (the render worker processes above all) is closed here
+        try:
+            # The lane queues are bound by the broker setup. The listen queue isn't consumed then, so it isn't bound.
+            lanes = os.environ.get("MQ_LANES", "false").lower() == "true"
+            mq_channel = self.warm_up(lambda: self.connect_to_queue(mq_username, mq_password, mq_vhost, mq_exchange,
+                                                                    queue_name, bind=not lanes))
+
+            # Started after the render workers are forked, so they don't inherit the threads
+            self.start_metrics_server()
+            with self.startup_timings.measure("notification_publisher"):
+                self.start_notification_publisher()
+
+            self.log.info("Startup timings: " + json.dumps(self.startup_timings.get_summary()))
+            self.set_ready()
+
+            # With more than one worker, messages are processed concurrently by a pool of worker threads. With lanes,
+            # onboarding and lønnsmelding messages each get their own workers and share of the P360 concurrency.
+            worker_count = int(os.environ.get("MQ_WORKER_COUNT", "1"))
+            if lanes:
+                self.consumer = self.create_lane_consumer(mq_channel, queue_name)
+            elif worker_threads:
+                self.consumer = ConcurrentConsumer(log=self.log, channel=mq_channel, queue_name=queue_name,
+                                                   message_handler=self.handle_mq_message,
+                                                   prefetch_count=int(os.environ.get("MQ_PREFETCH_COUNT",
+                                                                                     str(2 * worker_count))),
+                                                   worker_count=worker_count,
+                                                   drain_timeout=float(os.environ.get("MQ_DRAIN_TIMEOUT", "60")),
+                                                   requeue_delay=float(os.environ.get("MQ_REQUEUE_DELAY", "5")))
+            if self.consumer is not None:
+                self.requeue_retryable_errors = True
+                if threading.current_thread() is threading.main_thread():
+                    signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+                    signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+                self.consumer.start()
+            else:
+                self.mq_client.start_consuming(mq_channel, mq_exchange, queue_name)
+        finally:
+            self.set_ready(False)
+            self.close()
+
+    def close(self):
+        if self.notification_publisher is not None:
+            self.notification_publisher.close(timeout=float(os.environ.get("NOTIFICATION_DRAIN_TIMEOUT", "10")))
+            self.notification_publisher = None
+        if self.document_renderer is not None:
+            self.document_renderer.close()
+            self.document_renderer = None
+        # Closes the hedger and the case index too
+        self.p360_client.close()
+        if self.checkpoint_journal is not None:
+            self.checkpoint_journal.close()
+            self.checkpoint_journal = None
+
+    def create_lane_consumer(self, mq_channel, queue_name):
+        # Lønnsmelding messages are light and time sensitive, so by default their lane gets the higher priority and
+        # a small P360 share of its own, and onboarding gets the rest of the connection pool. Each lane consumes a
+        # queue of its own (MQ_<LANE>_QUEUE_NAME, provisioned and bound by the broker setup, see
+        # check_consumer_config) with its own prefetch window.
+        p360_pool_maxsize = int(os.environ.get("P360_POOL_MAXSIZE", "10"))
+        lonnsmelding_p360_concurrency = int(os.environ.get("P360_LONNSMELDING_CONCURRENCY", "2"))
+        onboarding_p360_concurrency = int(os.environ.get(
+            "P360_ONBOARDING_CONCURRENCY", str(max(1, p360_pool_maxsize - lonnsmelding_p360_concurrency))))
+        lanes = []
+        for event_type, default_worker_count, default_priority, p360_concurrency in (
+                (ONBOARDING_EVENT, 2, 0, onboarding_p360_concurrency),
+                (LONNSMELDING_EVENT, 1, 1, lonnsmelding_p360_concurrency)):
+            env_prefix = "MQ_" + event_type.upper() + "_"
+            worker_count = int(os.environ.get(env_prefix + "WORKER_COUNT", str(default_worker_count)))
+            lanes.append(Lane(event_type, worker_count=worker_count,
+                              prefetch_count=int(os.environ.get(env_prefix + "PREFETCH_COUNT", str(2 * worker_count))),
+                              priority=int(os.environ.get(env_prefix + "PRIORITY", str(default_priority))),
+                              queue_name=os.environ.get(env_prefix + "QUEUE_NAME") or None,
+                              p360_concurrency=p360_concurrency,
+                              p360_acquire_timeout=float(os.environ.get("P360_ACQUIRE_TIMEOUT", "30"))))
+
+        return LaneConsumer(log=self.log, channel=mq_channel, queue_name=queue_name,
+                            message_handler=self.handle_mq_message, lanes=lanes,
+                            lane_selector=get_message_event_type,
+                            shared_worker_count=int(os.environ.get("MQ_SHARED_WORKER_COUNT", "0")),
+                            drain_timeout=float(os.environ.get("MQ_DRAIN_TIMEOUT", "60")),
+                            requeue_delay=float(os.environ.get("MQ_REQUEUE_DELAY", "5")))
+
+    def connect_to_queue(self, mq_username, mq_password, mq_vhost, mq_exchange, queue_name, bind=True):
         mq_channel = self.mq_client.establish_mq_channel(mq_username, mq_password, mq_vhost)
-
-        self.mq_client.bind_to_queue(mq_channel, mq_exchange, queue_name)
-        self.mq_client.start_consuming(mq_channel, mq_exchange, queue_name)
+        if bind:
+            self.mq_client.bind_to_queue(mq_channel, mq_exchange, queue_name)
+        return mq_channel
+
+    def start_notification_publisher(self):
+        # With MQ_PERSISTENT_PUBLISHER, notifications are published on one long-lived connection with publisher
+        # confirms, instead of a connection and a blocking publish per notification (MqClient). Off by default:
+        # NOTIFICATION_ROUTING_KEY must match what MqClient publishes with, and the notifications are only buffered
+        # in memory when the message is acked, so a crash before they're confirmed loses them.
+        if os.environ.get("MQ_PERSISTENT_PUBLISHER", "false").lower() != "true":
+            return
+        from notification_publisher import NotificationPublisher
+        self.notification_publisher = NotificationPublisher(
+            log=self.log, host=self.config.get_mq_host(), port=self.config.get_mq_port(),
+            vhost=self.config.get_notification_vhost(), username=self.config.get_mq_username(),
+            password=self.config.get_mq_password(), exchange=self.config.get_notification_exchange_name(),
+            routing_key=os.environ.get("NOTIFICATION_ROUTING_KEY", ""),
+            buffer_size=int(os.environ.get("NOTIFICATION_BUFFER_SIZE", "10000")),
+            fallback=self.mq_client.emit_notification_message).start()
+
+    def emit_notification(self, message):
+        if self.notification_publisher is not None:
+            self.notification_publisher.publish(message)
+        else:
+            self.mq_client.emit_notification_message(message)
+
+    def stop(self):
+        self.log.info("Got a request to stop the server")
+        self.set_ready(False)
+        if self.consumer is not None:
+            self.consumer.stop()
+
+    def handle_mq_message(self, mq_message, routing_key=None):
+        event_type = get_event_type(mq_message, routing_key)
+        if event_type == LONNSMELDING_EVENT:
+            return self.handle_new_lonnsmelding(mq_message)
+        if event_type == ONBOARDING_EVENT:
+            return self.handle_new_onboarding(mq_message)
+        # Rejected by the consumer, not guessed at: an onboarding handler would fail on a lønnsmelding anyway
+        raise Exception("Unknown message type with routing key " + str(routing_key) +
+                        ". Set MQ_ONBOARDING_ROUTING_KEY and MQ_LONNSMELDING_ROUTING_KEY.")
 
     def get_new_onboarding_callback_function(self):
         return self.handle_new_onboarding
@@ -87,39 +465,73 @@ class Server:
         return self.handle_new_lonnsmelding
 
     def handle_new_lonnsmelding(self, mq_message):
+        return self.measure_message(LONNSMELDING_EVENT, self.process_new_lonnsmelding, mq_message)
+
+    def process_new_lonnsmelding(self, mq_message):
 
         responsible_person_email = None
 
         person_pnr = mq_message["FødselsOgPersonnummer"]
         person_name = mq_message["Navn"]
         access_group = mq_message["Enhet"] + " Personalmapper"
+        access_group_filter = access_group
 
 
-        incoming_document_path = "/resources/Lonnsmelding.docx"
+        incoming_document_path = LONNSMELDING_TEMPLATE_PATH
 
         today = datetime.datetime.now().strftime("%Y-%m-%d")
-        document_result_path = "/result/generated_lonnsmelding_" + person_pnr + "-" + today +".docx"
+        document_debug_sink_path = self.get_debug_sink_path("generated_lonnsmelding_" + person_pnr + "-" + today + ".docx")
         document_title = "Melding til Lønn"
 
-        try:
-            self.generate_docx_file(mq_message, incoming_document_path, document_result_path)
+        # Steps that were done before this message was redelivered are skipped
+        checkpoints = self.get_message_checkpoints(mq_message)
+        if checkpoints.is_completed():
+            self.notify_already_processed(checkpoints, "lønnsmelding", person_name, "p360lonnsmeldingCreated")
+            return True
 
-            try:
-                p360_case = self.p360_client.get_case_by_pnr_and_access_group(pnr=person_pnr, access_group_filter=access_group)
-            except Exception as e:
-                raise RuntimeError("Something went wrong when querying P360 for existing cases. Error message: " + str(e))
+        document_render = None
+        p360_case = None
 
-            if p360_case is not None:
-                self.log.info("Found an existing case with recno " + str(p360_case.get_recno()))
+        try:
+            # The document renders while we look up the case
+            if not checkpoints.is_done("upload"):
+                document_render = self.start_docx_file_generation(mq_message, incoming_document_path,
+                                                                  document_debug_sink_path)
+
+            saved_case = checkpoints.get("case")
+            if saved_case is not None:
+                p360_case = P360Case(**saved_case)
             else:
-                raise RuntimeError("Couldn't find any existing cases on the new employee with prn " + str(person_pnr))
+                try:
+                    with self.measure_stage("lookup"):
+                        p360_case = self.p360_client.get_case_by_pnr_and_access_group(pnr=person_pnr, access_group_filter=access_group_filter)
+                except (RetryableError, DeadlineExceededError):
+                    raise
+                except Exception as e:
+                    raise RuntimeError("Something went wrong when querying P360 for existing cases. Error message: " + str(e))
+
+                if p360_case is not None:
+                    self.log.info("Found an existing case with recno " + str(p360_case.get_recno()))
+                else:
+                    raise RuntimeError("Couldn't find any existing cases on the new employee with access group " +
+                                       access_group_filter)
+
+                checkpoints.record("case", {"case_number": p360_case.get_case_number(),
+                                            "case_recno": p360_case.get_recno(),
+                                            "responsible_person_email": p360_case.get_responsible_person_email(),
+                                            "responsible_person_recno": p360_case.get_responsible_person_recno(),
+                                            "access_group": p360_case.get_access_group()})
 
             responsible_person_email = p360_case.get_responsible_person_email()
             responsible_person_recno = p360_case.get_responsible_person_recno()
             access_group = p360_case.get_access_group()
             case_number = p360_case.get_case_number()
 
-            documents_folder_number = self.get_p360_document_folder(document_title, p360_case.get_case_number())
+            documents_folder_number = checkpoints.get("document_folder")
+            if documents_folder_number is not None:
+                self.log.info("The document folder " + str(documents_folder_number) + " was set up before")
+            else:
+                documents_folder_number = self.get_p360_document_folders([document_title], case_number)[document_title]
             if documents_folder_number is None:
                 self.log.info("No existing documents folder found. Will now create a new one called \"" + document_title + "\"")
 
@@ -128,22 +540,26 @@ class Server:
                 access_code = 18  # POP UO/Untatt offentlighet
                 paragraph = "Offl § 26 femte ledd"  # POP "only code value is permitted"
 
-                documents_folder_number = self.create_p360_documents_folder(access_code,    # POP
-                                                                            paragraph,      # POP
-                                                                            access_group,
+                documents_folder_number = self.create_p360_documents_folder(access_group,
                                                                             case_document_category,
                                                                             case_document_status,
                                                                             document_title,
                                                                             case_number,
-                                                                            responsible_person_recno)
+                                                                            responsible_person_recno,
+                                                                            access_code=access_code,    # POP
+                                                                            paragraph=paragraph)        # POP
             else:
                 self.log.info("Existing document folder with number " + str(documents_folder_number) +
                               " found. No need to create a new one")
 
             assert documents_folder_number is not None
+            checkpoints.record("document_folder", documents_folder_number)
 
-            document_file_object = self.generate_documents_file_object(document_result_path, "Melding til Lønn for " + person_name)
-            self.upload_file_to_p360(document_file_object, documents_folder_number)
+            if document_render is not None:
+                document_contents = self.wait_for_docx_file(document_render, mq_message)
+                document_file_object = self.generate_documents_file_object(document_contents, "Melding til Lønn for " + person_name)
+                self.upload_file_to_p360(document_file_object, documents_folder_number)
+                checkpoints.record("upload")
 
             assert responsible_person_email is not None
 
@@ -151,9 +567,16 @@ class Server:
                                       person_name=person_name,
                                       responsible_user_email=responsible_person_email,
                                       event_name="p360lonnsmeldingCreated")
+            checkpoints.complete({"case_number": p360_case.get_case_number(), "case_recno": p360_case.get_recno(),
+                                  "responsible_user_email": responsible_person_email})
 
         except Exception as e:
 
+            # P360 is overloaded or down. A consumer that can requeue the message gets the error, and there's no
+            # error notification. MqClient can't requeue, so there it fails like any other error.
+            if isinstance(e, RetryableError) and self.requeue_retryable_errors:
+                raise
+
             outgoing_mq_message = {
                 "event": "error",
                 "data": {
@@ -167,21 +590,84 @@ class Server:
             if responsible_person_email is not None:
                 outgoing_mq_message["data"]["email_recipient"] = responsible_person_email
 
-            self.log.error("Something went wrong. Error message: " + str(e))
-            self.mq_client.emit_notification_message(outgoing_mq_message)
+            # The case may have come from the case index (or the journal) and be out of date, e.g. moved, closed or
+            # given a new responsible person. The next message for this person looks it up in P360 again.
+            if p360_case is not None and not isinstance(e, RetryableError):
+                self.p360_client.invalidate_case_by_pnr_and_access_group(person_pnr, access_group_filter)
+                checkpoints.forget("case")
+                checkpoints.forget("document_folder")
+
+            self.record_error(e)
+            self.log.error("Something went wrong. Error message: %s, exception type %s", LogValue(e), type(e).__name__)
+            with self.measure_stage("notify"):
+                self.emit_notification(outgoing_mq_message)
             return False
 
         return True
 
-    def handle_new_onboarding(self, mq_message):
+    def handle_new_onboarding(self, mq_message, checkpoints=None):
+        return self.measure_message(ONBOARDING_EVENT,
+                                    lambda message: asyncio.run(self.process_new_onboarding(message, checkpoints)),
+                                    mq_message)
+
+    def measure_message(self, event_type, process_message, mq_message):
+        # Times the whole message, and the stages within it (see measure_stage). Ends with one summary log line
+        # per message. The message's deadline starts here.
+        message_timings = MessageTimings(event_type)
+        token = current_message_timings.set(message_timings)
+        deadline_token = current_deadline.set(Deadline(self.message_deadline_seconds)
+                                              if self.message_deadline_seconds > 0 else None)
+        successful = False
+        outcome = "failure"
+        try:
+            successful = process_message(mq_message)
+            if successful:
+                outcome = "success"
+            elif isinstance(message_timings.error, DeadlineExceededError):
+                outcome = "deadline_exceeded"
+            return successful
+        except RetryableError as e:
+            message_timings.set_error(e)
+            outcome = "retry"
+            raise
+        finally:
+            current_deadline.reset(deadline_token)
+            current_message_timings.reset(token)
+            MESSAGE_DURATION.observe(message_timings.get_elapsed(), event_type=event_type, outcome=outcome)
+            self.log.info("Message summary: " + json.dumps(message_timings.get_summary(outcome)))
+
+    @contextlib.contextmanager
+    def measure_stage(self, stage):
+        # Every stage but the notification first checks that the message still has time left
+        if stage != "notify":
+            check_deadline("the " + stage + " stage")
+        message_timings = current_message_timings.get()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(message_timings, stage, time.perf_counter() - start)
+
+    def record_error(self, error):
+        message_timings = current_message_timings.get()
+        if message_timings is not None:
+            message_timings.set_error(error)
 
-        self.log.info("Processing this incoming message: " + str(mq_message))
+    def record_stage(self, message_timings, stage, seconds):
+        event_type = message_timings.event_type if message_timings is not None else "none"
+        STAGE_DURATION.observe(seconds, event_type=event_type, stage=stage)
+        if message_timings is not None:
+            message_timings.record(stage, seconds)
+
+    async def process_new_onboarding(self, mq_message, checkpoints=None):
+
+        self.log.info("Processing this incoming message: %s", LogValue(mq_message))
         person_name = mq_message["Navn"]
         person_pnr = mq_message["FødselsOgPersonnummer"]
         responsible_user_email = mq_message["DinEpostadresse"]
         unit = mq_message["Enhet"]
         access_group = unit + " Personalmapper"
-        new_case_name = "Personalmappe offentlig - " + person_name + " - " + unit
+        new_case_name = get_onboarding_case_title(mq_message)
         case_arbeidsavtale_document_title = "Arbeidsavtale"
         case_hta_document_title = "Hovedtariffavtale"
         case_welcome_letter_document_title = "Velkomstbrev"
@@ -193,129 +679,135 @@ class Server:
 
         today = datetime.datetime.now().strftime("%Y-%m-%d")
 
-        terms_of_employment_document_result_path = "/result/generated_arbeidsavtale_" + \
-                                                   person_pnr + "_" + today + ".docx"
+        terms_of_employment_debug_sink_path = self.get_debug_sink_path("generated_arbeidsavtale_" +
+                                                                       person_pnr + "_" + today + ".docx")
 
         if mq_message["ArbeidsavtaleLanguage"] == "Engelsk":
-            terms_of_employment_incoming_document_path = "/resources/Arbeidsavtale_engelsk.docx"
+            terms_of_employment_incoming_document_path = ARBEIDSAVTALE_ENGELSK_TEMPLATE_PATH
         else:
-            terms_of_employment_incoming_document_path = "/resources/Arbeidsavtale_norsk.docx"
+            terms_of_employment_incoming_document_path = ARBEIDSAVTALE_NORSK_TEMPLATE_PATH
+
+        collective_bargaining_incoming_document_path = HOVEDTARIFFAVTALE_TEMPLATE_PATH
+        welcome_letter_incoming_document_path = VELKOMSTBREV_TEMPLATE_PATH
+
+        collective_bargaining_debug_sink_path = self.get_debug_sink_path("generated_hovedtariffavtale_" + person_pnr + "_" + today + ".docx")
+        welcome_letter_debug_sink_path = self.get_debug_sink_path("generated_welcome_letter_" + person_pnr + "_" + today + ".docx")
 
-        collective_bargaining_incoming_document_path = "/resources/Hovedtariffavtale.docx"
-        welcome_letter_incoming_document_path = "/resources/Velkomstbrev.docx"
+        # Steps that were done before this message was redelivered are skipped. A bulk import passes in checkpoints
+        # with the lookups it has already done for the whole batch.
+        if checkpoints is None:
+            checkpoints = self.get_message_checkpoints(mq_message)
+        if checkpoints.is_completed():
+            self.notify_already_processed(checkpoints, "onboarding", person_name, "p360caseCreated")
+            return True
 
-        collective_bargaining_document_result_path = "/result/generated_hovedtariffavtale_" + person_pnr + "_" + today + ".docx"
-        welcome_letter_document_result_path = "/result/generated_welcome_letter_" + person_pnr + "_" + today + ".docx"
+        # Limits how many P360 calls this message may have in flight at the same time
+        p360_call_limit = asyncio.Semaphore(self.p360_concurrency_per_message)
+
+        render_tasks = {}
 
         try:
-            self.generate_docx_file(mq_message, terms_of_employment_incoming_document_path, terms_of_employment_document_result_path)
-            self.log.info(
-                "Successfully created the document " + terms_of_employment_document_result_path + ".")
+            # The terms of employment don't depend on anything from P360, so they render while the lookups are in flight
+            if not checkpoints.is_done("upload:" + case_arbeidsavtale_document_title):
+                render_tasks[case_arbeidsavtale_document_title] = asyncio.ensure_future(
+                    self.generate_docx_file_async(mq_message, terms_of_employment_incoming_document_path,
+                                                  terms_of_employment_debug_sink_path))
 
-            responsible_contact = self.get_p360_contact_person_by_email(responsible_user_email)
-            responsible_recno = responsible_contact.get_recno()
+            # The contact lookup and the case lookup don't depend on each other
+            responsible_recno, p360_case = await asyncio.gather(
+                self.get_responsible_recno_step(checkpoints, p360_call_limit, responsible_user_email),
+                self.get_case_by_title_step(checkpoints, p360_call_limit, new_case_name))
 
-            p360_case = self.get_p360_case_by_title(new_case_name)
             if p360_case is None:
                 self.log.info("No existing case found. Will now create a new case with title \"" + new_case_name + "\"")
-                p360_case = self.create_p360_case(access_group, new_case_name, person_pnr, responsible_recno)
+                p360_case = await self.run_p360_call(p360_call_limit, self.create_p360_case, access_group,
+                                                     new_case_name, person_pnr, responsible_recno,
+                                                     responsible_user_email=responsible_user_email)
+                checkpoints.record("case", {"case_number": p360_case.get_case_number(),
+                                            "case_recno": p360_case.get_recno()})
             else:
                 self.log.info("Existing case with case number " + str(p360_case.get_case_number()) + " found. No need to create a new one")
 
             case_number = p360_case.get_case_number()
             case_recno = p360_case.get_recno()
 
-            # POP Velkomstbrev lagt først
-            welcome_letter_documents_folder_number = self.get_p360_document_folder(case_welcome_letter_document_title,
-                                                                                   case_number)
-
-            if welcome_letter_documents_folder_number is None:
-                self.log.info(
-                    "No existing documents folder found. Will now create a new one called \"" + case_welcome_letter_document_title + "\"")
-
-                welcome_letter_documents_folder_number = self.create_p360_documents_folder(access_group,
-                                                                                           case_document_category,
-                                                                                           case_document_status,
-                                                                                           case_welcome_letter_document_title,
-                                                                                           case_number,
-                                                                                           responsible_recno)
-            else:
-                self.log.info("Existing document folder with number " + str(
-                    welcome_letter_documents_folder_number) + " found. No need to create a new one")
-
-            arbeidsavtale_documents_folder_number = self.get_p360_document_folder(case_arbeidsavtale_document_title, case_number)
-
-            if arbeidsavtale_documents_folder_number is None:
-                self.log.info("No existing documents folder found. Will now create a new one called \"" + case_arbeidsavtale_document_title + "\"")
-
-                arbeidsavtale_documents_folder_number = self.create_p360_documents_folder(access_code, paragraph, access_group, case_document_category,
-                                                                            case_document_status, case_arbeidsavtale_document_title,
-                                                                            case_number, responsible_recno)
-            else:
-                self.log.info("Existing document folder with number " + str(arbeidsavtale_documents_folder_number) + " found. No need to create a new one")
-
-            hta_documents_folder_number = self.get_p360_document_folder(case_hta_document_title, case_number)
-
-            if hta_documents_folder_number is None:
-                self.log.info(
-                    "No existing documents folder found. Will now create a new one called \"" + case_hta_document_title + "\"")
-
-                hta_documents_folder_number = self.create_p360_documents_folder(access_group,
-                                                                                case_document_category,
-                                                                                case_document_status,
-                                                                                case_hta_document_title,
-                                                                                case_number,
-                                                                                responsible_recno)
-            else:
-                self.log.info("Existing document folder with number " + str(
-                    hta_documents_folder_number) + " found. No need to create a new one")
-
-
-
-            # We'll generate more files, but first let's add some data
+            # The other two documents need the case number. They render while the document folders are set up.
             enriched_mq_message = mq_message.copy()
             enriched_mq_message["p360_case_number"] = case_number
             enriched_mq_message["date"] = utils.get_current_date_as_string()
 
-            try:
-                self.generate_docx_file(enriched_mq_message, collective_bargaining_incoming_document_path,
-                                        collective_bargaining_document_result_path)
-            except Exception as e:
-                self.log.error("Something went wrong when creating a .docx-file based on this MQ message: " + str(
-                    mq_message) + ". Error message: " + str(e))
-                raise
-
-            try:
-                self.generate_docx_file(enriched_mq_message, welcome_letter_incoming_document_path,
-                                        welcome_letter_document_result_path)
-            except Exception as e:
-                self.log.error("Something went wrong when creating a .docx-file based on this MQ message: " + str(
-                    mq_message) + ". Error message: " + str(e))
-                raise
-
-            # Convert the generated docx-files to JSON objects, in which the docx-files content
-            # are represented in ascii format.
-            terms_of_employment_document_file_object = self.generate_documents_file_object(terms_of_employment_document_result_path, "Arbeidsavtale for " + person_name)
-            hta_document_file_object = self.generate_documents_file_object(collective_bargaining_document_result_path, "Hovedtariffavtale for " + person_name)
-            welcome_letter_document_file_object = self.generate_documents_file_object(welcome_letter_document_result_path, "Velkomstbrev for " + person_name)
-
-            assert welcome_letter_document_file_object is not None
-            assert welcome_letter_document_result_path is not None
-
-            self.upload_file_to_p360(terms_of_employment_document_file_object, arbeidsavtale_documents_folder_number)
-            self.upload_file_to_p360(hta_document_file_object, hta_documents_folder_number)
-            self.upload_file_to_p360(welcome_letter_document_file_object, welcome_letter_documents_folder_number)
+            if not checkpoints.is_done("upload:" + case_hta_document_title):
+                render_tasks[case_hta_document_title] = asyncio.ensure_future(
+                    self.generate_docx_file_async(enriched_mq_message, collective_bargaining_incoming_document_path,
+                                                  collective_bargaining_debug_sink_path))
+            if not checkpoints.is_done("upload:" + case_welcome_letter_document_title):
+                render_tasks[case_welcome_letter_document_title] = asyncio.ensure_future(
+                    self.generate_docx_file_async(enriched_mq_message, welcome_letter_incoming_document_path,
+                                                  welcome_letter_debug_sink_path))
+
+            document_folder_numbers = checkpoints.get("document_folders")
+            if document_folder_numbers is None:
+                # One lookup for all three document folders. The missing ones are created side by side.
+                document_folder_numbers = await self.run_p360_call(p360_call_limit, self.get_p360_document_folders,
+                                                                   [case_welcome_letter_document_title,
+                                                                    case_arbeidsavtale_document_title,
+                                                                    case_hta_document_title],
+                                                                   case_number)
+
+                welcome_letter_documents_folder_number, arbeidsavtale_documents_folder_number, hta_documents_folder_number = \
+                    await self.gather_settled(
+                        self.create_p360_documents_folder_if_missing(p360_call_limit, document_folder_numbers,
+                                                                     case_welcome_letter_document_title, case_number,
+                                                                     access_group, case_document_category,
+                                                                     case_document_status, responsible_recno),
+                        self.create_p360_documents_folder_if_missing(p360_call_limit, document_folder_numbers,
+                                                                     case_arbeidsavtale_document_title, case_number,
+                                                                     access_group, case_document_category,
+                                                                     case_document_status, responsible_recno,
+                                                                     access_code=access_code, paragraph=paragraph),
+                        self.create_p360_documents_folder_if_missing(p360_call_limit, document_folder_numbers,
+                                                                     case_hta_document_title, case_number,
+                                                                     access_group, case_document_category,
+                                                                     case_document_status, responsible_recno))
+
+                document_folder_numbers = {case_welcome_letter_document_title: welcome_letter_documents_folder_number,
+                                           case_arbeidsavtale_document_title: arbeidsavtale_documents_folder_number,
+                                           case_hta_document_title: hta_documents_folder_number}
+                checkpoints.record("document_folders", document_folder_numbers)
+
+            # Each document is uploaded as soon as it's rendered. The generated docx-files are converted to JSON
+            # objects, in which the docx-files content are represented in ascii format.
+            await self.gather_settled(
+                self.upload_document_step(checkpoints, p360_call_limit, render_tasks,
+                                          case_arbeidsavtale_document_title, "Arbeidsavtale for " + person_name,
+                                          document_folder_numbers[case_arbeidsavtale_document_title]),
+                self.upload_document_step(checkpoints, p360_call_limit, render_tasks,
+                                          case_hta_document_title, "Hovedtariffavtale for " + person_name,
+                                          document_folder_numbers[case_hta_document_title]),
+                self.upload_document_step(checkpoints, p360_call_limit, render_tasks,
+                                          case_welcome_letter_document_title, "Velkomstbrev for " + person_name,
+                                          document_folder_numbers[case_welcome_letter_document_title]))
+            self.log.info("Successfully created the documents " + case_arbeidsavtale_document_title + ", " +
+                          case_hta_document_title + " and " + case_welcome_letter_document_title + ".")
 
             self.emit_mq_notification(case_number=case_number, case_recno=case_recno, person_name=person_name,
                                       responsible_user_email=responsible_user_email, event_name="p360caseCreated")
+            checkpoints.complete({"case_number": case_number, "case_recno": case_recno,
+                                  "responsible_user_email": responsible_user_email})
 
         except Exception as e:
 
+            # P360 is overloaded or down. A consumer that can requeue the message gets the error, and there's no
+            # error notification. MqClient can't requeue, so there it fails like any other error.
+            if isinstance(e, RetryableError) and self.requeue_retryable_errors:
+                raise
+
             assert responsible_user_email is not None
             assert person_name is not None
 
-            self.log.error("Something went wrong. Error message: \"" + str(e) + "\", exception type " + str(type(e)) +
-                           " . Will emit an MQ message.")
+            self.record_error(e)
+            self.log.error("Something went wrong. Error message: \"%s\", exception type %s. Will emit an MQ message.",
+                           LogValue(e), type(e))
             outgoing_mq_message = {
                 "event": "error",
                 "data": {
@@ -323,11 +815,103 @@ class Server:
                     "message": "Noe gikk galt ved opprettelse av ny personalmappe for " + person_name + "."
                 }
             }
-            self.mq_client.emit_notification_message(outgoing_mq_message)
+            with self.measure_stage("notify"):
+                self.emit_notification(outgoing_mq_message)
             return False
 
+        finally:
+            await self.cancel_unfinished_tasks(list(render_tasks.values()))
+
         return True
 
+    def get_message_checkpoints(self, mq_message):
+        return MessageCheckpoints(self.checkpoint_journal, mq_message, current_message_id.get())
+
+    def notify_already_processed(self, checkpoints, event_type, person_name, event_name):
+        # The same message (a redelivery, or an identical resubmission without a message id of its own) was
+        # processed within CHECKPOINT_COMPLETED_RETENTION. Nothing is done in P360 again, but the sender still gets
+        # the notification.
+        self.log.warning("The " + event_type + " of " + person_name + " has already been processed. Skipping it and "
+                         "sending the notification again.")
+        completed = checkpoints.get_completed()
+        if completed is None:
+            self.log.warning("The journal has no case for the " + event_type + " of " + person_name +
+                             ". No notification is sent.")
+            return
+        self.emit_mq_notification(case_number=completed["case_number"], case_recno=completed["case_recno"],
+                                  person_name=person_name, responsible_user_email=completed["responsible_user_email"],
+                                  event_name=event_name)
+
+    async def gather_settled(self, *awaitables):
+        # Like asyncio.gather, but when one fails, the others are waited for before the first error is raised. A P360
+        # call that's running on a thread can't be cancelled, so it's left to finish and record its checkpoint.
+        results = await asyncio.gather(*awaitables, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def get_responsible_recno_step(self, checkpoints, p360_call_limit, responsible_user_email):
+        responsible_recno = checkpoints.get("responsible_recno")
+        if responsible_recno is None:
+            responsible_contact = await self.run_p360_call(p360_call_limit, self.get_p360_contact_person_by_email,
+                                                           responsible_user_email)
+            responsible_recno = responsible_contact.get_recno()
+            checkpoints.record("responsible_recno", responsible_recno)
+        return responsible_recno
+
+    async def get_case_by_title_step(self, checkpoints, p360_call_limit, new_case_name):
+        saved_case = checkpoints.get("case")
+        if saved_case is not None:
+            return P360Case(case_number=saved_case["case_number"], case_recno=saved_case["case_recno"])
+
+        p360_case = await self.run_p360_call(p360_call_limit, self.get_p360_case_by_title, new_case_name)
+        if p360_case is not None:
+            checkpoints.record("case", {"case_number": p360_case.get_case_number(),
+                                        "case_recno": p360_case.get_recno()})
+        return p360_case
+
+    async def upload_document_step(self, checkpoints, p360_call_limit, render_tasks, case_document_title,
+                                   file_title, documents_folder_number):
+        if checkpoints.is_done("upload:" + case_document_title):
+            self.log.info("The document " + case_document_title + " has already been uploaded")
+            return
+
+        document_contents = await render_tasks[case_document_title]
+        document_file_object = self.generate_documents_file_object(document_contents, file_title)
+        await self.run_p360_call(p360_call_limit, self.upload_file_to_p360, document_file_object,
+                                 documents_folder_number)
+        checkpoints.record("upload:" + case_document_title)
+
+    async def cancel_unfinished_tasks(self, tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run_p360_call(self, p360_call_limit, function, *args, **kwargs):
+        async with p360_call_limit:
+            return await self.async_p360_client.run(function, *args, **kwargs)
+
+    async def create_p360_documents_folder_if_missing(self, p360_call_limit, document_folder_numbers,
+                                                      case_document_title, case_number, access_group,
+                                                      case_document_category, case_document_status, responsible_recno,
+                                                      access_code=None, paragraph=None):
+        documents_folder_number = document_folder_numbers[case_document_title]
+
+        if documents_folder_number is None:
+            self.log.info("No existing documents folder found. Will now create a new one called \"" +
+                          case_document_title + "\"")
+            documents_folder_number = await self.run_p360_call(p360_call_limit, self.create_p360_documents_folder,
+                                                               access_group, case_document_category,
+                                                               case_document_status, case_document_title, case_number,
+                                                               responsible_recno, access_code=access_code,
+                                                               paragraph=paragraph)
+        else:
+            self.log.info("Existing document folder with number " + str(documents_folder_number) +
+                          " found. No need to create a new one")
+
+        return documents_folder_number
+
     def emit_mq_notification(self, case_number, case_recno, person_name, responsible_user_email, event_name):
 
         web_link = self.config.get_p360_web_base_uri() + "?recno=" + str(
@@ -344,16 +928,19 @@ class Server:
             }
         }
 
-        self.mq_client.emit_notification_message(data)
+        with self.measure_stage("notify"):
+            self.emit_notification(data)
 
-    def create_p360_case(self, access_group, new_case_name, person_pnr, responsible_recno):
+    def create_p360_case(self, access_group, new_case_name, person_pnr, responsible_recno, responsible_user_email=None):
         try:
-            p360_case = self.p360_client.create_case(case_title=new_case_name,
-                                                     responsible_person_recno=responsible_recno,
-                                                     access_group=access_group, pnr=person_pnr)
+            with self.measure_stage("create"):
+                p360_case = self.p360_client.create_case(case_title=new_case_name,
+                                                         responsible_person_recno=responsible_recno,
+                                                         access_group=access_group, pnr=person_pnr,
+                                                         responsible_person_email=responsible_user_email)
 
         except Exception as e:
-            self.log.error("Something went wrong when creating the new P360 case. Error message: " + str(e))
+            self.log.error("Something went wrong when creating the new P360 case. Error message: %s", LogValue(e))
             raise
 
         if p360_case is not None:
@@ -363,7 +950,10 @@ class Server:
 
     def get_p360_contact_person_by_email(self, responsible_user_email):
         try:
-            responsible_recno = self.p360_client.get_contact_person_by_email(user_email=responsible_user_email)
+            with self.measure_stage("lookup"):
+                responsible_recno = self.p360_client.get_contact_person_by_email(user_email=responsible_user_email)
+        except (RetryableError, DeadlineExceededError):
+            raise
         except Exception as e:
             raise Exception("Something went wrong when fetching responsible recno from username " +
                             responsible_user_email + ". Error message: " + str(e))
@@ -378,10 +968,11 @@ class Server:
 
     def get_p360_case_by_title(self, new_case_name):
         try:
-            p360_case = self.p360_client.get_case_by_title(case_title=new_case_name)
+            with self.measure_stage("lookup"):
+                p360_case = self.p360_client.get_case_by_title(case_title=new_case_name)
         except Exception as e:
-            self.log.error("The P360 client returned this error message when looking up case by title: " + str(e) +
-                           ". Exception type is " + str(type(e)))
+            self.log.error("The P360 client returned this error message when looking up case by title: %s. "
+                           "Exception type is %s", LogValue(e), type(e))
             raise  # Re-raise the current exception
 
         if p360_case is not None:
@@ -389,29 +980,40 @@ class Server:
 
         return p360_case
 
-    def generate_documents_file_object(self, document_path, title):
-        self.log.debug("Converting contents of " + document_path + " to ASCII text")
-        file_contents_as_ascii_text = utils.convert_file_contents_to_ASCII_text(document_path)
+    def generate_documents_file_object(self, document_contents, title):
+        # The contents are converted to ASCII text by the P360 client while they're uploaded, unless
+        # P360_STREAMING_UPLOADS is turned off. Only then is there an encode stage; otherwise it's part of the upload.
+        if self.streaming_uploads:
+            data = document_contents
+        else:
+            self.log.debug("Converting contents of " + title + " to ASCII text")
+            with self.measure_stage("encode"):
+                data = base64.b64encode(document_contents).decode("ascii")
         document_file_object = {"title": title,
                                 "format": "docx",
-                                "data": file_contents_as_ascii_text}
+                                "data": data}
         return document_file_object
 
     def create_p360_documents_folder(self, access_group, case_document_category, case_document_status,   ## POP lagt til access_code og paragraph
-                                     case_document_title, case_number, responsible_recno):
+                                     case_document_title, case_number, responsible_recno, access_code=None,
+                                     paragraph=None):
         try:
-            document_folder_recno, documents_folder_number = self.p360_client.create_document_folder(
-                folder_name=case_document_title,
-                category=case_document_category,
-                status=case_document_status,
-                case_number=case_number,
-                responsible_recno=responsible_recno,
-                access_group=access_group)
+            with self.measure_stage("create"):
+                document_folder_recno, documents_folder_number = self.p360_client.create_document_folder(
+                    folder_name=case_document_title,
+                    category=case_document_category,
+                    status=case_document_status,
+                    case_number=case_number,
+                    responsible_recno=responsible_recno,
+                    access_code=access_code,
+                    paragraph=paragraph,
+                    access_group=access_group)
             self.log.info(
                 "Successfully create a new documents folder \"" + case_document_title + "\" with recno " + str(
                     document_folder_recno))
         except Exception as e:
-            self.log.error("Something went wrong when creating the new P360 document folder. Error message: " + str(e))
+            self.log.error("Something went wrong when creating the new P360 document folder. Error message: %s",
+                           LogValue(e))
             raise
         return documents_folder_number
 
@@ -419,36 +1021,76 @@ class Server:
         document_title = document_file_object["title"]
         self.log.info("Will now upload the generated docx-file \"" + document_title + "\" to document number " + documents_folder_number)
         try:
-            self.p360_client.upload_file(document_number=documents_folder_number, file_object=document_file_object)
+            with self.measure_stage("upload"):
+                self.p360_client.upload_file(document_number=documents_folder_number, file_object=document_file_object)
 
         except Exception as e:
-            self.log.error("Something went wrong when uploading the document " + str(documents_folder_number) +
-                           " to Public 360. Error message: " + str(e))
+            self.log.error("Something went wrong when uploading the document %s to Public 360. Error message: %s",
+                           documents_folder_number, LogValue(e))
             raise  # Re-raise current exception
 
-    def generate_docx_file(self, mq_message, incoming_document_path, generated_document_path):
+    def get_debug_sink_path(self, file_name):
+        # Generated documents are only written to disk when a debug sink directory is configured
+        if self.document_debug_sink_dir is None:
+            return None
+        return os.path.join(self.document_debug_sink_dir, file_name)
+
+    def generate_docx_file(self, mq_message, incoming_document_path, debug_sink_path=None):
+        render = self.start_docx_file_generation(mq_message, incoming_document_path, debug_sink_path)
+        return self.wait_for_docx_file(render, mq_message)
+
+    def start_docx_file_generation(self, mq_message, incoming_document_path, debug_sink_path=None):
+        # The render stage is timed from submitting the render until it's done, queueing for a worker included
+        message_timings = current_message_timings.get()
+        start = time.perf_counter()
+        render = self.document_renderer.submit(mq_message, incoming_document_path, debug_sink_path)
+        render.add_done_callback(
+            lambda future: self.record_stage(message_timings, "render", time.perf_counter() - start))
+        return render
+
+    def wait_for_docx_file(self, render, mq_message):
         try:
-            self.document_creator.create_docx_file(mq_message,
-                                                   incoming_document_path,
-                                                   generated_document_path)
+            return render.result(timeout=self.get_render_timeout())
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceededError("The message deadline was exceeded while rendering a document")
         except Exception as e:
-            self.log.error("Something went wrong when creating a .docx-file based on this MQ message: " + str(
-                mq_message) + ". Error message: " + str(e))
+            self.log.error("Something went wrong when creating a .docx-file based on this MQ message: %s. Error message: %s",
+                           LogValue(mq_message), e)
             raise
 
-    def get_p360_document_folder(self, case_document_title, case_number):
-        self.log.info("Looking to see if there's already a documents folder named " +
-                      case_document_title + " registered in P360.")
+    async def generate_docx_file_async(self, mq_message, incoming_document_path, debug_sink_path=None):
         try:
-            documents_folder_number = self.p360_client.get_document_folder(
-                folder_name=case_document_title, document_number=case_number)
-            self.log.info("Found a documents folder with number " + str(documents_folder_number))
+            return await asyncio.wait_for(
+                asyncio.wrap_future(self.start_docx_file_generation(mq_message, incoming_document_path,
+                                                                    debug_sink_path)),
+                self.get_render_timeout())
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError("The message deadline was exceeded while rendering a document")
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            self.log.error(
-                "Something went wrong when querying P360 for existing document folders. Error message: " + str(e))
+            self.log.error("Something went wrong when creating a .docx-file based on this MQ message: %s. Error message: %s",
+                           LogValue(mq_message), e)
             raise
 
-        return documents_folder_number
-
+    def get_render_timeout(self):
+        # None (no limit) without a deadline
+        deadline = current_deadline.get()
+        if deadline is None:
+            return None
+        return max(0, deadline.remaining())
 
+    def get_p360_document_folders(self, case_document_titles, case_number):
+        self.log.info("Looking to see if there are already documents folders named " +
+                      ", ".join(case_document_titles) + " registered in P360.")
+        try:
+            with self.measure_stage("lookup"):
+                documents_folder_numbers = self.p360_client.get_document_folders(
+                    case_number=case_number, folder_names=case_document_titles)
+            self.log.info("Found these documents folders: " + str(documents_folder_numbers))
+        except Exception as e:
+            self.log.error("Something went wrong when querying P360 for existing document folders. Error message: %s",
+                           LogValue(e))
+            raise
 
+        return documents_folder_numbers
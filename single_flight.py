@@ -0,0 +1,81 @@
+# Stdlibs
+import threading
+import contextlib
+from concurrent.futures import Future, TimeoutError
+
+# Custom code
+from errors import DeadlineExceededError
+from deadline import current_deadline, check_deadline
+
+
+class SingleFlight:
+
+    # Merges identical calls that are in flight at the same time. The first caller for a key runs the function;
+    # callers that come while it runs wait for it and get the same result, or the same exception.
+    #
+    # A waiter waits no longer than its own message deadline. If the first caller ran out of its deadline, the
+    # waiters don't inherit that: one of them runs the function again, with the time it has left.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        # Returns (result, shared), where shared tells if the result came from another caller's call
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Future()
+            if leader:
+                break
+
+            deadline = current_deadline.get()
+            try:
+                return call.result(timeout=deadline.remaining() if deadline is not None else None), True
+            except TimeoutError:
+                raise DeadlineExceededError("The message deadline of " + str(deadline.seconds) + " seconds was "
+                                            "exceeded waiting for an identical call")
+            except DeadlineExceededError:
+                check_deadline("an identical call could be retried")
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class KeyedLock:
+
+    # One lock per key, created when it's needed and removed when no one holds or waits for it
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        # Yields True if another thread held the lock and we had to wait for it
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        waited = not entry[0].acquire(blocking=False)
+        if waited:
+            entry[0].acquire()
+        try:
+            yield waited
+        finally:
+            entry[0].release()
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
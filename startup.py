@@ -0,0 +1,49 @@
+# Stdlibs
+import time
+import threading
+import contextlib
+
+# Custom code
+from metrics import REGISTRY
+
+STARTUP_DURATION = REGISTRY.gauge("server_startup_seconds", "How long each part of starting the server took",
+                                  ("part",))
+SERVER_READY = REGISTRY.gauge("server_ready", "1 once the server is warmed up and consuming messages")
+
+
+class StartupTimings:
+
+    # How long each part of starting the server took. Parts run side by side overlap, so they can add up to more
+    # than the total.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.parts = {}
+        self.lock = threading.Lock()
+
+    def record(self, part, seconds):
+        with self.lock:
+            self.parts[part] = seconds
+        STARTUP_DURATION.set(seconds, part=part)
+
+    @contextlib.contextmanager
+    def measure(self, part):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(part, time.perf_counter() - start)
+
+    def start_thread(self, part, function, *args):
+        # Runs function on a thread of its own, measured as part. Join the thread before relying on the result.
+        def run():
+            with self.measure(part):
+                function(*args)
+
+        thread = threading.Thread(target=run, name="startup-" + part)
+        thread.start()
+        return thread
+
+    def get_summary(self):
+        with self.lock:
+            parts = {part: round(seconds, 4) for part, seconds in self.parts.items()}
+        return {"seconds": round(time.perf_counter() - self.start, 4), "parts": parts}
@@ -0,0 +1,79 @@
+# Stdlibs
+import json
+import base64
+
+# Placeholder for the file data while the JSON envelope is serialized
+FILE_DATA_PLACEHOLDER = "__P360_FILE_DATA__"
+
+# Read from the document this many bytes at a time. A multiple of 3, so every chunk base64-encodes without padding.
+SOURCE_CHUNK_SIZE = 3 * 16 * 1024
+
+
+class StreamingUploadBody:
+
+    # The JSON body of an UpdateDocument request, produced in small chunks as the HTTP client reads it. The document
+    # is base64-encoded one chunk at a time, so neither the encoded document nor the serialized JSON is ever held in
+    # memory in full. The length is known up front, so the request goes out with a normal Content-Length.
+    #
+    # file_object is {"title": ..., "format": ..., "data": ...}, where data is the raw document, either as bytes or as
+    # a binary file object.
+    def __init__(self, document_number, file_object):
+        self.source = file_object["data"]
+
+        envelope = {"parameter": {
+            "DocumentNumber": document_number,
+            "Files": [
+                {key: (FILE_DATA_PLACEHOLDER if key == "data" else value) for key, value in file_object.items()}
+            ]
+        }}
+        prefix, suffix = json.dumps(envelope).split(json.dumps(FILE_DATA_PLACEHOLDER))
+        self.prefix = (prefix + "\"").encode("utf-8")
+        self.suffix = ("\"" + suffix).encode("utf-8")
+
+        if hasattr(self.source, "read"):
+            position = self.source.tell()
+            self.source.seek(0, 2)
+            source_length = self.source.tell() - position
+            self.source.seek(position)
+        else:
+            source_length = len(self.source)
+
+        self.length = len(self.prefix) + 4 * ((source_length + 2) // 3) + len(self.suffix)
+        self.chunks = self.generate_chunks()
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return self.length
+
+    def generate_chunks(self):
+        yield self.prefix
+        if hasattr(self.source, "read"):
+            # Short reads are carried over, so only the last chunk can end in base64 padding
+            remainder = b""
+            while True:
+                chunk = self.source.read(SOURCE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunk = remainder + chunk
+                usable_length = len(chunk) - len(chunk) % 3
+                remainder = chunk[usable_length:]
+                yield base64.b64encode(chunk[:usable_length])
+            yield base64.b64encode(remainder)
+        else:
+            source = memoryview(self.source)
+            for offset in range(0, len(source), SOURCE_CHUNK_SIZE):
+                yield base64.b64encode(source[offset:offset + SOURCE_CHUNK_SIZE])
+        yield self.suffix
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
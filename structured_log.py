@@ -0,0 +1,91 @@
+# Stdlibs
+import re
+import json
+
+REDACTED = "***"
+
+# Keys whose values are never logged (lower case). ArchiveCode holds the pnr of the employee in P360.
+REDACTED_KEYS = {"authkey", "pnr", "archivecode", "fødselsogpersonnummer"}
+
+# Keys holding file contents. Only their length is logged.
+FILE_DATA_KEYS = {"data", "base64data"}
+
+AUTHKEY_PATTERN = re.compile(r"(?<=authkey=)[^&\s\"']*")
+# A Norwegian fødselsnummer or d-nummer: 11 digits, possibly with a space or dash after the date
+PNR_PATTERN = re.compile(r"(?<!\d)\d{6}[ -]?\d{5}(?!\d)")
+
+DEFAULT_MAX_LENGTH = 2000
+
+
+def redact_text(text):
+    # The substring checks skip the regular expressions for most strings
+    if "authkey=" in text:
+        text = AUTHKEY_PATTERN.sub(REDACTED, text)
+    if len(text) >= 11:
+        text = PNR_PATTERN.sub(REDACTED, text)
+    return text
+
+
+def redact(value):
+    # A copy of value without secrets, pnrs and file contents
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            name = str(key).lower()
+            if name in REDACTED_KEYS:
+                redacted[key] = REDACTED
+            elif name in FILE_DATA_KEYS and isinstance(item, (str, bytes)):
+                redacted[key] = "<" + str(len(item)) + " characters>"
+            else:
+                redacted[key] = redact(item)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+def truncate(text, max_length=DEFAULT_MAX_LENGTH):
+    if max_length is None or len(text) <= max_length:
+        return text
+    return text[:max_length] + "... (" + str(len(text) - max_length) + " more characters)"
+
+
+class LogValue:
+
+    # Wraps a value for a %s placeholder in a log call, e.g. log.debug("API response: %s", LogValue(response)).
+    # logging only formats the message when the record is emitted, so a value logged at a disabled level costs
+    # nothing to render. When it is rendered, it's redacted and capped at max_length characters.
+    __slots__ = ("value", "max_length")
+
+    def __init__(self, value, max_length=DEFAULT_MAX_LENGTH):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, str):
+            text = redact_text(value)
+        elif isinstance(value, (dict, list, tuple)):
+            text = json.dumps(redact(value), ensure_ascii=False, default=str)
+        else:
+            text = redact_text(str(value))
+        return truncate(text, self.max_length)
+
+
+class LogFields:
+
+    # Renders key=value pairs for a structured log line, e.g.
+    #   log.info("P360 request %s", LogFields(endpoint="CaseService/GetCases", body=post_data))
+    # gives P360 request endpoint="CaseService/GetCases" body={...}. Lazy and redacted like LogValue.
+    __slots__ = ("fields", "max_length")
+
+    def __init__(self, max_length=DEFAULT_MAX_LENGTH, **fields):
+        self.fields = fields
+        self.max_length = max_length
+
+    def __str__(self):
+        return " ".join(name + "=" + json.dumps(str(LogValue(value, self.max_length)), ensure_ascii=False)
+                        if isinstance(value, str) else name + "=" + str(LogValue(value, self.max_length))
+                        for name, value in self.fields.items())
@@ -0,0 +1,174 @@
+# Stdlibs
+import os
+import sys
+import time
+import signal
+import logging
+
+# Custom code
+from config.server import ServerConfig as Config
+from template_registry import TemplateRegistry
+from server import Server, TEMPLATE_PATHS, check_consumer_config
+
+
+class Supervisor:
+
+    # Runs a fleet of worker_count Server processes that all consume the same listen queue, so rendering and JSON
+    # encoding aren't limited to the one core the GIL gives a single process.
+    #
+    # The config is read, the server modules are imported and the templates are compiled once, here, before forking,
+    # so the workers share them copy-on-write and start fast. Each worker then builds its own P360 client, MQ
+    # connection and render pool.
+    #
+    # A worker that exits without being asked to is restarted; if it ran for less than min_uptime seconds, only after
+    # restart_delay seconds, so a worker that can't start doesn't spin. On SIGTERM or SIGINT the workers get a SIGTERM
+    # and drain_timeout seconds to finish their in-flight messages before they're killed. Only a server that consumes
+    # with worker threads drains on SIGTERM, so the supervisor requires MQ_WORKER_COUNT > 1 or MQ_LANES.
+    #
+    # With cpu_pinning, the CPUs are split between the workers, and each worker (with its render processes) is
+    # pinned to its own share.
+    def __init__(self, log=None, worker_count=None, cpu_pinning=False, drain_timeout=70, restart_delay=5,
+                 min_uptime=10):
+        self.log = log if log else logging.getLogger(__name__)
+        self.worker_count = worker_count if worker_count else os.cpu_count()
+        self.cpu_pinning = cpu_pinning
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.min_uptime = min_uptime
+
+        self.config = None
+        self.template_registry = None
+        self.workers = {}
+        self.restarts = {}
+        self.stopping = False
+
+    def run(self):
+        # The workers only drain on SIGTERM when they consume with worker threads
+        check_consumer_config(require_worker_threads=True)
+        self.log.info("Starting " + str(self.worker_count) + " server processes")
+        self.config = Config(log=self.log)
+        # The server imports the docx libraries when it first needs them. Import them here, so the workers share them.
+        import docxgenerator
+        if os.environ.get("DOCX_COMPILED_TEMPLATES", "true").lower() == "true":
+            self.template_registry = TemplateRegistry(log=self.log)
+            self.template_registry.preload(TEMPLATE_PATHS)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        for worker_number in range(self.worker_count):
+            self.start_worker(worker_number)
+
+        while not self.stopping:
+            self.reap_workers()
+            self.restart_workers()
+            time.sleep(0.5)
+
+        self.drain()
+
+    def stop(self):
+        self.stopping = True
+
+    def start_worker(self, worker_number):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                self.run_worker(worker_number)
+                exit_code = 0
+            except Exception as e:
+                self.log.error("Server process " + str(worker_number) + " failed. Error message: " + str(e) +
+                               ", exception type " + type(e).__name__)
+            finally:
+                logging.shutdown()
+                os._exit(exit_code)
+
+        self.workers[pid] = (worker_number, time.monotonic())
+        self.log.info("Started server process " + str(worker_number) + " with pid " + str(pid))
+
+    def run_worker(self, worker_number):
+        # Runs in the forked process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        if self.cpu_pinning:
+            cpus = self.get_worker_cpus(worker_number)
+            os.sched_setaffinity(0, cpus)
+            self.log.info("Server process " + str(worker_number) + " is pinned to CPUs " +
+                          ",".join(str(cpu) for cpu in sorted(cpus)))
+
+        # Every process serves its own metrics, on METRICS_PORT + the worker number
+        metrics_port = os.environ.get("METRICS_PORT")
+        if metrics_port:
+            os.environ["METRICS_PORT"] = str(int(metrics_port) + worker_number)
+
+        server = Server(log=self.log, config=self.config, template_registry=self.template_registry)
+        server.run()
+
+    def get_worker_cpus(self, worker_number):
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) <= self.worker_count:
+            return {cpus[worker_number % len(cpus)]}
+        share = len(cpus) // self.worker_count
+        return set(cpus[worker_number * share:(worker_number + 1) * share])
+
+    def reap_workers(self):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            worker_number, started = worker
+            uptime = time.monotonic() - started
+            self.log.warning("Server process " + str(worker_number) + " (pid " + str(pid) + ") exited with status " +
+                             str(os.waitstatus_to_exitcode(status)) + " after " + str(round(uptime)) +
+                             " seconds. It will be restarted.")
+            delay = self.restart_delay if uptime < self.min_uptime else 0
+            self.restarts[worker_number] = time.monotonic() + delay
+
+    def restart_workers(self):
+        now = time.monotonic()
+        for worker_number, restart_at in list(self.restarts.items()):
+            if restart_at <= now:
+                del self.restarts[worker_number]
+                self.start_worker(worker_number)
+
+    def drain(self):
+        self.log.info("Stopping " + str(len(self.workers)) + " server processes")
+        for pid in self.workers:
+            self.signal_worker(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.drain_timeout
+        while self.workers and time.monotonic() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.2)
+            else:
+                self.workers.pop(pid, None)
+
+        for pid, (worker_number, started) in self.workers.items():
+            self.log.warning("Server process " + str(worker_number) + " (pid " + str(pid) +
+                             ") didn't stop within " + str(self.drain_timeout) + " seconds. Killing it.")
+            self.signal_worker(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers = {}
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+if __name__ == "__main__":
+    log = logging.getLogger(os.environ.get("LOG_NAME", "DEFAULT_LOG"))
+    log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+    supervisor = Supervisor(log=log,
+                            worker_count=int(os.environ.get("SERVER_PROCESSES", "0")),
+                            cpu_pinning=os.environ.get("SERVER_CPU_PINNING", "false").lower() == "true",
+                            drain_timeout=float(os.environ.get("MQ_DRAIN_TIMEOUT", "60")) + 10,
+                            restart_delay=float(os.environ.get("SERVER_RESTART_DELAY", "5")))
+    supervisor.run()
+    sys.exit(0)
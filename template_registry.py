@@ -0,0 +1,129 @@
+# Stdlibs
+import io
+import os
+import re
+import zipfile
+import logging
+import threading
+from xml.sax.saxutils import escape
+
+# The XML parts of a docx file that can contain placeholders
+TEMPLATE_PART_PATTERN = re.compile(r"^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$")
+
+# A {{ placeholder }}. Word often splits the braces and the name into separate runs, so XML tags are allowed anywhere
+# inside the placeholder. They're dropped when the placeholder is replaced; the tags in between close one run and open
+# the next, so removing them keeps the XML balanced.
+XML_TAG_PATTERN = re.compile(r"<[^>]*>")
+XML_TAGS = r"(?:<[^>]*>)*"
+PLACEHOLDER_PATTERN = re.compile(r"\{" + XML_TAGS + r"\{" + XML_TAGS + r"\s*" + XML_TAGS +
+                                 r"([^\W\d](?:\w|<[^>]*>)*?)" +
+                                 XML_TAGS + r"\s*" + XML_TAGS + r"\}" + XML_TAGS + r"\}")
+
+# Template features the compiled plan can't render. Templates using them are rendered by DocxGenerator.
+UNSUPPORTED_TEMPLATE_SYNTAX = ("{{", "{%", "{#", "MERGEFIELD")
+
+
+class CompiledTemplate:
+
+    # A render plan for one docx template. Parts without placeholders are kept as raw bytes. Parts with
+    # placeholders are split into literal XML chunks with the placeholder names in between, so rendering is a join.
+    def __init__(self, path, mtime, parts, placeholder_count, compilable):
+        self.path = path
+        self.mtime = mtime
+        self.parts = parts
+        self.placeholder_count = placeholder_count
+        self.compilable = compilable
+
+    def render(self, values):
+        rendered_parts = []
+        for name, plan in self.parts:
+            if isinstance(plan, bytes):
+                rendered_parts.append((name, plan))
+                continue
+            chunks = []
+            for i, segment in enumerate(plan):
+                if i % 2 == 0:
+                    chunks.append(segment)
+                else:
+                    value = values.get(segment)
+                    chunks.append(escape("" if value is None else str(value)).encode("utf-8"))
+            rendered_parts.append((name, b"".join(chunks)))
+        return rendered_parts
+
+    def render_to_bytes(self, values):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as docx_file:
+            for name, data in self.render(values):
+                docx_file.writestr(name, data)
+        return buffer.getvalue()
+
+
+def compile_template(path):
+    mtime = os.stat(path).st_mtime
+    parts = []
+    placeholder_count = 0
+    compilable = True
+
+    with zipfile.ZipFile(path) as docx_file:
+        for name in docx_file.namelist():
+            data = docx_file.read(name)
+            if not TEMPLATE_PART_PATTERN.match(name):
+                parts.append((name, data))
+                continue
+
+            xml = data.decode("utf-8")
+            segments = PLACEHOLDER_PATTERN.split(xml)
+            placeholder_count += len(segments) // 2
+
+            text = XML_TAG_PATTERN.sub("", "".join(segments[0::2]))
+            if any(syntax in text for syntax in UNSUPPORTED_TEMPLATE_SYNTAX):
+                compilable = False
+
+            plan = [segment.encode("utf-8") if i % 2 == 0 else XML_TAG_PATTERN.sub("", segment)
+                    for i, segment in enumerate(segments)]
+            parts.append((name, plan))
+
+    return CompiledTemplate(path, mtime, parts, placeholder_count, compilable)
+
+
+class TemplateRegistry:
+
+    # Loads each docx template once and keeps its compiled render plan. An entry is recompiled when the template
+    # file's mtime changes, so templates can be replaced without restarting the server.
+    def __init__(self, log=None):
+        self.log = log if log else logging.getLogger(__name__)
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def preload(self, paths):
+        for path in paths:
+            try:
+                self.get(path)
+            except Exception as e:
+                self.log.warning("Could not compile the template " + path + ". Error message: " + str(e))
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime
+        compiled_template = self.templates.get(path)
+        if compiled_template is not None and compiled_template.mtime == mtime:
+            return compiled_template
+
+        with self.lock:
+            compiled_template = self.templates.get(path)
+            if compiled_template is None or compiled_template.mtime != mtime:
+                compiled_template = compile_template(path)
+                self.templates[path] = compiled_template
+                if compiled_template.compilable:
+                    self.log.info("Compiled the template " + path + " with " +
+                                  str(compiled_template.placeholder_count) + " placeholders")
+                else:
+                    self.log.info("The template " + path + " uses syntax the compiled templates don't support. "
+                                  "It will be rendered by DocxGenerator.")
+        return compiled_template
+
+    def render(self, path, values):
+        # Returns the generated docx file as bytes, or None if the template can't be rendered from a compiled plan
+        compiled_template = self.get(path)
+        if not compiled_template.compilable:
+            return None
+        return compiled_template.render_to_bytes(values)
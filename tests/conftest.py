@@ -0,0 +1,40 @@
+# Stdlibs
+import os
+import sys
+import logging
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture
+def log():
+    return logging.getLogger("tests")
+
+
+@pytest.fixture
+def fake_p360():
+    from fake_p360 import FakeP360Server
+    fake_p360 = FakeP360Server().start()
+    fake_p360.state.add_contact("hr@example.com")
+    yield fake_p360
+    fake_p360.stop()
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch, log, fake_p360):
+    # A Server against the fake P360 server, with a checkpoint journal and a case index
+    for module in ("config.server", "models.p360_case", "utils", "docxgenerator"):
+        pytest.importorskip(module)
+    from stubs import StubMqClient, StubConfig
+    from server import Server
+
+    monkeypatch.setenv("CHECKPOINT_JOURNAL_PATH", str(tmp_path / "checkpoints.db"))
+    monkeypatch.setenv("CASE_INDEX_PATH", str(tmp_path / "cases.db"))
+    monkeypatch.setenv("DOCX_RENDER_POOL_SIZE", "0")
+    server = Server(mq_client=StubMqClient(keep_messages=True), log=log, config=StubConfig(fake_p360.get_base_uri()))
+    yield server
+    server.close()
@@ -0,0 +1,137 @@
+# A stand-in for a pika BlockingChannel on one queue-holding broker, for the consumer tests. Like pika,
+# the channel must only be used on the thread that processes the connection's events; anything else has to go
+# through add_callback_threadsafe. Using it from another thread raises AssertionError.
+
+# Stdlibs
+import time
+import threading
+import itertools
+from types import SimpleNamespace
+from collections import deque
+
+
+class FakeConnection:
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.callbacks = deque()
+        self.closed = False
+
+    def add_callback_threadsafe(self, callback):
+        with self.channel.condition:
+            self.callbacks.append(callback)
+            self.channel.condition.notify_all()
+
+    def process_data_events(self, time_limit=0):
+        self.channel.process_data_events(time_limit)
+
+    def close(self):
+        self.channel.check_thread()
+        self.closed = True
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.connection = FakeConnection(self)
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.consumers = {}
+        self.prefetch_count = 0
+        self.delivery_tags = itertools.count(1)
+        self.consumer_tags = itertools.count(1)
+        self.unacked = {}
+        self.acks = []
+        self.nacks = []
+        self.cancelled = []
+        self.thread = None
+
+    def publish(self, queue, routing_key, body, message_id=None):
+        # Test helper, safe from any thread
+        with self.condition:
+            self.queues.setdefault(queue, deque()).append((routing_key, body, message_id))
+            self.condition.notify_all()
+
+    def get_message_count(self, queue):
+        with self.condition:
+            return len(self.queues.get(queue, ()))
+
+    def check_thread(self):
+        if self.thread is None:
+            self.thread = threading.get_ident()
+        assert self.thread == threading.get_ident(), "The channel was used outside the connection's thread"
+
+    def basic_qos(self, prefetch_count):
+        self.check_thread()
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.check_thread()
+        consumer_tag = "consumer-" + str(next(self.consumer_tags))
+        self.consumers[consumer_tag] = SimpleNamespace(queue=queue, callback=on_message_callback,
+                                                       prefetch_count=self.prefetch_count, unacked=set())
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        self.check_thread()
+        self.consumers.pop(consumer_tag)
+        self.cancelled.append(consumer_tag)
+
+    def basic_ack(self, delivery_tag):
+        self.check_thread()
+        self.settle(delivery_tag)
+        self.acks.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.check_thread()
+        queue, message = self.settle(delivery_tag)
+        self.nacks.append((delivery_tag, requeue, time.monotonic()))
+        if requeue:
+            with self.condition:
+                self.queues[queue].appendleft(message)
+
+    def settle(self, delivery_tag):
+        consumer_tag, queue, message = self.unacked.pop(delivery_tag)
+        if consumer_tag in self.consumers:
+            self.consumers[consumer_tag].unacked.discard(delivery_tag)
+        return queue, message
+
+    def queue_declare(self, queue, passive=False):
+        self.check_thread()
+        return SimpleNamespace(method=SimpleNamespace(message_count=self.get_message_count(queue)))
+
+    def process_data_events(self, time_limit):
+        # Returns once something happened, or after time_limit seconds
+        self.check_thread()
+        deadline = time.monotonic() + time_limit
+        while True:
+            with self.condition:
+                callbacks = list(self.connection.callbacks)
+                self.connection.callbacks.clear()
+            for callback in callbacks:
+                callback()
+            delivered = self.deliver()
+            remaining = deadline - time.monotonic()
+            if callbacks or delivered or remaining <= 0:
+                return
+            with self.condition:
+                if not self.connection.callbacks:
+                    self.condition.wait(min(remaining, 0.05))
+
+    def deliver(self):
+        delivered = 0
+        for consumer_tag, consumer in list(self.consumers.items()):
+            while not consumer.prefetch_count or len(consumer.unacked) < consumer.prefetch_count:
+                with self.condition:
+                    queue = self.queues.get(consumer.queue)
+                    if not queue:
+                        break
+                    message = queue.popleft()
+                routing_key, body, message_id = message
+                delivery_tag = next(self.delivery_tags)
+                consumer.unacked.add(delivery_tag)
+                self.unacked[delivery_tag] = (consumer_tag, consumer.queue, message)
+                consumer.callback(self, SimpleNamespace(delivery_tag=delivery_tag, routing_key=routing_key),
+                                  SimpleNamespace(message_id=message_id), body)
+                delivered += 1
+        return delivered
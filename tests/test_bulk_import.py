@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+PNR = "01019012345"
+
+
+def create_message(name, email="hr@example.com", unit="IT"):
+    return {"event": "onboarding", "Navn": name, "FødselsOgPersonnummer": PNR, "DinEpostadresse": email,
+            "Enhet": unit, "ArbeidsavtaleLanguage": "Norsk"}
+
+
+@pytest.fixture
+def importer(server, log):
+    from bulk_import import BulkImporter
+    return BulkImporter(server, log=log, concurrency=4)
+
+
+def test_batch_files_keep_their_line_numbers(tmp_path):
+    pytest.importorskip("models.p360_case")
+    from bulk_import import read_onboarding_batch
+
+    jsonl_path = tmp_path / "batch.jsonl"
+    jsonl_path.write_text(json.dumps(create_message("Ola Nordmann")) + "\n\n{not json\n" +
+                          json.dumps(create_message("Kari Nordmann")) + "\n", encoding="utf-8")
+    assert [(line_number, mq_message and mq_message["Navn"])
+            for line_number, mq_message in read_onboarding_batch(str(jsonl_path))] == \
+        [(1, "Ola Nordmann"), (3, None), (4, "Kari Nordmann")]
+
+    csv_path = tmp_path / "batch.csv"
+    csv_path.write_text("Navn,Enhet\nOla Nordmann,IT\nKari Nordmann,HR\n", encoding="utf-8")
+    assert read_onboarding_batch(str(csv_path)) == [(2, {"Navn": "Ola Nordmann", "Enhet": "IT"}),
+                                                    (3, {"Navn": "Kari Nordmann", "Enhet": "HR"})]
+
+
+def test_responsible_officer_is_looked_up_once_per_batch(importer, fake_p360):
+    results = importer.run([(1, create_message("Ola Nordmann")), (2, create_message("Kari Nordmann")),
+                            (3, create_message("Per Hansen", unit="HR"))])
+
+    assert [result["result"] for result in results] == ["success"] * 3
+    assert fake_p360.state.call_counts["ContactService/GetContactPersons"] == 1
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 3
+
+
+def test_hires_with_the_same_case_title_share_the_case(importer, fake_p360):
+    results = importer.run([(1, create_message("Ola Nordmann")), (2, create_message("Ola Nordmann"))])
+
+    assert [result["result"] for result in results] == ["success", "success"]
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 1
+    assert fake_p360.state.call_counts["CaseService/GetCases"] == 1
+    assert len({mq_message["data"]["p360_case_number"] for mq_message in importer.server.mq_client.sent}) == 1
+
+
+def test_each_line_reports_its_own_error(importer, fake_p360):
+    results = importer.run([(1, create_message("Ola Nordmann")),
+                            (2, None),
+                            (3, dict(create_message("Kari Nordmann"), Enhet="")),
+                            (4, create_message("Per Hansen", email="unknown@example.com"))])
+
+    assert results[0] == {"line": 1, "case_title": "Personalmappe offentlig - Ola Nordmann - IT", "result": "success"}
+    assert results[1]["result"] == "invalid" and results[1]["line"] == 2
+    assert results[2] == {"line": 3, "result": "invalid", "error": "Missing Enhet"}
+    assert (results[3]["line"], results[3]["result"]) == (4, "failed")
+    assert [mq_message["event"] for mq_message in importer.server.mq_client.sent].count("error") == 1
+
+
+def test_address_is_looked_up_as_given_like_a_single_onboarding(importer, fake_p360, monkeypatch):
+    import fake_p360 as fake_p360_module
+    looked_up_emails = []
+    get_contact_persons = fake_p360_module.FakeP360State.get_contact_persons
+
+    def recording_get_contact_persons(state, parameter):
+        looked_up_emails.append(parameter["Email"])
+        return get_contact_persons(state, parameter)
+
+    monkeypatch.setitem(fake_p360_module.ENDPOINTS, "ContactService/GetContactPersons", recording_get_contact_persons)
+    fake_p360.state.add_contact("Kari.Hansen@example.com")
+
+    results = importer.run([(1, create_message("Ola Nordmann", email="Kari.Hansen@example.com"))])
+
+    assert results[0]["result"] == "success"
+    assert looked_up_emails == ["Kari.Hansen@example.com"]
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("models.p360_case")
+
+from case_index import CaseIndex
+
+PNR = "01019012345"
+LONNSMELDING_MESSAGE = {
+    "event": "lonnsmelding",
+    "Navn": "Ola Nordmann",
+    "FødselsOgPersonnummer": PNR,
+    "Enhet": "IT",
+}
+
+
+@pytest.fixture
+def case_index(tmp_path, log):
+    case_index = CaseIndex(str(tmp_path / "cases.db"), log=log, salt="salt")
+    yield case_index
+    case_index.close()
+
+
+def test_put_get_invalidate(case_index):
+    case_index.put(PNR, "IT Personalmapper", 1, "21/1", "hr@example.com", 2)
+    p360_case = case_index.get(PNR, "IT Personalmapper")
+    assert (p360_case.get_case_number(), p360_case.get_responsible_person_email()) == ("21/1", "hr@example.com")
+    assert case_index.get(PNR, "HR Personalmapper") is None
+
+    case_index.invalidate(PNR, "IT Personalmapper")
+    assert case_index.get(PNR, "IT Personalmapper") is None
+
+
+def test_pnr_is_not_stored(case_index, tmp_path):
+    case_index.put(PNR, "IT Personalmapper", 1, "21/1", "hr@example.com", 2)
+    with open(str(tmp_path / "cases.db"), "rb") as database:
+        assert PNR.encode("utf-8") not in database.read()
+
+
+def test_stale_index_entry_is_dropped_when_the_lonnsmelding_fails(server, fake_p360, monkeypatch):
+    import fake_p360 as fake_p360_module
+    # The case was moved: the indexed case number doesn't exist in P360 anymore, so documents can't be created in it
+    create_document = fake_p360_module.FakeP360State.create_document
+
+    def create_document_in_existing_case(state, parameter):
+        if parameter.get("CaseNumber") not in [case["CaseNumber"] for case in state.cases]:
+            return None
+        return create_document(state, parameter)
+
+    monkeypatch.setitem(fake_p360_module.ENDPOINTS, "DocumentService/CreateDocument",
+                        create_document_in_existing_case)
+    case_number = fake_p360.state.add_case("Personalmappe offentlig - Ola Nordmann - IT", "IT Personalmapper", PNR,
+                                           "hr@example.com")
+    server.p360_client.case_index.put(PNR, "IT Personalmapper", 1, "21/moved", "old@example.com", 2)
+
+    assert server.handle_new_lonnsmelding(dict(LONNSMELDING_MESSAGE)) is False
+    assert fake_p360.state.call_counts.get("CaseService/GetCases") is None
+    assert server.p360_client.case_index.get(PNR, "IT Personalmapper") is None
+
+    assert server.handle_new_lonnsmelding(dict(LONNSMELDING_MESSAGE)) is True
+    assert server.mq_client.sent[-1]["data"]["p360_case_number"] == case_number
+    assert server.mq_client.sent[-1]["data"]["executive_officer"] == "hr@example.com"
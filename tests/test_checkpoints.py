@@ -0,0 +1,139 @@
+import time
+import threading
+
+import pytest
+
+from checkpoint_journal import CheckpointJournal, MessageCheckpoints
+
+ONBOARDING_MESSAGE = {
+    "event": "onboarding",
+    "Navn": "Ola Nordmann",
+    "FødselsOgPersonnummer": "01019012345",
+    "DinEpostadresse": "hr@example.com",
+    "Enhet": "IT",
+    "ArbeidsavtaleLanguage": "Norsk",
+}
+
+
+@pytest.fixture
+def journal(tmp_path, log):
+    journal = CheckpointJournal(str(tmp_path / "checkpoints.db"), log=log)
+    yield journal
+    journal.close()
+
+
+def test_steps_survive_reopening_the_journal(tmp_path, log):
+    path = str(tmp_path / "checkpoints.db")
+    journal = CheckpointJournal(path, log=log)
+    MessageCheckpoints(journal, ONBOARDING_MESSAGE).record("case", {"case_number": "21/1", "case_recno": 1})
+    journal.close()
+
+    journal = CheckpointJournal(path, log=log)
+    checkpoints = MessageCheckpoints(journal, dict(reversed(list(ONBOARDING_MESSAGE.items()))))
+    assert checkpoints.get("case") == {"case_number": "21/1", "case_recno": 1}
+    assert not checkpoints.is_completed()
+    journal.close()
+
+
+def test_completed_message_keeps_what_the_notification_needs(journal):
+    checkpoints = MessageCheckpoints(journal, ONBOARDING_MESSAGE)
+    checkpoints.record("upload:Arbeidsavtale")
+    checkpoints.complete({"case_number": "21/1", "case_recno": 1, "responsible_user_email": "hr@example.com"})
+
+    checkpoints = MessageCheckpoints(journal, ONBOARDING_MESSAGE)
+    assert checkpoints.is_completed()
+    assert not checkpoints.is_done("upload:Arbeidsavtale")
+    assert checkpoints.get_completed()["case_number"] == "21/1"
+
+
+def test_old_entries_are_pruned(journal):
+    MessageCheckpoints(journal, ONBOARDING_MESSAGE).record("responsible_recno", 1)
+    time.sleep(0.01)
+    assert journal.prune(0) == 1
+    assert not MessageCheckpoints(journal, ONBOARDING_MESSAGE).is_done("responsible_recno")
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    # Records the document number of every upload. The first upload to the Arbeidsavtale folder fails right away;
+    # the others take a while, so they're still running in P360 when it fails.
+    import fake_p360
+    uploads = []
+    failed = []
+    lock = threading.Lock()
+    update_document = fake_p360.FakeP360State.update_document
+
+    def failing_update_document(state, parameter):
+        document_number = parameter.get("DocumentNumber")
+        title = [document["Title"] for document in state.documents if document["DocumentNumber"] == document_number]
+        with lock:
+            if title == ["Arbeidsavtale"] and not failed:
+                failed.append(document_number)
+                return None
+        time.sleep(0.3)
+        with lock:
+            uploads.append(title[0])
+        return update_document(state, parameter)
+
+    monkeypatch.setitem(fake_p360.ENDPOINTS, "DocumentService/UpdateDocument", failing_update_document)
+    return uploads
+
+
+def test_redelivered_onboarding_uploads_each_document_once(server, uploads):
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is False
+    assert sorted(uploads) == ["Hovedtariffavtale", "Velkomstbrev"]
+
+    checkpoints = server.get_message_checkpoints(ONBOARDING_MESSAGE)
+    assert checkpoints.is_done("upload:Hovedtariffavtale")
+    assert checkpoints.is_done("upload:Velkomstbrev")
+    assert not checkpoints.is_done("upload:Arbeidsavtale")
+
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is True
+    assert sorted(uploads) == ["Arbeidsavtale", "Hovedtariffavtale", "Velkomstbrev"]
+
+
+def test_completed_mark_is_only_kept_for_the_completed_retention(tmp_path, log, journal):
+    MessageCheckpoints(journal, ONBOARDING_MESSAGE).complete({"case_number": "21/1"})
+    assert MessageCheckpoints(journal, ONBOARDING_MESSAGE).is_completed()
+
+    later_journal = CheckpointJournal(str(tmp_path / "checkpoints.db"), log=log, completed_retention=0)
+    assert not MessageCheckpoints(later_journal, ONBOARDING_MESSAGE).is_completed()
+    later_journal.close()
+
+
+def test_message_id_tells_a_resubmission_from_a_redelivery(journal):
+    MessageCheckpoints(journal, ONBOARDING_MESSAGE, "form-1").complete({"case_number": "21/1"})
+
+    assert MessageCheckpoints(journal, ONBOARDING_MESSAGE, "form-1").is_completed()
+    assert not MessageCheckpoints(journal, ONBOARDING_MESSAGE, "form-2").is_completed()
+    assert not MessageCheckpoints(journal, ONBOARDING_MESSAGE).is_completed()
+
+
+def test_resubmitted_onboarding_is_notified_again(server, fake_p360):
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is True
+    calls = fake_p360.state.get_total_calls()
+
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is True
+    assert fake_p360.state.get_total_calls() == calls
+    events = [mq_message["event"] for mq_message in server.mq_client.sent]
+    assert events == ["p360caseCreated", "p360caseCreated"]
+    assert server.mq_client.sent[0]["data"] == server.mq_client.sent[1]["data"]
+
+
+
+def test_resubmission_with_a_new_message_id_is_processed_again(server, fake_p360):
+    from message_routing import current_message_id
+
+    token = current_message_id.set("form-1")
+    try:
+        assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is True
+        calls = fake_p360.state.get_total_calls()
+        current_message_id.set("form-2")
+        assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is True
+    finally:
+        current_message_id.reset(token)
+
+    # The case is found this time, and the documents are uploaded again
+    assert fake_p360.state.get_total_calls() > calls
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 1
+    assert fake_p360.state.call_counts["DocumentService/UpdateDocument"] == 6
@@ -0,0 +1,176 @@
+import json
+import time
+import threading
+
+from fake_broker import FakeChannel
+from concurrent_consumer import ConcurrentConsumer
+from errors import RetryableError
+
+
+def publish(channel, count):
+    for i in range(count):
+        channel.publish("listen", "hr.onboarding", json.dumps({"number": i}))
+
+
+def start_consumer(log, message_handler, prefetch_count=4, worker_count=2, drain_timeout=5, requeue_delay=0):
+    channel = FakeChannel()
+    consumer = ConcurrentConsumer(log=log, channel=channel, queue_name="listen", message_handler=message_handler,
+                                  prefetch_count=prefetch_count, worker_count=worker_count,
+                                  drain_timeout=drain_timeout, requeue_delay=requeue_delay)
+    consumer_thread = threading.Thread(target=consumer.start)
+    return channel, consumer, consumer_thread
+
+
+def stop_consumer(channel, consumer, consumer_thread):
+    channel.connection.add_callback_threadsafe(consumer.stop)
+    consumer_thread.join(10)
+    assert not consumer_thread.is_alive()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_messages_are_acked_on_the_connection_thread_as_they_finish(log):
+    # The first message takes longest, so it's acked last. The fake channel fails if the workers touch it.
+    handler_threads = set()
+
+    def message_handler(mq_message, routing_key):
+        handler_threads.add(threading.get_ident())
+        time.sleep(0.3 if mq_message["number"] == 0 else 0)
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler)
+    publish(channel, 3)
+    consumer_thread.start()
+    wait_until(lambda: len(channel.acks) == 3)
+    stop_consumer(channel, consumer, consumer_thread)
+
+    assert channel.acks[-1] == 1 and sorted(channel.acks) == [1, 2, 3]
+    assert channel.nacks == []
+    assert channel.thread not in handler_threads and channel.thread == consumer_thread.ident
+
+
+def test_prefetch_bounds_the_unacked_messages(log):
+    released = threading.Event()
+    running = []
+    lock = threading.Lock()
+
+    def message_handler(mq_message, routing_key):
+        with lock:
+            running.append(mq_message["number"])
+        released.wait(10)
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler, prefetch_count=3, worker_count=2)
+    publish(channel, 10)
+    consumer_thread.start()
+    wait_until(lambda: len(running) == 2)
+    time.sleep(0.2)
+
+    # Two messages with the workers, one waiting for a worker, and the rest still in the broker
+    assert len(running) == 2
+    assert consumer.in_flight == 3
+    assert channel.get_message_count("listen") == 7
+
+    released.set()
+    wait_until(lambda: len(channel.acks) == 10)
+    stop_consumer(channel, consumer, consumer_thread)
+
+
+def test_retryable_error_requeues_after_the_delay(log):
+    attempts = []
+
+    def message_handler(mq_message, routing_key):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryableError("P360 is down")
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler, requeue_delay=0.3)
+    publish(channel, 1)
+    consumer_thread.start()
+    wait_until(lambda: len(channel.acks) == 1)
+    stop_consumer(channel, consumer, consumer_thread)
+
+    assert [(delivery_tag, requeue) for delivery_tag, requeue, nacked in channel.nacks] == [(1, True)]
+    assert channel.nacks[0][2] - attempts[0] >= 0.3
+    assert channel.acks == [2]
+
+
+def test_other_errors_reject_the_message(log):
+    def message_handler(mq_message, routing_key):
+        raise ValueError("Poison message")
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler)
+    publish(channel, 1)
+    channel.publish("listen", "hr.onboarding", b"{not json")
+    consumer_thread.start()
+    wait_until(lambda: len(channel.nacks) == 2)
+    stop_consumer(channel, consumer, consumer_thread)
+
+    assert sorted((delivery_tag, requeue) for delivery_tag, requeue, nacked in channel.nacks) == [(1, False),
+                                                                                                  (2, False)]
+    assert channel.get_message_count("listen") == 0
+
+
+def test_stop_drains_the_messages_in_flight(log):
+    started = threading.Event()
+    released = threading.Event()
+
+    def message_handler(mq_message, routing_key):
+        started.set()
+        released.wait(10)
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler, prefetch_count=1, worker_count=1)
+    publish(channel, 3)
+    consumer_thread.start()
+    assert started.wait(5)
+
+    channel.connection.add_callback_threadsafe(consumer.stop)
+    time.sleep(0.2)
+    # Still waiting for the message in flight, and nothing new is taken
+    assert consumer_thread.is_alive()
+    assert channel.cancelled == [consumer.consumer_tag]
+
+    released.set()
+    consumer_thread.join(5)
+    assert not consumer_thread.is_alive()
+    assert channel.acks == [1]
+    assert channel.get_message_count("listen") == 2
+    assert channel.connection.closed
+
+
+def test_drain_gives_up_after_the_timeout(log):
+    released = threading.Event()
+
+    def message_handler(mq_message, routing_key):
+        released.wait(10)
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler, drain_timeout=0.3)
+    publish(channel, 1)
+    consumer_thread.start()
+    wait_until(lambda: consumer.in_flight == 1)
+
+    start = time.monotonic()
+    stop_consumer(channel, consumer, consumer_thread)
+    assert 0.3 <= time.monotonic() - start < 2
+    assert channel.acks == [] and channel.connection.closed
+    released.set()
+
+
+def test_handler_sees_the_message_id_of_its_message(log):
+    from message_routing import current_message_id
+    message_ids = []
+
+    def message_handler(mq_message, routing_key):
+        message_ids.append((mq_message["number"], current_message_id.get()))
+
+    channel, consumer, consumer_thread = start_consumer(log, message_handler, worker_count=1)
+    channel.publish("listen", "hr.onboarding", json.dumps({"number": 0}), message_id="form-1")
+    channel.publish("listen", "hr.onboarding", json.dumps({"number": 1}))
+    consumer_thread.start()
+    wait_until(lambda: len(channel.acks) == 2)
+    stop_consumer(channel, consumer, consumer_thread)
+
+    assert message_ids == [(0, "form-1"), (1, None)]
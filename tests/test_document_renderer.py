@@ -0,0 +1,40 @@
+import os
+import time
+import signal
+
+import pytest
+
+from document_renderer import DocumentRenderer
+from template_registry import TemplateRegistry
+from test_template_registry import write_template, get_paragraph_texts
+
+PARAGRAPHS = '<w:p><w:r><w:t>{{ Navn }}</w:t></w:r></w:p>'
+
+
+@pytest.fixture
+def renderer(log):
+    pytest.importorskip("docxgenerator")
+    template_registry = TemplateRegistry(log=log)
+    renderer = DocumentRenderer(log=log, pool_size=1, template_registry=template_registry)
+    yield renderer
+    renderer.close()
+
+
+def test_broken_pool_is_replaced_by_a_forkserver_pool(renderer, tmp_path):
+    path = write_template(tmp_path / "template.docx", PARAGRAPHS)
+    assert get_paragraph_texts(renderer.submit({"Navn": "Ola Nordmann"}, path).result(10)) == ["Ola Nordmann"]
+
+    broken_executor = renderer.executor
+    worker_pids = list(broken_executor._processes)
+    os.kill(worker_pids[0], signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not broken_executor._broken:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    render = renderer.submit({"Navn": "Kari Nordmann"}, path)
+
+    assert get_paragraph_texts(render.result(30)) == ["Kari Nordmann"]
+    assert renderer.executor is not broken_executor
+    assert renderer.executor._mp_context.get_start_method() == "forkserver"
+    assert broken_executor._shutdown_thread
@@ -0,0 +1,119 @@
+import time
+import threading
+
+import pytest
+
+from hedging import Hedger, HedgeBudget
+
+ENDPOINT = "CaseService/GetCases"
+
+
+class SlowCall:
+
+    # A fake P360 lookup. The calls listed in slow_calls (counting from 0) take slow_seconds, the others answer at once.
+    def __init__(self, slow_calls=(0,), slow_seconds=1.0):
+        self.slow_calls = slow_calls
+        self.slow_seconds = slow_seconds
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            call_number = self.count
+            self.count += 1
+        if call_number in self.slow_calls:
+            time.sleep(self.slow_seconds)
+        return call_number
+
+
+def create_hedger(budget_ratio=1.0, max_workers=10):
+    # A hedger that already knows the endpoint usually answers within 10 ms
+    hedger = Hedger(budget_ratio=budget_ratio, min_delay=0.05, min_samples=20, max_workers=max_workers)
+    for i in range(20):
+        hedger.latency_tracker.record(ENDPOINT, 0.01)
+    return hedger
+
+
+def test_budget_allows_one_hedge_per_ratio_of_requests():
+    budget = HedgeBudget(ratio=0.05, burst=10)
+    for i in range(19):
+        budget.earn()
+    assert not budget.spend()
+    budget.earn()
+    assert budget.spend()
+    assert not budget.spend()
+
+    for i in range(1000):
+        budget.earn()
+    assert [budget.spend() for i in range(11)] == [True] * 10 + [False]
+
+
+def test_no_hedge_before_the_latencies_are_known():
+    hedger = Hedger(budget_ratio=1.0, min_delay=0.01, min_samples=20)
+    slow_call = SlowCall(slow_seconds=0.2)
+
+    assert hedger.call(ENDPOINT, slow_call) == 0
+    assert slow_call.count == 1
+    hedger.close()
+
+
+def test_slow_lookup_is_answered_by_the_hedge():
+    hedger = create_hedger()
+    slow_call = SlowCall(slow_seconds=2.0)
+
+    start = time.monotonic()
+    assert hedger.call(ENDPOINT, slow_call) == 1
+    assert time.monotonic() - start < 1.0
+    assert slow_call.count == 2
+    hedger.close()
+
+
+def test_no_hedge_without_budget():
+    hedger = create_hedger(budget_ratio=0)
+    slow_call = SlowCall(slow_seconds=0.3)
+
+    assert hedger.call(ENDPOINT, slow_call) == 0
+    assert slow_call.count == 1
+    hedger.close()
+
+
+def test_hedge_that_has_not_started_is_cancelled_when_the_primary_answers():
+    # One hedging thread: the hedge waits behind the primary, which answers first
+    hedger = create_hedger(max_workers=1)
+    slow_call = SlowCall(slow_seconds=0.3)
+
+    assert hedger.call(ENDPOINT, slow_call) == 0
+    hedger.executor.submit(int).result()
+    assert slow_call.count == 1
+    hedger.close()
+
+
+def test_writes_are_never_hedged(log, fake_p360):
+    pytest.importorskip("models.p360_case")
+    from p360_client import P360Client, HEDGED_ENDPOINTS
+
+    hedger = create_hedger()
+    hedged_endpoints = []
+    call = hedger.call
+
+    def recording_call(endpoint, function, *args, **kwargs):
+        hedged_endpoints.append(endpoint)
+        return call(endpoint, function, *args, **kwargs)
+
+    hedger.call = recording_call
+    client = P360Client(log=log, api_base_uri=fake_p360.get_base_uri(), api_key="test", hedger=hedger)
+    responsible_recno = client.get_contact_person_by_email("hr@example.com").get_recno()
+    p360_case = client.create_case(case_title="Personalmappe - Ola Nordmann", responsible_person_recno=responsible_recno,
+                                   access_group="IT Personalmapper", pnr="01019012345")
+    document_recno, document_number = client.create_document_folder(
+        folder_name="Arbeidsavtale", category=111, status=1, case_number=p360_case.get_case_number(),
+        responsible_recno=responsible_recno, access_code=None, paragraph=None, access_group="IT Personalmapper")
+    client.upload_file(document_number=document_number,
+                       file_object={"title": "Arbeidsavtale", "format": "docx", "data": b"docx"})
+    client.close()
+
+    assert hedged_endpoints == ["ContactService/GetContactPersons"]
+    assert set(hedged_endpoints) <= set(HEDGED_ENDPOINTS)
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 1
+    assert fake_p360.state.call_counts["DocumentService/CreateDocument"] == 1
+    assert fake_p360.state.call_counts["DocumentService/UpdateDocument"] == 1
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from json_stream import JsonArrayStream
+
+
+def chunked(response_object, chunk_size):
+    data = json.dumps(response_object, ensure_ascii=False, indent=1).encode("utf-8")
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 100000])
+def test_items_and_fields_across_chunk_boundaries(chunk_size):
+    cases = [{"Recno": i, "Title": "Personalmappe - Åse Øvrebø " + str(i), "Notes": "\"quoted\" \\ text",
+              "ArchiveCodes": ["221", "01019012345"]} for i in range(20)]
+    stream = JsonArrayStream(chunked({"ErrorMessage": None, "Cases": cases, "Successful": True}, chunk_size),
+                             "Cases")
+
+    assert list(stream) == cases
+    assert stream.finished
+    assert stream.fields == {"ErrorMessage": None, "Successful": True}
+
+
+def test_empty_array_and_empty_object():
+    stream = JsonArrayStream(chunked({"Cases": [], "Successful": True}, 4), "Cases")
+    assert list(stream) == []
+    assert stream.finished and stream.fields["Successful"] is True
+
+    stream = JsonArrayStream([b"{}"], "Cases")
+    assert list(stream) == []
+    assert stream.finished
+
+
+def test_stops_early_when_not_successful():
+    stream = JsonArrayStream(chunked({"Successful": False, "ErrorMessage": "No access", "Cases": [{"Recno": 1}]},
+                                     5), "Cases")
+    assert list(stream) == []
+    assert not stream.finished
+    assert stream.fields == {"Successful": False}
+
+
+def test_caller_can_stop_reading_early():
+    chunks_read = []
+
+    def chunks():
+        for chunk in chunked({"Cases": [{"Recno": i, "Notes": "x" * 100} for i in range(1000)]}, 256):
+            chunks_read.append(chunk)
+            yield chunk
+
+    for case in JsonArrayStream(chunks(), "Cases"):
+        if case["Recno"] == 2:
+            break
+    assert len(chunks_read) < 5
+
+
+def test_truncated_response_is_an_error():
+    data = json.dumps({"Cases": [{"Recno": 1}, {"Recno": 2}]}).encode("utf-8")
+    with pytest.raises(ValueError):
+        list(JsonArrayStream([data[:-10]], "Cases"))
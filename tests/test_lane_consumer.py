@@ -0,0 +1,92 @@
+import json
+import time
+import threading
+
+import pytest
+
+from fake_broker import FakeChannel
+from lane_consumer import Lane, LaneConsumer
+
+
+def create_lane_consumer(log, channel, message_handler, onboarding_queue_name, lonnsmelding_queue_name):
+    lanes = [Lane("onboarding", worker_count=2, prefetch_count=4, priority=0, queue_name=onboarding_queue_name),
+             Lane("lonnsmelding", worker_count=1, prefetch_count=2, priority=1, queue_name=lonnsmelding_queue_name)]
+    return LaneConsumer(log=log, channel=channel, queue_name="listen", message_handler=message_handler, lanes=lanes,
+                        lane_selector=lambda body, routing_key: routing_key, drain_timeout=5)
+
+
+class BlockedOnboardings:
+
+    # A message handler where onboardings wait until they're released, and lønnsmelding messages are done at once
+    def __init__(self):
+        self.released = threading.Event()
+        self.lonnsmelding_done = threading.Event()
+        self.lock = threading.Lock()
+        self.onboardings_started = 0
+
+    def __call__(self, mq_message, routing_key):
+        if routing_key == "onboarding":
+            with self.lock:
+                self.onboardings_started += 1
+            self.released.wait(10)
+        else:
+            self.lonnsmelding_done.set()
+
+
+def run_consumer(consumer, channel, message_handler, queue_names):
+    # Publishes a backlog of onboardings and then one lønnsmelding, and returns how long the lønnsmelding took
+    for i in range(10):
+        channel.publish(queue_names[0], "onboarding", json.dumps({"event": "onboarding", "number": i}))
+    channel.publish(queue_names[1], "lonnsmelding", json.dumps({"event": "lonnsmelding"}))
+    consumer_thread = threading.Thread(target=consumer.start)
+    start = time.monotonic()
+    consumer_thread.start()
+    message_handler.lonnsmelding_done.wait(1)
+    lonnsmelding_seconds = time.monotonic() - start
+
+    message_handler.released.set()
+    channel.connection.add_callback_threadsafe(consumer.stop)
+    consumer_thread.join(10)
+    assert not consumer_thread.is_alive()
+    return lonnsmelding_seconds
+
+
+def test_lonnsmelding_is_not_held_back_by_blocked_onboarding_workers(log):
+    channel = FakeChannel()
+    message_handler = BlockedOnboardings()
+    consumer = create_lane_consumer(log, channel, message_handler, "onboarding-queue", "lonnsmelding-queue")
+
+    assert run_consumer(consumer, channel, message_handler, ["onboarding-queue", "lonnsmelding-queue"]) < 0.5
+    # Both onboarding workers were busy, and the onboarding prefetch held the rest of the backlog in the queue
+    assert message_handler.onboardings_started >= 2
+    assert channel.connection.closed
+
+
+def test_lanes_on_one_queue_block_the_lonnsmelding_behind_the_onboardings(log):
+    # Why every lane needs a queue of its own: the shared prefetch window is full of onboardings
+    channel = FakeChannel()
+    message_handler = BlockedOnboardings()
+    consumer = create_lane_consumer(log, channel, message_handler, None, None)
+
+    assert run_consumer(consumer, channel, message_handler, ["listen", "listen"]) >= 1
+
+
+def test_lanes_need_queues_of_their_own(monkeypatch):
+    for module in ("config.server", "models.p360_case", "utils"):
+        pytest.importorskip(module)
+    from server import check_consumer_config
+
+    monkeypatch.setenv("MQ_ONBOARDING_ROUTING_KEY", "hr.onboarding")
+    monkeypatch.setenv("MQ_LONNSMELDING_ROUTING_KEY", "hr.lonnsmelding")
+    monkeypatch.setenv("MQ_LANES", "true")
+    monkeypatch.delenv("MQ_ONBOARDING_QUEUE_NAME", raising=False)
+    monkeypatch.setenv("MQ_LONNSMELDING_QUEUE_NAME", "lonnsmelding")
+    with pytest.raises(Exception, match="queue of its own"):
+        check_consumer_config()
+
+    monkeypatch.setenv("MQ_ONBOARDING_QUEUE_NAME", "lonnsmelding")
+    with pytest.raises(Exception, match="queue of its own"):
+        check_consumer_config()
+
+    monkeypatch.setenv("MQ_ONBOARDING_QUEUE_NAME", "onboarding")
+    assert check_consumer_config() is True
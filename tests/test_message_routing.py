@@ -0,0 +1,34 @@
+import pytest
+
+from message_routing import get_event_type, get_message_event_type, ONBOARDING_EVENT, LONNSMELDING_EVENT
+
+
+@pytest.fixture
+def routing_keys(monkeypatch):
+    monkeypatch.setenv("MQ_ONBOARDING_ROUTING_KEY", "hr.onboarding")
+    monkeypatch.setenv("MQ_LONNSMELDING_ROUTING_KEY", "hr.lonnsmelding")
+
+
+def test_event_type_comes_from_the_routing_key(routing_keys):
+    assert get_event_type({}, "hr.onboarding") == ONBOARDING_EVENT
+    assert get_event_type({}, "hr.lonnsmelding") == LONNSMELDING_EVENT
+
+
+def test_event_field_wins_over_the_routing_key(routing_keys):
+    assert get_event_type({"event": LONNSMELDING_EVENT}, "hr.onboarding") == LONNSMELDING_EVENT
+
+
+def test_unknown_routing_key_is_not_guessed(routing_keys):
+    assert get_event_type({"Navn": "Ola Nordmann"}, "something.else") is None
+    assert get_event_type({"Navn": "Ola Nordmann"}) is None
+
+
+def test_routing_keys_have_no_defaults(monkeypatch):
+    monkeypatch.delenv("MQ_ONBOARDING_ROUTING_KEY", raising=False)
+    monkeypatch.delenv("MQ_LONNSMELDING_ROUTING_KEY", raising=False)
+    assert get_event_type({}, LONNSMELDING_EVENT) is None
+
+
+def test_unparsed_body(routing_keys):
+    assert get_message_event_type(b'{"event": "lonnsmelding"}', "x") == LONNSMELDING_EVENT
+    assert get_message_event_type(b"not json", "hr.onboarding") == ONBOARDING_EVENT
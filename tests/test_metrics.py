@@ -0,0 +1,85 @@
+import urllib.request
+import urllib.error
+
+from metrics import MetricsRegistry, MessageTimings, start_metrics_server
+
+
+def test_histogram_buckets_are_cumulative_with_inf_sum_and_count():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("stage_duration_seconds", "Duration of each stage", ("stage",),
+                                   buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="lookup")
+    histogram.observe(0.1, stage="lookup")
+    histogram.observe(5, stage="lookup")
+
+    assert registry.expose() == (
+        "# HELP stage_duration_seconds Duration of each stage\n"
+        "# TYPE stage_duration_seconds histogram\n"
+        "stage_duration_seconds_bucket{stage=\"lookup\",le=\"0.1\"} 2\n"
+        "stage_duration_seconds_bucket{stage=\"lookup\",le=\"1.0\"} 2\n"
+        "stage_duration_seconds_bucket{stage=\"lookup\",le=\"+Inf\"} 3\n"
+        "stage_duration_seconds_sum{stage=\"lookup\"} 5.15\n"
+        "stage_duration_seconds_count{stage=\"lookup\"} 3\n")
+
+
+def test_counters_and_gauges_with_escaped_labels():
+    registry = MetricsRegistry()
+    counter = registry.counter("notifications_total", "Notifications", ("result",))
+    counter.inc(result="confirmed")
+    counter.inc(2, result="say \"hi\"\\\n")
+    registry.gauge("buffer_size", "Buffered").set(3)
+    registry.gauge("cache_lookups", "Lookups", ("namespace", "result"),
+                   callback=lambda: {("contact", "hits"): 4})
+
+    assert registry.expose().split("\n") == [
+        "# HELP notifications_total Notifications",
+        "# TYPE notifications_total counter",
+        "notifications_total{result=\"confirmed\"} 1.0",
+        "notifications_total{result=\"say \\\"hi\\\"\\\\\\n\"} 2.0",
+        "# HELP buffer_size Buffered",
+        "# TYPE buffer_size gauge",
+        "buffer_size 3.0",
+        "# HELP cache_lookups Lookups",
+        "# TYPE cache_lookups gauge",
+        "cache_lookups{namespace=\"contact\",result=\"hits\"} 4.0",
+        ""]
+
+
+def test_registering_a_name_again_returns_the_same_metric():
+    registry = MetricsRegistry()
+    assert registry.counter("requests_total", "Requests") is registry.counter("requests_total", "Requests")
+
+
+def test_message_timings_sum_the_calls_of_a_stage():
+    message_timings = MessageTimings("onboarding")
+    message_timings.record("upload", 0.25)
+    message_timings.record("upload", 0.5)
+    message_timings.set_error(ValueError("No case"))
+
+    summary = message_timings.get_summary("failure")
+    assert summary["stages"] == {"upload": {"seconds": 0.75, "calls": 2}}
+    assert (summary["event_type"], summary["outcome"], summary["error"]) == ("onboarding", "failure", "ValueError")
+
+
+def test_metrics_and_readiness_are_served_over_http():
+    registry = MetricsRegistry()
+    registry.counter("requests_total", "Requests").inc()
+    ready = [False]
+    httpd = start_metrics_server(0, host="127.0.0.1", registry=registry, readiness=lambda: ready[0])
+    base_uri = "http://127.0.0.1:" + str(httpd.server_address[1])
+    try:
+        with urllib.request.urlopen(base_uri + "/metrics") as response:
+            assert response.headers["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+            assert response.read().decode("utf-8") == registry.expose()
+
+        try:
+            urllib.request.urlopen(base_uri + "/ready")
+            assert False, "Not ready yet"
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+        ready[0] = True
+        with urllib.request.urlopen(base_uri + "/ready") as response:
+            assert response.status == 200
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,139 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pika = pytest.importorskip("pika")
+
+from notification_publisher import NotificationPublisher
+
+
+class FakeConfirmChannel:
+
+    # Records what's published. The test plays the IO thread and the broker's confirms.
+    def __init__(self):
+        self.published = []
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def confirm_delivery(self, callback):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(json.loads(body)["number"])
+
+
+def ack(delivery_tag, multiple=False):
+    return SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=delivery_tag, multiple=multiple))
+
+
+def nack(delivery_tag, multiple=False):
+    return SimpleNamespace(method=pika.spec.Basic.Nack(delivery_tag=delivery_tag, multiple=multiple))
+
+
+@pytest.fixture
+def fallback_messages():
+    return []
+
+
+def create_publisher(log, fallback_messages, buffer_size=100, max_unconfirmed=3):
+    # Never started, so there's no connection: the test calls the IO thread's callbacks itself
+    return NotificationPublisher(log=log, host="localhost", port=5672, vhost="/", username="guest", password="guest",
+                                 exchange="notifications", buffer_size=buffer_size, max_unconfirmed=max_unconfirmed,
+                                 fallback=fallback_messages.append)
+
+
+def publish(publisher, numbers):
+    for number in numbers:
+        publisher.publish({"number": number})
+
+
+def test_multiple_ack_confirms_every_delivery_up_to_the_tag(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages)
+    channel = FakeConfirmChannel()
+    publish(publisher, range(5))
+    publisher.on_channel_open(channel)
+
+    publisher.on_delivery_confirmation(ack(2, multiple=True))
+    # The confirms made room for the rest of the buffer
+    assert sorted(publisher.unconfirmed) == [3, 4, 5]
+    publisher.on_delivery_confirmation(ack(4))
+    publisher.on_delivery_confirmation(ack(3))
+    publisher.on_delivery_confirmation(ack(5))
+
+    assert channel.published == [0, 1, 2, 3, 4]
+    assert not publisher.buffer and not publisher.unconfirmed
+
+
+def test_nacked_notifications_are_published_again_in_order_before_newer_ones(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages)
+    channel = FakeConfirmChannel()
+    publish(publisher, range(5))
+    publisher.on_channel_open(channel)
+    assert channel.published == [0, 1, 2]
+
+    publisher.on_delivery_confirmation(nack(2, multiple=True))
+
+    assert channel.published == [0, 1, 2, 0, 1]
+    assert [json.loads(body)["number"] for body in publisher.buffer] == [3, 4]
+
+
+def test_unconfirmed_notifications_are_published_again_after_the_channel_closes(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages)
+    channel = FakeConfirmChannel()
+    publish(publisher, range(5))
+    publisher.on_channel_open(channel)
+    publisher.on_delivery_confirmation(ack(1))
+
+    publisher.on_channel_closed(channel, "Connection reset")
+    assert [json.loads(body)["number"] for body in publisher.buffer] == [1, 2, 3, 4]
+    assert publisher.unconfirmed == {}
+
+    new_channel = FakeConfirmChannel()
+    publisher.on_channel_open(new_channel)
+    assert new_channel.published == [1, 2, 3]
+    assert sorted(publisher.unconfirmed) == [1, 2, 3]
+
+
+def test_full_buffer_falls_back_to_publishing_directly(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages, buffer_size=2)
+    publish(publisher, range(3))
+
+    assert len(publisher.buffer) == 2
+    assert fallback_messages == [{"number": 2}]
+
+    publisher.fallback = None
+    with pytest.raises(Exception, match="buffer is full"):
+        publish(publisher, [3])
+
+
+def test_close_waits_for_the_confirms(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages)
+    channel = FakeConfirmChannel()
+    publish(publisher, range(2))
+    publisher.on_channel_open(channel)
+
+    confirmer = threading.Timer(0.2, publisher.on_delivery_confirmation, args=(ack(2, multiple=True),))
+    confirmer.start()
+    publisher.close(timeout=5)
+    confirmer.join()
+
+    assert channel.published == [0, 1]
+    assert fallback_messages == []
+
+
+def test_close_publishes_what_is_left_directly_after_the_timeout(log, fallback_messages):
+    publisher = create_publisher(log, fallback_messages)
+    channel = FakeConfirmChannel()
+    publish(publisher, range(5))
+    publisher.on_channel_open(channel)
+    publisher.on_delivery_confirmation(ack(1))
+
+    publisher.close(timeout=0.1)
+
+    assert fallback_messages == [{"number": number} for number in (1, 2, 3, 4)]
+    assert not publisher.buffer and not publisher.unconfirmed
+    publish(publisher, [5])
+    assert fallback_messages[-1] == {"number": 5}
@@ -0,0 +1,67 @@
+import pytest
+
+import p360_cache
+from p360_cache import TtlLruCache, MISSING
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(p360_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = TtlLruCache(ttl=300, negative_ttl=30)
+    cache.put(("contact", "hr@example.com"), 5)
+    cache.put(("contact", "unknown@example.com"), None)
+
+    clock.now += 29
+    assert cache.get(("contact", "hr@example.com")) == 5
+    assert cache.get(("contact", "unknown@example.com")) is None
+
+    clock.now += 2
+    assert cache.get(("contact", "unknown@example.com")) is MISSING
+    clock.now += 270
+    assert cache.get(("contact", "hr@example.com")) is MISSING
+    assert cache.get_stats() == {"contact": {"hits": 1, "negative_hits": 1, "misses": 2, "evictions": 0},
+                                 "entries": 0}
+
+
+def test_zero_ttl_caches_nothing(clock):
+    cache = TtlLruCache(ttl=300, negative_ttl=0)
+    cache.put(("contact", "unknown@example.com"), None)
+    assert cache.get(("contact", "unknown@example.com")) is MISSING
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TtlLruCache(max_entries=2)
+    cache.put(("contact", "a"), 1)
+    cache.put(("case", "b"), 2)
+    assert cache.get(("contact", "a")) == 1
+
+    cache.put(("case", "c"), 3)
+
+    assert cache.get(("case", "b")) is MISSING
+    assert cache.get(("contact", "a")) == 1
+    assert cache.get(("case", "c")) == 3
+    # The eviction is counted for the namespace of the evicted entry
+    assert cache.get_stats()["case"]["evictions"] == 1
+    assert cache.get_stats()["contact"]["evictions"] == 0
+
+
+def test_invalidate(clock):
+    cache = TtlLruCache()
+    cache.put(("case", "a"), 1)
+    cache.invalidate(("case", "a"))
+    cache.invalidate(("case", "never cached"))
+    assert cache.get(("case", "a")) is MISSING
@@ -0,0 +1,109 @@
+import pytest
+
+pytest.importorskip("models.p360_case")
+
+from p360_client import P360Client, GET_DOCUMENTS_PAGE_SIZE
+
+
+@pytest.fixture(params=[False, True], ids=["buffered", "streaming"])
+def client(request, log, fake_p360):
+    client = P360Client(log=log, api_base_uri=fake_p360.get_base_uri(), api_key="test",
+                        streaming_responses=request.param)
+    yield client
+    client.close()
+
+
+def test_document_folders_are_found_beyond_the_first_page(client, fake_p360):
+    for i in range(2 * GET_DOCUMENTS_PAGE_SIZE + 10):
+        fake_p360.state.add_document("21/1", "Document " + str(i))
+    document_number = fake_p360.state.add_document("21/1", "Arbeidsavtale")
+
+    document_folders = client.fetch_document_folders("21/1", ["Arbeidsavtale", "Melding til Lønn"])
+
+    assert document_folders == {"Arbeidsavtale": document_number, "Melding til Lønn": None}
+    assert fake_p360.state.call_counts["DocumentService/GetDocuments"] == 3
+
+
+def test_document_folder_found_twice_across_pages_is_an_error(client, fake_p360):
+    fake_p360.state.add_document("21/1", "Arbeidsavtale")
+    for i in range(GET_DOCUMENTS_PAGE_SIZE):
+        fake_p360.state.add_document("21/1", "Document " + str(i))
+    fake_p360.state.add_document("21/1", "Arbeidsavtale")
+
+    with pytest.raises(Exception, match="more than one documents"):
+        client.fetch_document_folders("21/1", ["Arbeidsavtale"])
+
+
+def test_document_lookup_does_not_ask_for_file_data(client, monkeypatch):
+    import fake_p360
+    parameters = []
+    get_documents = fake_p360.FakeP360State.get_documents
+    monkeypatch.setitem(fake_p360.ENDPOINTS, "DocumentService/GetDocuments",
+                        lambda state, parameter: parameters.append(parameter) or get_documents(state, parameter))
+    client.fetch_document_folders("21/1", ["Arbeidsavtale"])
+    assert parameters[0]["IncludeFileData"] is False
+
+
+def test_case_created_just_before_is_not_created_again(client, fake_p360):
+    # The second create comes after the first one released the title lock, so it didn't wait for it, but its title
+    # lookup was answered before the first case existed
+    first = client.create_case("Personalmappe - Ola Nordmann - IT", 1, "IT Personalmapper", "01019012345")
+    second = client.create_case("Personalmappe - Ola Nordmann - IT", 1, "IT Personalmapper", "01019012345")
+
+    assert second.get_case_number() == first.get_case_number()
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 1
+
+
+def test_last_case_with_the_access_group_is_used_as_before(client, fake_p360):
+    fake_p360.state.add_case("Personalmappe - HR", "HR Personalmapper", "01019012345", "hr@example.com")
+    fake_p360.state.add_case("Personalmappe - IT", "IT Personalmapper", "01019012345", "hr@example.com")
+    last_case_number = fake_p360.state.add_case("Personalmappe - IT 2", "IT Personalmapper", "01019012345",
+                                                "hr@example.com")
+
+    p360_case = client.fetch_case_by_pnr_and_access_group("01019012345", "IT Personalmapper")
+
+    assert p360_case.get_case_number() == last_case_number
+
+
+def test_missing_case_is_an_error(client):
+    with pytest.raises(Exception, match="Could not find any cases"):
+        client.fetch_case_by_pnr_and_access_group("01019012345", "IT Personalmapper")
+
+
+def test_invalidated_case_is_looked_up_in_p360_again(log, fake_p360):
+    from p360_cache import TtlLruCache
+    client = P360Client(log=log, api_base_uri=fake_p360.get_base_uri(), api_key="test", cache=TtlLruCache())
+    fake_p360.state.add_case("Personalmappe - IT", "IT Personalmapper", "01019012345", "hr@example.com")
+    fake_p360.state.add_case("Personalmappe - HR", "HR Personalmapper", "01019012345", "hr@example.com")
+
+    first = client.get_case_by_pnr_and_access_group("01019012345", "IT Personalmapper")
+    assert client.get_case_by_pnr_and_access_group("01019012345", "IT Personalmapper") is first
+    client.get_case_by_pnr_and_access_group("01019012345", "HR Personalmapper")
+    assert fake_p360.state.call_counts["CaseService/GetCases"] == 2
+
+    client.invalidate_case_by_pnr_and_access_group("01019012345", "IT Personalmapper")
+
+    assert client.get_case_by_pnr_and_access_group("01019012345", "IT Personalmapper").get_case_number() == \
+        first.get_case_number()
+    client.get_case_by_pnr_and_access_group("01019012345", "HR Personalmapper")
+    assert fake_p360.state.call_counts["CaseService/GetCases"] == 3
+    client.close()
+
+
+def test_created_case_is_only_remembered_for_its_ttl(client, fake_p360):
+    import time
+    from p360_cache import TtlLruCache
+    client.created_cases = TtlLruCache(max_entries=1024, ttl=0.2)
+    responsible_recno = client.get_contact_person_by_email("hr@example.com").get_recno()
+
+    def create_case():
+        return client.create_case(case_title="Personalmappe - Ola Nordmann", responsible_person_recno=responsible_recno,
+                                  access_group="IT Personalmapper", pnr="01019012345")
+
+    first = create_case()
+    assert create_case().get_case_number() == first.get_case_number()
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 1
+
+    time.sleep(0.3)
+    create_case()
+    assert fake_p360.state.call_counts["CaseService/CreateCase"] == 2
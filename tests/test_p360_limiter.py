@@ -0,0 +1,131 @@
+import time
+import threading
+
+import pytest
+
+from p360_limiter import AdaptiveLimiter, CircuitBreaker, ConcurrencyShare, CLOSED, HALF_OPEN, OPEN
+from p360_transport import P360Transport
+from errors import RetryableError, CircuitOpenError
+
+
+def test_limit_grows_with_fast_responses_and_is_cut_by_slow_ones():
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1, max_limit=8, latency_target=0.05)
+    for i in range(20):
+        limiter.acquire()
+        limiter.release(0.001, failed=False)
+    assert int(limiter.limit) > 4
+
+    grown_limit = limiter.limit
+    limiter.acquire()
+    limiter.release(1.0, failed=False)
+    assert limiter.limit == pytest.approx(grown_limit * 0.7)
+
+    # At most one cut per latency_target
+    limiter.acquire()
+    limiter.release(0.0, failed=True)
+    assert limiter.limit == pytest.approx(grown_limit * 0.7)
+
+
+def test_limit_stays_within_bounds():
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=1, max_limit=3, latency_target=0.0)
+    for i in range(10):
+        limiter.acquire()
+        limiter.release(0.0, failed=True)
+    assert limiter.limit == 1
+    limiter.latency_target = 10
+    for i in range(100):
+        limiter.acquire()
+        limiter.release(0.0, failed=False)
+    assert limiter.limit == 3
+
+
+def test_acquire_waits_for_a_slot_and_then_gives_up():
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+    limiter.acquire()
+    start = time.monotonic()
+    with pytest.raises(RetryableError):
+        limiter.acquire(timeout=0.1)
+    assert time.monotonic() - start >= 0.1
+
+    threading.Timer(0.1, limiter.cancel).start()
+    limiter.acquire(timeout=5)
+    assert limiter.in_flight == 1
+
+
+def test_circuit_opens_after_failures_in_a_row_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, open_duration=0.1)
+    breaker.before_call()
+    breaker.on_failure()
+    breaker.before_call()
+    breaker.on_success()
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.1)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.on_failure()
+    assert breaker.state == OPEN
+
+    time.sleep(0.1)
+    breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == CLOSED
+
+
+def test_concurrency_share():
+    share = ConcurrencyShare("lonnsmelding", 1)
+    share.acquire()
+    with pytest.raises(RetryableError):
+        share.acquire(timeout=0.05)
+    share.release()
+    share.acquire(timeout=0.05)
+
+
+@pytest.fixture
+def slow_fake_p360():
+    from fake_p360 import FakeP360Server
+    fake_p360 = FakeP360Server(latency=0.2).start()
+    yield fake_p360
+    fake_p360.stop()
+
+
+def test_limiter_backs_off_from_a_slow_p360(slow_fake_p360):
+    limiter = AdaptiveLimiter(initial_limit=8, max_limit=8, latency_target=0.05)
+    transport = P360Transport(pool_maxsize=8, limiter=limiter)
+    url = slow_fake_p360.get_base_uri() + "/DocumentService/Ping"
+
+    threads = [threading.Thread(target=transport.post, args=(url, {"parameter": {}}), kwargs={"idempotent": True})
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    transport.close()
+
+    assert limiter.limit < 8
+    assert limiter.in_flight == 0
+
+
+def test_circuit_breaker_stops_calls_to_a_failing_p360():
+    from fake_p360 import FakeP360Server
+    fake_p360 = FakeP360Server(error_rate=1.0).start()
+    transport = P360Transport(max_retries=0, circuit_breaker=CircuitBreaker(failure_threshold=3, open_duration=60))
+    url = fake_p360.get_base_uri() + "/DocumentService/Ping"
+    try:
+        for i in range(3):
+            assert transport.post(url, {"parameter": {}}, idempotent=True).status_code == 503
+        with pytest.raises(CircuitOpenError):
+            transport.post(url, {"parameter": {}}, idempotent=True)
+        assert fake_p360.state.call_counts["DocumentService/Ping"] == 3
+    finally:
+        transport.close()
+        fake_p360.stop()
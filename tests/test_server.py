@@ -0,0 +1,125 @@
+import pytest
+
+from errors import CircuitOpenError
+
+ONBOARDING_MESSAGE = {
+    "event": "onboarding",
+    "Navn": "Ola Nordmann",
+    "FødselsOgPersonnummer": "01019012345",
+    "DinEpostadresse": "hr@example.com",
+    "Enhet": "IT",
+    "ArbeidsavtaleLanguage": "Norsk",
+}
+
+
+@pytest.fixture
+def failing_p360(monkeypatch, fake_p360):
+    monkeypatch.setenv("P360_CIRCUIT_BREAKER", "true")
+    monkeypatch.setenv("P360_CIRCUIT_FAILURE_THRESHOLD", "1")
+    monkeypatch.setenv("P360_MAX_RETRIES", "0")
+    fake_p360.state.error_rate = 1.0
+    return fake_p360
+
+
+def test_open_circuit_fails_the_message_with_a_notification_on_the_mq_client_path(failing_p360, request):
+    server = request.getfixturevalue("server")
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is False
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE, Navn="Kari Nordmann")) is False
+    assert [mq_message["event"] for mq_message in server.mq_client.sent] == ["error", "error"]
+
+
+def test_open_circuit_requeues_the_message_with_a_requeuing_consumer(failing_p360, request):
+    server = request.getfixturevalue("server")
+    server.requeue_retryable_errors = True
+    assert server.handle_new_onboarding(dict(ONBOARDING_MESSAGE)) is False
+    with pytest.raises(CircuitOpenError):
+        server.handle_new_onboarding(dict(ONBOARDING_MESSAGE, Navn="Kari Nordmann"))
+    assert [mq_message["event"] for mq_message in server.mq_client.sent] == ["error"]
+
+
+def test_supervised_servers_must_be_able_to_drain(monkeypatch):
+    for module in ("config.server", "models.p360_case", "utils"):
+        pytest.importorskip(module)
+    from server import check_consumer_config
+
+    monkeypatch.delenv("MQ_WORKER_COUNT", raising=False)
+    monkeypatch.delenv("MQ_LANES", raising=False)
+    assert check_consumer_config() is False
+    with pytest.raises(Exception, match="drains"):
+        check_consumer_config(require_worker_threads=True)
+
+    monkeypatch.setenv("MQ_WORKER_COUNT", "4")
+    monkeypatch.delenv("MQ_LONNSMELDING_ROUTING_KEY", raising=False)
+    with pytest.raises(Exception, match="ROUTING_KEY"):
+        check_consumer_config(require_worker_threads=True)
+
+    monkeypatch.setenv("MQ_ONBOARDING_ROUTING_KEY", "hr.onboarding")
+    monkeypatch.setenv("MQ_LONNSMELDING_ROUTING_KEY", "hr.lonnsmelding")
+    assert check_consumer_config(require_worker_threads=True) is True
+
+
+def test_pnr_is_not_logged_when_the_lonnsmelding_has_no_case(server, fake_p360, caplog):
+    import logging
+    caplog.set_level(logging.DEBUG, logger="tests")
+    # The person only has a case in another unit
+    fake_p360.state.add_case("Personalmappe - HR", "HR Personalmapper", "01019012345", "hr@example.com")
+    lonnsmelding_message = {"event": "lonnsmelding", "Navn": "Ola Nordmann",
+                            "FødselsOgPersonnummer": "01019012345", "Enhet": "IT"}
+
+    assert server.handle_new_lonnsmelding(lonnsmelding_message) is False
+    assert "Something went wrong" in caplog.text
+    assert "01019012345" not in caplog.text
+
+
+def test_run_shuts_down_the_render_workers_when_it_ends(server, monkeypatch, log):
+    import os
+    from document_renderer import DocumentRenderer
+
+    for name in ("get_mq_listen_queue_name", "get_mq_vhost", "get_mq_username", "get_mq_password",
+                 "get_mq_listen_exchange_name"):
+        monkeypatch.setattr(server.config, name, lambda: "test", raising=False)
+    monkeypatch.setattr(server, "connect_to_queue", lambda *args, **kwargs: None)
+    monkeypatch.setattr(server.mq_client, "start_consuming", lambda *args: None, raising=False)
+    monkeypatch.delenv("MQ_WORKER_COUNT", raising=False)
+    monkeypatch.delenv("MQ_LANES", raising=False)
+    server.document_renderer.close()
+    server.document_renderer = DocumentRenderer(log=log, pool_size=2)
+    worker_pids = list(server.document_renderer.executor._processes)
+    assert len(worker_pids) == 2
+
+    server.run()
+
+    assert server.document_renderer is None
+    for pid in worker_pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+def test_run_is_only_ready_between_warm_up_and_the_end_of_consuming(server, monkeypatch, tmp_path):
+    import os
+    from startup import SERVER_READY
+
+    ready_file = str(tmp_path / "ready")
+    monkeypatch.setenv("READY_FILE", ready_file)
+    for name in ("get_mq_listen_queue_name", "get_mq_vhost", "get_mq_username", "get_mq_password",
+                 "get_mq_listen_exchange_name"):
+        monkeypatch.setattr(server.config, name, lambda: "test", raising=False)
+    monkeypatch.delenv("MQ_WORKER_COUNT", raising=False)
+    monkeypatch.delenv("MQ_LANES", raising=False)
+    readiness = {}
+
+    def connect_to_queue(*args, **kwargs):
+        readiness["warm_up"] = (server.ready, SERVER_READY.values.get((), 0), os.path.exists(ready_file))
+
+    def start_consuming(*args):
+        with open(ready_file) as file:
+            readiness["consuming"] = (server.ready, SERVER_READY.values.get((), 0), file.read())
+
+    monkeypatch.setattr(server, "connect_to_queue", connect_to_queue)
+    monkeypatch.setattr(server.mq_client, "start_consuming", start_consuming, raising=False)
+
+    server.run()
+
+    assert readiness["warm_up"] == (False, 0, False)
+    assert readiness["consuming"] == (True, 1, str(os.getpid()))
+    assert (server.ready, SERVER_READY.values.get((), 0), os.path.exists(ready_file)) == (False, 0, False)
@@ -0,0 +1,118 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight, KeyedLock
+from deadline import Deadline, current_deadline
+from errors import DeadlineExceededError
+
+
+def run_with_deadline(seconds, function, *args):
+    token = current_deadline.set(Deadline(seconds) if seconds is not None else None)
+    try:
+        return function(*args)
+    finally:
+        current_deadline.reset(token)
+
+
+def test_identical_calls_in_flight_run_once():
+    single_flight = SingleFlight()
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        time.sleep(0.2)
+        return "case"
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(single_flight.do, "key", lookup) for i in range(5)]
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert sorted(results) == [("case", False)] + [("case", True)] * 4
+    assert single_flight.calls == {}
+
+
+def test_waiters_get_the_same_exception():
+    single_flight = SingleFlight()
+    started = threading.Event()
+
+    def lookup():
+        started.set()
+        time.sleep(0.2)
+        raise ValueError("P360 says no")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "key", lookup)
+        started.wait()
+        waiter = executor.submit(single_flight.do, "key", lookup)
+        for future in (leader, waiter):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_waiter_gives_up_at_its_own_deadline():
+    single_flight = SingleFlight()
+    started = threading.Event()
+
+    def lookup():
+        started.set()
+        time.sleep(1)
+        return "case"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "key", lookup)
+        started.wait()
+        start = time.monotonic()
+        waiter = executor.submit(run_with_deadline, 0.1, single_flight.do, "key", lookup)
+        with pytest.raises(DeadlineExceededError):
+            waiter.result()
+        assert time.monotonic() - start < 0.5
+        assert leader.result() == ("case", False)
+
+
+def test_waiter_does_not_inherit_the_leaders_deadline():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def lookup():
+        calls.append(1)
+        if len(calls) == 1:
+            started.set()
+            time.sleep(0.2)
+            raise DeadlineExceededError("The leader ran out of time")
+        return "case"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leader = executor.submit(single_flight.do, "key", lookup)
+        started.wait()
+        waiter = executor.submit(run_with_deadline, 10, single_flight.do, "key", lookup)
+        with pytest.raises(DeadlineExceededError):
+            leader.result()
+        assert waiter.result() == ("case", False)
+    assert len(calls) == 2
+
+
+def test_keyed_lock_tells_if_it_waited():
+    keyed_lock = KeyedLock()
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with keyed_lock.hold("title") as waited:
+            holding.set()
+            release.wait()
+            return waited
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(hold)
+        holding.wait()
+        second = executor.submit(hold)
+        time.sleep(0.1)
+        release.set()
+        assert first.result() is False
+        assert second.result() is True
+    assert keyed_lock.locks == {}
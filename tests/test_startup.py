@@ -0,0 +1,29 @@
+import time
+
+from startup import StartupTimings, STARTUP_DURATION
+
+
+def test_parts_are_timed_on_their_own_threads():
+    startup_timings = StartupTimings()
+    threads = [startup_timings.start_thread(part, time.sleep, 0.1) for part in ("templates", "p360_connections")]
+    with startup_timings.measure("broker"):
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join()
+
+    summary = startup_timings.get_summary()
+    assert sorted(summary["parts"]) == ["broker", "p360_connections", "templates"]
+    assert all(seconds >= 0.1 for seconds in summary["parts"].values())
+    # The parts ran side by side, so together they took longer than the whole
+    assert sum(summary["parts"].values()) > summary["seconds"]
+    assert round(STARTUP_DURATION.values[("broker",)], 4) == summary["parts"]["broker"]
+
+
+def test_a_failing_part_is_still_timed():
+    startup_timings = StartupTimings()
+    try:
+        with startup_timings.measure("broker"):
+            raise ConnectionError("No broker")
+    except ConnectionError:
+        pass
+    assert "broker" in startup_timings.get_summary()["parts"]
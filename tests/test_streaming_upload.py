@@ -0,0 +1,56 @@
+import io
+import json
+import base64
+
+import pytest
+
+import streaming_upload
+from streaming_upload import StreamingUploadBody
+
+
+class ShortReads(io.BytesIO):
+
+    # A file object that returns fewer bytes than asked for, like a pipe or a socket
+    def read(self, size=-1):
+        return super().read(min(size, 1000) if size > 0 else size)
+
+
+def read_all(body, size):
+    data = b""
+    while True:
+        chunk = body.read(size)
+        if not chunk:
+            return data
+        data += chunk
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(streaming_upload, "SOURCE_CHUNK_SIZE", 3 * 100)
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, 299, 300, 301, 5000])
+@pytest.mark.parametrize("source", [bytes, io.BytesIO, ShortReads])
+@pytest.mark.parametrize("read_size", [-1, 1, 7, 4096])
+def test_body_matches_the_buffered_json(length, source, read_size):
+    document = bytes(i % 251 for i in range(length))
+    file_object = {"title": "Arbeidsavtale æøå \"signert\"", "format": "docx", "data": source(document)}
+
+    body = StreamingUploadBody("26/00001-1", file_object)
+    data = read_all(body, read_size) if read_size > 0 else body.read()
+
+    assert len(data) == len(body)
+    assert json.loads(data) == {"parameter": {"DocumentNumber": "26/00001-1", "Files": [
+        {"title": "Arbeidsavtale æøå \"signert\"", "format": "docx",
+         "data": base64.b64encode(document).decode("ascii")}]}}
+
+
+def test_file_object_is_read_from_its_current_position():
+    source = io.BytesIO(b"skipped" + b"document")
+    source.seek(len(b"skipped"))
+
+    body = StreamingUploadBody("26/00001-1", {"title": "A", "format": "pdf", "data": source})
+    data = body.read()
+
+    assert len(data) == len(body)
+    assert json.loads(data)["parameter"]["Files"][0]["data"] == base64.b64encode(b"document").decode("ascii")
@@ -0,0 +1,60 @@
+import logging
+
+from structured_log import LogValue, LogFields, redact, redact_text
+
+
+def test_redact_text_hides_authkeys_and_pnrs():
+    assert redact_text("https://p360/api?authkey=abc-123&format=json") == "https://p360/api?authkey=***&format=json"
+    assert redact_text("Employee 01017012345 has no case") == "Employee *** has no case"
+    assert redact_text("010170 12345 and 010170-12345") == "*** and ***"
+    # Longer digit runs, like case ids or phone numbers with a country code, are left alone
+    assert redact_text("Recno 1234567890123") == "Recno 1234567890123"
+
+
+def test_redact_hides_sensitive_keys_and_file_contents():
+    value = {
+        "Pnr": "01017012345",
+        "ArchiveCodes": [{"ArchiveCode": "01017012345", "ArchiveType": "FNR"}],
+        "Contacts": [{"FødselsOgPersonnummer": "01017012345", "Name": "Kari"}],
+        "Files": [{"Title": "Kontrakt", "Data": "UEsDBBQ="}],
+        "Title": "Ansettelse for 01017012345"
+    }
+    assert redact(value) == {
+        "Pnr": "***",
+        "ArchiveCodes": [{"ArchiveCode": "***", "ArchiveType": "FNR"}],
+        "Contacts": [{"FødselsOgPersonnummer": "***", "Name": "Kari"}],
+        "Files": [{"Title": "Kontrakt", "Data": "<8 characters>"}],
+        "Title": "Ansettelse for ***"
+    }
+    assert value["Pnr"] == "01017012345"
+
+
+def test_log_value_is_redacted_and_truncated():
+    assert str(LogValue({"pnr": "01017012345", "Æ": 1})) == "{\"pnr\": \"***\", \"Æ\": 1}"
+    assert str(LogValue(ValueError("No case for 01017012345"))) == "No case for ***"
+    assert str(LogValue("x" * 15, max_length=10)) == "xxxxxxxxxx... (5 more characters)"
+    assert str(LogValue("x" * 15, max_length=None)) == "x" * 15
+
+
+def test_log_fields_quote_strings_and_render_other_values_as_json():
+    fields = LogFields(endpoint="CaseService/GetCases", body={"Pnr": "01017012345"}, status=200)
+    assert str(fields) == "endpoint=\"CaseService/GetCases\" body={\"Pnr\": \"***\"} status=200"
+
+
+def test_values_are_only_rendered_when_the_record_is_emitted(caplog):
+    class CountingValue:
+        def __init__(self):
+            self.renders = 0
+
+        def __str__(self):
+            self.renders += 1
+            return "rendered"
+
+    value = CountingValue()
+    log = logging.getLogger("test_structured_log")
+    with caplog.at_level(logging.INFO, logger="test_structured_log"):
+        log.debug("Response: %s", LogValue(value))
+        assert value.renders == 0
+        log.info("Response: %s", LogValue(value))
+    assert value.renders > 0
+    assert caplog.messages == ["Response: rendered"]
@@ -0,0 +1,123 @@
+import io
+import os
+import re
+import zipfile
+
+import pytest
+
+from template_registry import TemplateRegistry
+from document_renderer import render_docx_file
+
+CONTENT_TYPES = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                 '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                 '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                 '<Default Extension="xml" ContentType="application/xml"/>'
+                 '<Override PartName="/word/document.xml" '
+                 'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+                 '</Types>')
+RELATIONSHIPS = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                 '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                 '<Relationship Id="rId1" Target="word/document.xml" '
+                 'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+                 '</Relationships>')
+DOCUMENT = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+            '{paragraphs}</w:body></w:document>')
+
+# Word splits placeholders into several runs, e.g. after a spelling check or an edit in the middle of the name
+SPLIT_PLACEHOLDER = ('<w:p><w:r><w:t xml:space="preserve">Navn: </w:t></w:r><w:r><w:t>{</w:t></w:r>'
+                     '<w:r><w:rPr><w:b/></w:rPr><w:t>{ Na</w:t></w:r><w:r><w:t>vn }</w:t></w:r>'
+                     '<w:r><w:t>}</w:t></w:r></w:p>')
+PARAGRAPHS = (SPLIT_PLACEHOLDER +
+              '<w:p><w:r><w:t xml:space="preserve">Enhet: {{ Enhet }}, saksnummer {{p360_case_number}}</w:t></w:r></w:p>')
+VALUES = {"Navn": "Ola Nordmann", "Enhet": "IT", "p360_case_number": "26/00001"}
+
+
+def write_template(path, paragraphs):
+    with zipfile.ZipFile(path, "w") as docx_file:
+        docx_file.writestr("[Content_Types].xml", CONTENT_TYPES)
+        docx_file.writestr("_rels/.rels", RELATIONSHIPS)
+        docx_file.writestr("word/document.xml", DOCUMENT.format(paragraphs=paragraphs))
+    return str(path)
+
+
+def get_paragraph_texts(document_contents):
+    # The text of each paragraph, whatever runs it is split into
+    with zipfile.ZipFile(io.BytesIO(document_contents)) as docx_file:
+        xml = docx_file.read("word/document.xml").decode("utf-8")
+    return ["".join(re.findall(r"<w:t(?:\s[^>]*)?>([^<]*)</w:t>", paragraph))
+            for paragraph in re.findall(r"<w:p[ >].*?</w:p>", xml)]
+
+
+@pytest.fixture
+def registry(log):
+    return TemplateRegistry(log=log)
+
+
+def test_placeholder_split_across_runs(registry, tmp_path):
+    path = write_template(tmp_path / "template.docx", PARAGRAPHS)
+
+    document_contents = registry.render(path, VALUES)
+
+    assert registry.get(path).placeholder_count == 3
+    assert get_paragraph_texts(document_contents) == ["Navn: Ola Nordmann", "Enhet: IT, saksnummer 26/00001"]
+    with zipfile.ZipFile(io.BytesIO(document_contents)) as docx_file:
+        assert docx_file.read("[Content_Types].xml").decode("utf-8") == CONTENT_TYPES
+
+
+def test_values_are_escaped_and_none_is_empty(registry, tmp_path):
+    path = write_template(tmp_path / "template.docx", PARAGRAPHS)
+
+    document_contents = registry.render(path, {"Navn": "Hansen & <Sønn>", "Enhet": None})
+
+    with zipfile.ZipFile(io.BytesIO(document_contents)) as docx_file:
+        assert b"Hansen &amp; &lt;S\xc3\xb8nn&gt;" in docx_file.read("word/document.xml")
+    assert get_paragraph_texts(document_contents) == ["Navn: Hansen &amp; &lt;Sønn&gt;", "Enhet: , saksnummer "]
+
+
+@pytest.mark.parametrize("paragraph", [
+    '<w:p><w:r><w:t>{% if Navn %}{{ Navn }}{% endif %}</w:t></w:r></w:p>',
+    '<w:p><w:r><w:t>{# a comment #}{{ Navn }}</w:t></w:r></w:p>',
+    '<w:p><w:r><w:t>{{ Navn|upper }}</w:t></w:r></w:p>',
+    '<w:p><w:r><w:instrText> MERGEFIELD Navn </w:instrText></w:r></w:p>',
+])
+def test_unsupported_syntax_falls_back_to_docx_generator(registry, tmp_path, paragraph):
+    path = write_template(tmp_path / "template.docx", paragraph)
+
+    class RecordingDocxGenerator:
+        def __init__(self):
+            self.calls = []
+
+        def create_docx_file(self, mq_message, incoming_document_path, output_path):
+            self.calls.append(incoming_document_path)
+            with open(output_path, "wb") as output_file:
+                output_file.write(b"rendered by DocxGenerator")
+
+    document_creator = RecordingDocxGenerator()
+
+    assert registry.render(path, VALUES) is None
+    assert render_docx_file(document_creator, registry, VALUES, path) == b"rendered by DocxGenerator"
+    assert document_creator.calls == [path]
+
+
+def test_changed_template_is_recompiled(registry, tmp_path):
+    path = write_template(tmp_path / "template.docx", PARAGRAPHS)
+    first = registry.get(path)
+    assert registry.get(path) is first
+
+    write_template(tmp_path / "template.docx", '<w:p><w:r><w:t>{{ Navn }}</w:t></w:r></w:p>')
+    os.utime(path, (first.mtime + 10, first.mtime + 10))
+
+    assert get_paragraph_texts(registry.render(path, VALUES)) == ["Ola Nordmann"]
+
+
+def test_same_text_as_docx_generator(registry, tmp_path, log):
+    docxgenerator = pytest.importorskip("docxgenerator")
+    path = write_template(tmp_path / "template.docx", PARAGRAPHS)
+    output_path = str(tmp_path / "generated.docx")
+
+    docxgenerator.DocxGenerator(log=log).create_docx_file(VALUES, path, output_path)
+    with open(output_path, "rb") as generated_file:
+        expected = get_paragraph_texts(generated_file.read())
+
+    assert get_paragraph_texts(registry.render(path, VALUES)) == expected